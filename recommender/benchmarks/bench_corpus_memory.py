@@ -0,0 +1,76 @@
+"""
+Peak memory of building the training corpus: materialised lists (previous
+load_data/build_model) against the streaming corpus.
+
+Run from the recommender directory (uses a temporary sqlite database):
+    python -m benchmarks.bench_corpus_memory --sizes 5000 20000 50000
+
+Memory is measured with tracemalloc, from loading the rows to the bag-of-words
+corpus (the LDA fit itself is the same in both paths, add --with-lda to include it).
+"""
+import argparse
+import time
+import tracemalloc
+
+from benchmarks.database import setup_database, create_events
+from benchmarks.synthetic import generate_descriptions
+
+
+def measure(function):
+    tracemalloc.start()
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5000, 20000, 50000])
+    parser.add_argument('--with-lda', action='store_true')
+    args = parser.parse_args()
+
+    setup_database()
+    from gensim import corpora
+    from nltk.tokenize import RegexpTokenizer
+    from gensim.parsing.porter import PorterStemmer
+    from dimadb.models import Events, PreprocessedText
+    from dimadb.lda_model_builder import LdaModelManager, DescriptionStream, TokenStream, BowStream, get_artifact_path
+
+    manager = LdaModelManager()
+
+    # Previous implementation: every model instance, every description, every text and the whole corpus in memory
+    def materialised():
+        docs = list(Events.objects.all().order_by('-created_at'))
+        data = [str(item.description) for item in docs]
+        tokenizer = RegexpTokenizer(r'\w+')
+        stemmer = PorterStemmer()
+        texts = [manager.preprocessing(tokenizer, stemmer, d) for d in data]
+        dictionary = corpora.Dictionary(texts)
+        corpus = [dictionary.doc2bow(text) for text in texts]
+        if (args.with_lda):
+            manager.create_lda_model(corpus, dictionary, manager.NUM_OF_TOPICS)
+
+    def streaming():
+        texts = TokenStream(manager, DescriptionStream('events'))
+        dictionary = corpora.Dictionary(texts)
+        corpora.MmCorpus.serialize(get_artifact_path('events', 'corpus'), BowStream(dictionary, texts))
+        if (args.with_lda):
+            manager.create_lda_model(corpora.MmCorpus(get_artifact_path('events', 'corpus')), dictionary, manager.NUM_OF_TOPICS)
+
+    for size in args.sizes:
+        Events.objects.all().delete()
+        PreprocessedText.objects.all().delete()
+        create_events(generate_descriptions(size))
+
+        results = [('materialised', measure(materialised)),
+                   ('streaming (cold cache)', measure(streaming)),
+                   ('streaming (warm cache)', measure(streaming))]
+        for name, (seconds, peak) in results:
+            print('%6d items | %-22s | %7.2fs | peak %8.1f MB' % (size, name, seconds, peak / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Compare the single-core LDA training with gensim's multicore LDA.
+
+Run from the recommender directory (no database is needed):
+    python -m benchmarks.bench_lda_training --sizes 5000 20000 --workers 3 7 15
+
+For each configuration the wall time and the topic coherence (u_mass, and c_v
+unless --no-cv) are reported, so that defaults can be chosen for
+LDA_TRAINING_OPTIONS.
+"""
+import argparse
+import time
+
+from gensim import corpora, models
+from gensim.models import CoherenceModel
+
+from benchmarks.synthetic import generate_descriptions, tokenize
+
+
+def train(corpus, dictionary, args, training_mode, workers=None):
+    start = time.perf_counter()
+    if (training_mode == 'multicore'):
+        model = models.ldamulticore.LdaMulticore(corpus=corpus, id2word=dictionary, num_topics=args.topics, random_state=100,
+                                                 workers=workers, chunksize=args.chunksize, passes=args.passes)
+    else:
+        model = models.ldamodel.LdaModel(corpus=corpus, id2word=dictionary, num_topics=args.topics, random_state=100,
+                                         chunksize=args.chunksize, passes=args.passes)
+    return model, time.perf_counter() - start
+
+
+def coherence(model, texts, corpus, dictionary, measure):
+    if (measure == 'u_mass'):
+        return CoherenceModel(model=model, corpus=corpus, dictionary=dictionary, coherence='u_mass').get_coherence()
+    return CoherenceModel(model=model, texts=texts, dictionary=dictionary, coherence=measure).get_coherence()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5000, 20000])
+    parser.add_argument('--workers', type=int, nargs='+', default=[3, 7, 15])
+    parser.add_argument('--topics', type=int, default=11)
+    parser.add_argument('--chunksize', type=int, default=2000)
+    parser.add_argument('--passes', type=int, default=1)
+    parser.add_argument('--no-cv', action='store_true', help='Skip the (slow) c_v coherence')
+    args = parser.parse_args()
+
+    measures = ['u_mass'] if args.no_cv else ['u_mass', 'c_v']
+    for size in args.sizes:
+        texts = [tokenize(d) for d in generate_descriptions(size)]
+        dictionary = corpora.Dictionary(texts)
+        corpus = [dictionary.doc2bow(text) for text in texts]
+
+        configurations = [('single', None)] + [('multicore', workers) for workers in args.workers]
+        for training_mode, workers in configurations:
+            model, seconds = train(corpus, dictionary, args, training_mode, workers)
+            scores = ['%s %.4f' % (measure, coherence(model, texts, corpus, dictionary, measure)) for measure in measures]
+            print('%6d items | %-9s | workers %-4s | %7.2fs | %s'
+                  % (size, training_mode, workers or '-', seconds, ' | '.join(scores)))
+
+
+if __name__ == '__main__':
+    main()
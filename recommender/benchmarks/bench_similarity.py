@@ -0,0 +1,95 @@
+"""
+Compare the pairwise similarity loop used before with the blocked matrix engine.
+
+Run from the recommender directory (no database is needed):
+    python -m benchmarks.bench_similarity --sizes 1000 10000 50000
+
+The old path is quadratic in Python, so above --old-max-pairs it is timed on a
+random sample of pairs and its total time is extrapolated.
+"""
+import argparse
+import random
+import time
+
+from gensim import corpora, models
+from gensim.matutils import cossim
+
+from dimadb.similarity_engine import doc_topic_matrix, normalize_rows, iter_similar_pairs
+from benchmarks.synthetic import generate_descriptions, tokenize
+
+
+def build_lda(n_docs, n_topics):
+    texts = [tokenize(d) for d in generate_descriptions(n_docs)]
+    dictionary = corpora.Dictionary(texts)
+    corpus = [dictionary.doc2bow(text) for text in texts]
+    model = models.ldamodel.LdaModel(corpus=corpus, id2word=dictionary, num_topics=n_topics, random_state=100)
+    return model, corpus
+
+
+# The previous implementation of save_similarity, without the database writes
+def old_similarity(model, corpus, threshold, pairs):
+    n_similar = 0
+    for source_index, target_index in pairs:
+        sim = cossim(
+            model.get_document_topics(corpus[source_index], minimum_probability=0),
+            model.get_document_topics(corpus[target_index], minimum_probability=0)
+            )
+        if (float(sim) >= threshold):
+            n_similar += 1
+    return n_similar
+
+
+def new_similarity(model, corpus, threshold, block_size):
+    doc_topics = normalize_rows(doc_topic_matrix(model, corpus))
+    n_similar = 0
+    for sources, targets, sims in iter_similar_pairs(doc_topics, threshold, block_size):
+        n_similar += len(sources)
+    return n_similar
+
+
+def run(size, args, rng):
+    model, corpus = build_lda(size, args.topics)
+    n_pairs = size * (size - 1) // 2
+
+    start = time.perf_counter()
+    new_similar = new_similarity(model, corpus, args.threshold, args.block_size)
+    new_seconds = time.perf_counter() - start
+
+    if (n_pairs <= args.old_max_pairs):
+        pairs = ((i, j) for i in range(size - 1) for j in range(i + 1, size))
+        start = time.perf_counter()
+        old_similar = old_similarity(model, corpus, args.threshold, pairs)
+        old_seconds = time.perf_counter() - start
+        old_note = 'measured, %d similar pairs (new: %d)' % (old_similar, new_similar)
+    else:
+        sample = []
+        while (len(sample) < args.old_sample_pairs):
+            i, j = rng.randrange(size), rng.randrange(size)
+            if (i != j):
+                sample.append((min(i, j), max(i, j)))
+        start = time.perf_counter()
+        old_similarity(model, corpus, args.threshold, sample)
+        old_seconds = (time.perf_counter() - start) / len(sample) * n_pairs
+        old_note = 'extrapolated from %d sampled pairs' % len(sample)
+
+    print('%6d items | %12d pairs | old %10.1fs (%s) | new %7.2fs | speed-up x%.0f'
+          % (size, n_pairs, old_seconds, old_note, new_seconds, old_seconds / max(new_seconds, 1e-9)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--topics', type=int, default=11)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--block-size', type=int, default=1024)
+    parser.add_argument('--old-max-pairs', type=int, default=500000)
+    parser.add_argument('--old-sample-pairs', type=int, default=20000)
+    args = parser.parse_args()
+
+    rng = random.Random(100)
+    for size in args.sizes:
+        run(size, args, rng)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""
+Time each stage of the similarity training on a synthetic catalogue and write
+the results as JSON, to compare commits and catch regressions.
+
+Run from the recommender directory (uses a temporary sqlite database):
+    python -m benchmarks.bench_training --sizes 1000 5000 --output results.json
+    python -m benchmarks.bench_training --sizes 1000 5000 --compare results.json
+
+Scenarios: 'cold' is a full training with an empty preprocessing cache,
+'warm' the same training again, 'incremental' an update after --changed-share
+of the descriptions changed. The stages are the ones reported to the training
+progress callback; peak memory is the Python heap traced by tracemalloc (numpy
+arrays included) and max_rss_mb the maximum resident size of the process.
+Tracing slows the Python code down: use --no-trace to compare times only.
+With --similarity-workers above 1 the similarities are computed by worker
+processes, whose memory is only counted in max_rss_mb. --bounded trains with
+the vocabulary pruning and float32 arrays of LDA_MEMORY_BOUNDS; artifact_mb is
+the size of the artifact directory of the trained version.
+"""
+import argparse
+import datetime
+import json
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from benchmarks.database import setup_database, create_events, create_products, clear_items
+from benchmarks.synthetic import generate_catalogue, generate_descriptions
+
+MB = 1024 * 1024
+
+
+# Progress callback recording the wall time and the traced memory peak of each stage
+class StageRecorder(object):
+
+    def __init__(self, trace=True):
+        self.trace = trace
+        self.stages = []
+        self.current = None
+        self.started_at = None
+
+    def __call__(self, stage, progress=0):
+        if (stage == self.current):
+            return
+        self.close()
+        self.current = stage
+        self.started_at = time.perf_counter()
+        if (self.trace and hasattr(tracemalloc, 'reset_peak')):
+            tracemalloc.reset_peak()
+
+    def close(self):
+        if (self.current is None):
+            return
+        seconds = time.perf_counter() - self.started_at
+        peak_mb = tracemalloc.get_traced_memory()[1] / MB if self.trace else 0
+        # A stage reported several times (e.g. 'index' of a fallback training) is accumulated
+        for stage in self.stages:
+            if (stage['stage'] == self.current):
+                stage['seconds'] += seconds
+                stage['peak_mb'] = max(stage['peak_mb'], peak_mb)
+                break
+        else:
+            self.stages.append({'stage': self.current, 'seconds': seconds, 'peak_mb': peak_mb})
+        self.current = None
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_max_rss_mb():
+    # The largest of this process and of its (similarity worker) children
+    max_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Kilobytes on Linux, bytes on macOS
+    return max_rss / MB if sys.platform == 'darwin' else max_rss / 1024
+
+
+def count_rows_written(item_type):
+    from dimadb.models import LdaSimilarity, LdaNeighbour
+    from dimadb.lda_model_builder import get_active_version
+    version = get_active_version(item_type)
+    if (version is None):
+        return 0
+    if (version.similarity_storage == 'top_k'):
+        return LdaNeighbour.objects.filter(version=version.id).count()
+    return LdaSimilarity.objects.filter(version=str(version.id)).count()
+
+
+def get_artifact_mb(item_type):
+    from dimadb.lda_model_builder import get_active_version
+    version = get_active_version(item_type)
+    if (version is None or version.artifact_bytes is None):
+        return None
+    return version.artifact_bytes / MB
+
+
+def run_training(item_type, backend, mode, trace=True, training_options=None):
+    from dimadb.content_based_recommender import ContentBasedRecommender
+
+    recorder = StageRecorder(trace)
+    if (trace):
+        tracemalloc.start()
+    start = time.perf_counter()
+    ContentBasedRecommender.train_items_by_items(item_type, mode=mode, progress_callback=recorder, backend=backend,
+                                                 training_options=training_options)
+    seconds = time.perf_counter() - start
+    recorder.close()
+    peak_mb = 0
+    if (trace):
+        peak_mb = max([stage['peak_mb'] for stage in recorder.stages] + [tracemalloc.get_traced_memory()[1] / MB])
+        tracemalloc.stop()
+
+    return {
+        'seconds': seconds,
+        'peak_mb': peak_mb,
+        'max_rss_mb': get_max_rss_mb(),
+        'rows_written': count_rows_written(item_type),
+        'artifact_mb': get_artifact_mb(item_type),
+        'stages': recorder.stages,
+    }
+
+
+# Replace the descriptions of a share of the items, as an import of updated items would
+def change_descriptions(item_type, share):
+    from django.apps import apps
+    from django.utils import timezone
+    Model = apps.get_model(app_label='dimadb', model_name=item_type)
+    ids = list(Model.objects.order_by('id').values_list('id', flat=True))
+    changed_ids = ids[::max(int(1 / share), 1)] if share > 0 else []
+    for item_id, description in zip(changed_ids, generate_descriptions(len(changed_ids), seed=300)):
+        Model.objects.filter(id=item_id).update(description=description, modified_at=timezone.now())
+    return len(changed_ids)
+
+
+def result_key(result):
+    return (result['item_type'], result['backend'], result['size'], result['scenario'])
+
+
+# Print the ratios to a previous run; returns False when a time or a memory peak grew beyond the tolerance
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as baseline_file:
+        baseline = {result_key(result): result for result in json.load(baseline_file)['results']}
+
+    passed = True
+    for result in results:
+        previous = baseline.get(result_key(result))
+        if (previous is None):
+            continue
+        time_ratio = result['seconds'] / max(previous['seconds'], 1e-9)
+        memory_ratio = result['peak_mb'] / previous['peak_mb'] if result['peak_mb'] and previous['peak_mb'] else 1
+        # Informative only: a smaller or larger model is not a regression
+        artifact_ratio = result.get('artifact_mb') / previous['artifact_mb'] if result.get('artifact_mb') and previous.get('artifact_mb') else 1
+        regression = time_ratio > 1 + tolerance or memory_ratio > 1 + tolerance
+        passed = passed and not regression
+        print('%-8s | %-5s | %7d | %-11s | time x%.2f | peak x%.2f | artifacts x%.2f%s'
+              % (result['item_type'], result['backend'], result['size'], result['scenario'], time_ratio, memory_ratio,
+                 artifact_ratio, ' | REGRESSION' if regression else ''))
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000])
+    parser.add_argument('--item-types', nargs='+', default=['events', 'products'], choices=['events', 'products'])
+    parser.add_argument('--backends', nargs='+', default=['lda'], choices=['lda', 'tfidf'])
+    parser.add_argument('--scenarios', nargs='+', default=['cold', 'warm', 'incremental'], choices=['cold', 'warm', 'incremental'])
+    parser.add_argument('--changed-share', type=float, default=0.01, help='Share of the items changed before the incremental training')
+    parser.add_argument('--similarity-workers', type=int, default=1, help='Processes computing the LDA similarities')
+    parser.add_argument('--bounded', action='store_true', help='Prune the vocabulary and store float32 arrays (LDA_MEMORY_BOUNDS)')
+    parser.add_argument('--no-trace', action='store_true', help='Do not trace the memory (faster, times only)')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed growth of time and memory when comparing')
+    args = parser.parse_args()
+
+    setup_database()
+    from dimadb.models import PreprocessedText
+    create_items = {'events': create_events, 'products': create_products}
+
+    training_options = {'similarity_workers': args.similarity_workers, 'bounded': args.bounded}
+    results = []
+    for item_type in args.item_types:
+        for size in args.sizes:
+            for backend in args.backends:
+                clear_items(item_type)
+                create_items[item_type](generate_catalogue(item_type, size))
+
+                for scenario in args.scenarios:
+                    if (scenario == 'cold'):
+                        PreprocessedText.objects.filter(item_type=item_type).delete()
+                    n_changed = change_descriptions(item_type, args.changed_share) if scenario == 'incremental' else 0
+                    result = run_training(item_type, backend, 'incremental' if scenario == 'incremental' else 'full', not args.no_trace,
+                                          training_options)
+                    result.update({'item_type': item_type, 'backend': backend, 'size': size, 'scenario': scenario, 'n_changed': n_changed})
+                    results.append(result)
+
+                    stages = ' '.join(['%s %.2fs' % (stage['stage'], stage['seconds']) for stage in result['stages']])
+                    print('%-8s | %-5s | %7d | %-11s | %7.2fs | peak %7.1f MB | rss %7.1f MB | artifacts %6.1f MB | %8d rows | %s'
+                          % (item_type, backend, size, scenario, result['seconds'], result['peak_mb'], result['max_rss_mb'],
+                             result['artifact_mb'] or 0, result['rows_written'], stages))
+
+    if (args.output):
+        with open(args.output, 'w') as output_file:
+            json.dump({
+                'commit': get_commit(),
+                'created_at': datetime.datetime.now().isoformat(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'arguments': vars(args),
+                'results': results,
+            }, output_file, indent=2)
+
+    if (args.compare and not compare(results, args.compare, args.tolerance)):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""
+Latency of the widget endpoint (get-recommendation) under concurrent clients,
+synchronous DRF view against the async one of an ASGI deployment.
+
+Run from the recommender directory (uses a temporary sqlite database):
+    python -m benchmarks.bench_widget_latency --concurrency 8 32 --db-latency 2
+    python -m benchmarks.bench_widget_latency --concurrency 32 --output results.json
+
+Each of the --concurrency clients requests pages (event and article homepages,
+article domains, items) one after the other, --requests times. The sync view
+is served by --workers threads, as gunicorn workers would; the async view by
+an event loop (Django AsyncClient, ASGI handler). The sqlite database answers
+without the network round trip of a MySQL server: --db-latency adds this many
+milliseconds to each query (a sleep, which releases the GIL like a socket
+wait). The recommendation cache is disabled unless --cache, so that every
+request computes its sections.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import platform
+import threading
+import time
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from benchmarks.bench_training import get_commit
+from benchmarks.database import setup_database
+from benchmarks.synthetic import generate_catalogue
+
+SYNC_PATH = '/dimadb/get-recommendation/'
+ASYNC_PATH = '/dimadb/async/get-recommendation/'
+domains = ['Arts visuels', 'Cinéma', 'Littérature', 'Musique', 'Théâtre']
+
+
+# Catalogue with urls, dates, page activity and similarities: every kind of section has data
+def create_catalogue(size):
+    from django.utils import timezone
+    from dimadb.models import Events, EventDate, Products, PageActivity
+    from dimadb.event_dates import refresh_next_dates
+    from dimadb.popularity import rebuild_popularity
+    from dimadb.content_based_recommender import ContentBasedRecommender
+
+    Events.objects.bulk_create([
+        Events(event_id='event-%d' % index, event_name='Événement %d' % index, event_type=domains[index % len(domains)],
+               url='https://dici.ca/evenements/event-%d' % index, description=description)
+        for index, description in enumerate(generate_catalogue('events', size))], batch_size=2000)
+    Products.objects.bulk_create([
+        Products(product_id='product-%d' % index, product_name='Article %d' % index, product_type=domains[index % len(domains)],
+                 url='https://dici.ca/magazine/article/product-%d' % index, description=description)
+        for index, description in enumerate(generate_catalogue('products', size))], batch_size=2000)
+    now = timezone.now()
+    EventDate.objects.bulk_create([EventDate(event_id=str(item_id), date=now + datetime.timedelta(days=item_id % 60))
+                                   for item_id in Events.objects.values_list('id', flat=True)], batch_size=2000)
+    refresh_next_dates()
+
+    today = timezone.localdate()
+    urls = list(Events.objects.values_list('url', flat=True)) + list(Products.objects.values_list('url', flat=True))
+    PageActivity.objects.bulk_create([PageActivity(page_location=url, event_name='page_view', date=today - datetime.timedelta(days=index % 30),
+                                                   event_count=index % 17 + 1) for index, url in enumerate(urls)], batch_size=2000)
+    rebuild_popularity(activity=False)
+    for item_type in ['events', 'products']:
+        ContentBasedRecommender.train_items_by_items(item_type, backend='tfidf')
+
+
+def get_page_urls(size):
+    from slugify import slugify
+    urls = ['https://dici.ca/evenements', 'https://dici.ca/magazine/tous-les-articles']
+    urls += ['https://dici.ca/magazine/' + slugify(domain) for domain in domains]
+    urls += ['https://dici.ca/evenements/event-%d' % index for index in range(0, size, max(size // 5, 1))]
+    urls += ['https://dici.ca/magazine/article/product-%d' % index for index in range(0, size, max(size // 5, 1))]
+    return urls
+
+
+# Add a network round trip to each query of the connections opened from now on
+def add_database_latency(seconds):
+    from django.db.backends.signals import connection_created
+
+    def delay(execute, sql, params, many, context):
+        time.sleep(seconds)
+        return execute(sql, params, many, context)
+
+    def on_connection_created(sender, connection, **kwargs):
+        if (delay not in connection.execute_wrappers):
+            connection.execute_wrappers.append(delay)
+
+    connection_created.connect(on_connection_created, weak=False)
+
+
+# The errors are answered with a 200 status and a message instead of the sections
+def check_response(response):
+    assert response.status_code == 200 and isinstance(json.loads(response.content), list), response.content
+
+
+def summarize(latencies, seconds):
+    latencies = np.array(latencies) * 1000
+    return {
+        'requests': len(latencies),
+        'throughput': len(latencies) / seconds,
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'max_ms': float(latencies.max()),
+    }
+
+
+def run_sync(urls, concurrency, n_requests, workers, headers):
+    from django.test import Client
+    # The requests wait for a worker in their order of arrival, as in the queue of a server
+    server = ThreadPoolExecutor(workers)
+    worker_data = threading.local()
+    latencies = []
+    lock = threading.Lock()
+
+    def handle(url):
+        if (not hasattr(worker_data, 'client')):
+            worker_data.client = Client()
+        return worker_data.client.get(SYNC_PATH, {'url': url}, **headers)
+
+    def client(client_index):
+        client_latencies = []
+        for index in range(n_requests):
+            url = urls[(client_index + index * concurrency) % len(urls)]
+            start = time.perf_counter()
+            response = server.submit(handle, url).result()
+            client_latencies.append(time.perf_counter() - start)
+            check_response(response)
+        with lock:
+            latencies.extend(client_latencies)
+
+    threads = [threading.Thread(target=client, args=(client_index,)) for client_index in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    server.shutdown()
+    return summarize(latencies, seconds)
+
+
+def run_async(urls, concurrency, n_requests, headers):
+    from django.test import AsyncClient
+    latencies = []
+
+    async def client(client_index):
+        http_client = AsyncClient()
+        for index in range(n_requests):
+            url = urls[(client_index + index * concurrency) % len(urls)]
+            start = time.perf_counter()
+            # The AsyncClient of Django 3.2 sends its extra arguments as the headers of the ASGI scope, and ignores the
+            # data of a GET: the query string is part of the path
+            response = await http_client.get(ASYNC_PATH + '?' + urlencode({'url': url}), authorization=headers['HTTP_AUTHORIZATION'])
+            latencies.append(time.perf_counter() - start)
+            check_response(response)
+
+    async def run_clients():
+        await asyncio.gather(*[client(client_index) for client_index in range(concurrency)])
+
+    start = time.perf_counter()
+    asyncio.run(run_clients())
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=1000, help='Events and articles of the catalogue')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32], help='Concurrent clients')
+    parser.add_argument('--requests', type=int, default=20, help='Requests of each client')
+    parser.add_argument('--workers', type=int, default=4, help='Threads serving the sync view')
+    parser.add_argument('--db-latency', type=float, default=2, help='Milliseconds added to each query')
+    parser.add_argument('--conn-max-age', type=int, default=0, help='CONN_MAX_AGE of the database (seconds, 0: a connection per request)')
+    parser.add_argument('--modes', nargs='+', default=['sync', 'async'], choices=['sync', 'async'])
+    parser.add_argument('--cache', action='store_true', help='Keep the recommendation cache of the process')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    setup_database()
+    from django.conf import settings
+    from django.test import Client
+    from dimadb import views
+    from dimadb.recommend_cache import recommend_cache
+    create_catalogue(args.size)
+    if (not args.cache):
+        recommend_cache.max_size = 0
+    add_database_latency(args.db_latency / 1000)
+    settings.DATABASES['default']['CONN_MAX_AGE'] = args.conn_max_age
+    urls = get_page_urls(args.size)
+    headers = {'HTTP_AUTHORIZATION': 'Bearer ' + views.API_KEY}
+    # Load the neighbour indexes and the routing table before timing
+    for url in urls:
+        Client().get(SYNC_PATH, {'url': url}, **headers)
+
+    results = []
+    for concurrency in args.concurrency:
+        for mode in args.modes:
+            if (mode == 'sync'):
+                result = run_sync(urls, concurrency, args.requests, args.workers, headers)
+            else:
+                result = run_async(urls, concurrency, args.requests, headers)
+            result.update({'mode': mode, 'concurrency': concurrency})
+            results.append(result)
+            print('%-5s | %3d clients | %5d requests | %7.1f req/s | mean %7.1f ms | p50 %7.1f ms | p95 %7.1f ms | p99 %7.1f ms | max %7.1f ms'
+                  % (mode, concurrency, result['requests'], result['throughput'], result['mean_ms'], result['p50_ms'],
+                     result['p95_ms'], result['p99_ms'], result['max_ms']))
+
+    if (args.output):
+        with open(args.output, 'w') as output_file:
+            json.dump({
+                'commit': get_commit(),
+                'created_at': datetime.datetime.now().isoformat(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'arguments': vars(args),
+                'results': results,
+            }, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+import os
+
+import django
+from django.conf import settings
+from django.core.management import call_command
+
+
+# Configure Django with the benchmark settings and create an empty database
+def setup_database():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    django.setup()
+    os.makedirs(settings.LDA_MODEL_DIR, exist_ok=True)
+    if (os.path.exists(settings.DATABASES['default']['NAME'])):
+        os.remove(settings.DATABASES['default']['NAME'])
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+
+def create_events(descriptions, batch_size=2000):
+    from dimadb.models import Events
+    Events.objects.bulk_create([
+        Events(event_id='event-%d' % index, event_name='Événement %d' % index, description=description)
+        for index, description in enumerate(descriptions)], batch_size=batch_size)
+
+
+def create_products(descriptions, batch_size=2000):
+    from dimadb.models import Products
+    Products.objects.bulk_create([
+        Products(product_id='product-%d' % index, product_name='Article %d' % index, description=description)
+        for index, description in enumerate(descriptions)], batch_size=batch_size)
+
+
+# Remove the items of a type with their cached tokens and trained similarities
+def clear_items(item_type):
+    from django.apps import apps
+    from dimadb.models import LdaSimilarityVersion, LdaSimilarity, LdaNeighbour, PreprocessedText
+    apps.get_model(app_label='dimadb', model_name=item_type).objects.all().delete()
+    for Model in [LdaSimilarityVersion, LdaSimilarity, LdaNeighbour, PreprocessedText]:
+        Model.objects.filter(item_type=item_type).delete()
@@ -0,0 +1,17 @@
+# Settings of the benchmarks: same as the project, with a local sqlite database and
+# a temporary artifact directory so that the committed models are never overwritten
+import os
+import tempfile
+
+from recommender.settings import *
+
+BENCHMARK_DIR = os.environ.get('BENCHMARK_DIR', os.path.join(tempfile.gettempdir(), 'trivi_benchmarks'))
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BENCHMARK_DIR, 'benchmark.sqlite3'),
+    }
+}
+
+LDA_MODEL_DIR = os.path.join(BENCHMARK_DIR, 'model_recommend')
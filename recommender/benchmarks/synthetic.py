@@ -0,0 +1,53 @@
+import random
+
+# Deterministic generator of French cultural descriptions used by the benchmarks
+
+THEMES = {
+    'musique': ['concert', 'orchestre', 'chanson', 'musicien', 'guitare', 'piano', 'symphonie', 'chorale', 'festival', 'jazz', 'album', 'scène'],
+    'theatre': ['théâtre', 'pièce', 'comédien', 'mise', 'dramaturge', 'spectacle', 'décor', 'répétition', 'troupe', 'comédie', 'tragédie', 'public'],
+    'musee': ['musée', 'collection', 'exposition', 'oeuvre', 'conservateur', 'galerie', 'archive', 'vitrine', 'visite', 'guide', 'histoire', 'objet'],
+    'litterature': ['livre', 'roman', 'auteur', 'poésie', 'lecture', 'bibliothèque', 'écrivain', 'conte', 'récit', 'édition', 'librairie', 'recueil'],
+    'arts_visuels': ['peinture', 'sculpture', 'artiste', 'toile', 'dessin', 'atelier', 'couleur', 'photographie', 'installation', 'vernissage', 'estampe', 'gravure'],
+    'patrimoine': ['patrimoine', 'église', 'maison', 'village', 'architecture', 'tradition', 'site', 'fortification', 'moulin', 'rivière', 'mémoire', 'ancêtre'],
+    'cinema': ['film', 'cinéma', 'réalisateur', 'projection', 'documentaire', 'court', 'métrage', 'acteur', 'écran', 'tournage', 'animation', 'festival'],
+    'metiers_art': ['artisan', 'céramique', 'tissage', 'bijou', 'verre', 'bois', 'cuir', 'ébéniste', 'potier', 'métier', 'savoir', 'création'],
+}
+
+COMMON_WORDS = ['les', 'des', 'une', 'avec', 'pour', 'dans', 'sur', 'est', 'sont', 'nous', 'vous', 'cette', 'ville', 'région',
+                'mauricie', 'trois', 'rivières', 'soirée', 'journée', 'famille', 'gratuit', 'billet', 'inscription', 'automne', 'été']
+
+
+# Generate n_docs descriptions, each one mostly drawn from one or two themes
+def generate_descriptions(n_docs, min_words=30, max_words=120, seed=100):
+    rng = random.Random(seed)
+    theme_names = sorted(THEMES.keys())
+    descriptions = []
+
+    for _ in range(n_docs):
+        themes = rng.sample(theme_names, rng.choice([1, 2]))
+        n_words = rng.randint(min_words, max_words)
+        words = []
+        for _ in range(n_words):
+            if (rng.random() < 0.35):
+                words.append(rng.choice(COMMON_WORDS))
+            else:
+                words.append(rng.choice(THEMES[rng.choice(themes)]))
+        descriptions.append(' '.join(words))
+
+    return descriptions
+
+
+# Descriptions of a synthetic catalogue: articles (products) are longer than events and use another seed
+catalogue_options = {
+    'events': {'min_words': 30, 'max_words': 120, 'seed': 100},
+    'products': {'min_words': 80, 'max_words': 300, 'seed': 200},
+}
+
+
+def generate_catalogue(item_type, n_docs):
+    return generate_descriptions(n_docs, **catalogue_options[item_type])
+
+
+# Simple tokenizer for benchmarks which do not need the full preprocessing pipeline
+def tokenize(description):
+    return description.lower().split()
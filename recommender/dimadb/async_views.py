@@ -0,0 +1,114 @@
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.http import HttpResponseNotAllowed, JsonResponse
+from rest_framework.utils.encoders import JSONEncoder
+from .views import API_KEY, get_page_recommend_info, get_recommend_items, get_batch_recommendation_data
+from .recommend_cache import get_data_validators, get_not_modified_response, set_http_cache_headers
+import json
+
+# Async versions of the widget endpoints, for an ASGI server (recommender/asgi.py): the event loop is not blocked
+# while a request waits for the database. DRF views are synchronous, so these are plain Django views answering the
+# same JSON. They are not faster than the sync views (benchmarks/bench_widget_latency.py): the widget uses the sync
+# ones.
+
+
+# Run a function using the ORM in a thread of the pool. All the queries of a request are made by one call: they
+# share the connection of the thread, closed once the function returned (kept within CONN_MAX_AGE). Computing
+# the sections of a page in several threads took a connection per section.
+def run_database_function(function, *args):
+    try:
+        return function(*args)
+    finally:
+        close_old_connections()
+
+
+async def run_sync(function, *args):
+    return await sync_to_async(run_database_function, thread_sensitive=False)(function, *args)
+
+
+def json_response(data, status=200):
+    return JsonResponse(data, status=status, encoder=JSONEncoder, safe=False)
+
+
+def is_authorized(request):
+    return request.headers.get('Authorization') == 'Bearer ' + API_KEY
+
+
+# The sections of a page, one after the other as in the sync view
+def get_page_recommendation(request):
+    # The browser or the CDN already has the recommendations of this data version
+    etag, last_modified = get_data_validators()
+    not_modified = get_not_modified_response(request, etag, last_modified)
+    if (not_modified is not None):
+        return not_modified
+    # Read request info
+    url = request.GET.get('url', None)
+    item_type, recommend_level, item_domain, item_url, recommend_types = get_page_recommend_info(url)
+    recommendation = [{'itemType': item_type, 'recommendType': recommend_type,
+                       'items': get_recommend_items(recommend_level, item_type, recommend_type, 4, item_domain, item_url)}
+                      for recommend_type in recommend_types]
+    return set_http_cache_headers(json_response(recommendation), etag, last_modified)
+
+
+async def get_recommendation_async(request):
+    if (request.method != 'GET'):
+        return HttpResponseNotAllowed(['GET'])
+    try:
+        # Authorization
+        if (is_authorized(request)):
+            return await run_sync(get_page_recommendation, request)
+        else:
+            return json_response({'message': 'Authorization failed'}, status=401)
+    except Exception as error:
+        return json_response({'message': str(error)})
+
+
+def get_section_recommendation(request):
+    # The browser or the CDN already has the recommendations of this data version
+    etag, last_modified = get_data_validators()
+    not_modified = get_not_modified_response(request, etag, last_modified)
+    if (not_modified is not None):
+        return not_modified
+    # Read request info
+    level = request.GET.get('level', None)
+    item_type = request.GET.get('itemType', None)
+    recommend_type = request.GET.get('recommendType', None)
+    quantity = request.GET.get('quantity', None)
+    domain = request.GET.get('domain', None)
+    item_url = request.GET.get('itemUrl', None)
+    list_recommend_items = get_recommend_items(level, item_type, recommend_type, quantity, domain, item_url)
+    response = json_response({'itemType': item_type, 'recommendType': recommend_type, 'items': list_recommend_items})
+    return set_http_cache_headers(response, etag, last_modified)
+
+
+async def get_list_recommend_async(request):
+    if (request.method != 'GET'):
+        return HttpResponseNotAllowed(['GET'])
+    try:
+        # Authorization
+        if (is_authorized(request)):
+            return await run_sync(get_section_recommendation, request)
+        else:
+            return json_response({'message': 'Authorization failed'}, status=401)
+    except Exception as error:
+        return json_response({'message': str(error)})
+
+
+# The pages of a batch share their queries: they are computed together, in one thread
+async def get_batch_recommendation_async(request):
+    if (request.method != 'POST'):
+        return HttpResponseNotAllowed(['POST'])
+    try:
+        # Authorization
+        if (is_authorized(request)):
+            # Read request info
+            body = json.loads(request.body)
+            return json_response(await run_sync(get_batch_recommendation_data, body['requests']))
+        else:
+            return json_response({'message': 'Authorization failed'}, status=401)
+    except Exception as error:
+        return json_response({'message': str(error)})
+
+
+# Authorized by the API key like the DRF views (csrf_exempt does not wrap async views in Django 3.2)
+get_batch_recommendation_async.csrf_exempt = True
@@ -1,40 +1,180 @@
 from django.db.models.aggregates import Sum
 from django.forms.models import model_to_dict
-from .models import LdaSimilarity
-from .lda_model_builder import LdaModelManager
+from .models import LdaSimilarity, LdaNeighbour
+from .lda_model_builder import LdaModelManager, get_artifact_path, get_active_version
+from .tfidf_model_builder import TfidfModelManager
+from .similarity_engine import NeighbourIndex
 from django.db.models import Q
 from django.apps import apps
+from django.conf import settings
+import os
+
+# Neighbour indexes loaded by this process: {table_name: ((path, modified time) of the index file, NeighbourIndex)}
+neighbour_indexes = {}
+
+
+# Load the neighbour index of an item type once per process (and again only after a new version is published)
+def get_neighbour_index(table_name):
+    matrix_path = get_artifact_path(table_name, 'index')
+    ids_path = get_artifact_path(table_name, 'index_ids')
+    if (not os.path.exists(matrix_path) or not os.path.exists(ids_path)):
+        return None
+
+    key = (matrix_path, os.path.getmtime(matrix_path))
+    cached = neighbour_indexes.get(table_name)
+    if (cached is None or cached[0] != key):
+        cached = (key, NeighbourIndex.load(matrix_path, ids_path))
+        neighbour_indexes[table_name] = cached
+    return cached[1]
+
+
+# A similarity backend trains the similarities of an item type and records them as a LdaSimilarityVersion
+# (neighbour index and/or LdaSimilarity/LdaNeighbour rows), which get_batch_similar_records then reads
+class SimilarityBackend(object):
+    name = None
+    recommend_threshold = 0.8 # Minimum similarity of a recommended item
+
+    def __init__(self, progress_callback=None):
+        self.progress_callback = progress_callback
+
+    def train(self, table_name, mode='full', training_options=None, sweep_options=None):
+        raise NotImplementedError
+
+
+# LDA topics of the descriptions
+class LdaBackend(SimilarityBackend):
+    name = 'lda'
+
+    def train(self, table_name, mode='full', training_options=None, sweep_options=None):
+        manager = LdaModelManager(progress_callback=self.progress_callback)
+        # Options of the item type (settings), overridden by the ones of the request
+        options = dict(settings.LDA_TRAINING_OPTIONS.get(table_name, {}))
+        options.update(training_options or {})
+        if (options.pop('bounded', False)):
+            manager.set_memory_bounds(**settings.LDA_MEMORY_BOUNDS.get(table_name, {}))
+        if ('similarity_workers' in options):
+            manager.set_similarity_workers(options.pop('similarity_workers'))
+        if ('training_mode' in options):
+            manager.set_training_mode(**options)
+        if (table_name in settings.LDA_SIMILARITY_STORAGE):
+            manager.set_similarity_storage(**settings.LDA_SIMILARITY_STORAGE[table_name])
+        # 'incremental' infers the new/changed items with the current model, 'online' also updates the model with them
+        if (mode == 'incremental' or mode == 'online'):
+            manager.update_model(table_name=table_name, online_update=(mode == 'online'))
+        # 'sweep' trains several numbers of topics in parallel and keeps the most coherent model
+        elif (mode == 'sweep'):
+            options = dict(settings.LDA_TOPIC_SWEEP)
+            options.update(sweep_options or {})
+            manager.sweep_num_topics(table_name=table_name, candidates=options['candidates'],
+                                     coherence=options['coherence'], processes=options['processes'])
+        else:
+            manager.train_model(table_name=table_name)
+
+
+# Cosine of the sparse TF-IDF vectors of the descriptions, top k neighbours only
+class TfidfBackend(SimilarityBackend):
+    name = 'tfidf'
+    recommend_threshold = 0.3
+
+    def train(self, table_name, mode='full', training_options=None, sweep_options=None):
+        manager = TfidfModelManager(progress_callback=self.progress_callback)
+        if (table_name in settings.LDA_SIMILARITY_STORAGE):
+            manager.set_similarity_storage(**settings.LDA_SIMILARITY_STORAGE[table_name])
+        # Training is cheap: every mode trains from scratch
+        manager.train_model(table_name=table_name)
+
+
+similarity_backends = {backend.name: backend for backend in [LdaBackend, TfidfBackend]}
+
+
+def get_similarity_backend(name, progress_callback=None):
+    if (name not in similarity_backends):
+        raise ValueError('Unknown similarity backend: ' + str(name))
+    return similarity_backends[name](progress_callback=progress_callback)
+
 
 class ContentBasedRecommender():
     def __init__(self, min_sim=0.1):
         self.min_sim = min_sim
-        
+
+    # Similar records of several items, read together: {item id: records}
+    @staticmethod
+    def get_batch_similar_records(table_name, items_ids, threshold, limit=None, version=None):
+        records = {item_id: [] for item_id in items_ids}
+        # Answer from the in-memory neighbour index when training has written one
+        index = get_neighbour_index(table_name)
+        if (index is not None):
+            for item_id in records:
+                records[item_id] = [{'id': target, 'similarity_score': score} for (target, score) in index.query(item_id, limit, threshold)]
+            return records
+
+        # Only the rows of the active version, the ones of a training in progress are not complete
+        version = version or get_active_version(table_name)
+        if (version is not None and version.similarity_storage == 'top_k'):
+            neighbours = LdaNeighbour.objects.filter(version=version.id, source__in=list(records), similarity__gte=threshold).order_by('source', 'rank')
+            for (source, target, similarity) in neighbours.values_list('source', 'target', 'similarity'):
+                if (limit is None or len(records[source]) < limit):
+                    records[source].append({'id': target, 'similarity_score': similarity})
+            return records
+
+        sources = [str(item_id) for item_id in records]
+        source_records = LdaSimilarity.objects.filter(source__in=sources, item_type=table_name, similarity__gte=threshold)
+        target_records = LdaSimilarity.objects.filter(target__in=sources, item_type=table_name, similarity__gte=threshold)
+        if (version is not None):
+            source_records = source_records.filter(version=str(version.id))
+            target_records = target_records.filter(version=str(version.id))
+
+        # The ids of the pairs are stored as strings
+        for item in list(source_records):
+            records[int(item.source)].append({'id': int(item.target), 'similarity_score': item.similarity})
+        for item in list(target_records):
+            records[int(item.target)].append({'id': int(item.source), 'similarity_score': item.similarity})
+        return records
+
+    # Ids and similarity scores of the items similar to each of several items, most similar first, one list per item
+    # (no item row is loaded). The similarities of all the items are read together.
+    @staticmethod
+    def rank_batch_items_by_items(table_name, items_ids, limit=None):
+        # The similarities of each backend have their own scale
+        version = get_active_version(table_name)
+        threshold = similarity_backends.get(version.backend if version else 'lda', LdaBackend).recommend_threshold
+        batch_records = ContentBasedRecommender.get_batch_similar_records(table_name, [int(item_id) for item_id in items_ids], threshold, limit, version)
+        list_records = []
+        for item_id in items_ids:
+            records = sorted(batch_records[int(item_id)], key=lambda record: record['similarity_score'], reverse=True)
+            if (limit is not None):
+                records = records[:limit]
+            list_records.append(records)
+        return list_records
+
+    # Load the items of ranked records with one query, in the order of the records, and merge the keys of the records
+    # (similarity_score, ...) into them. fields restricts the loaded columns; the records of removed items are dropped.
+    # The ids of the records may be strings (LdaSimilarity rows): the items keep their integer id.
     @staticmethod
-    def recommend_items_by_items(table_name, items_id):
-        threshold = 0.8
-        source_records = LdaSimilarity.objects.filter(source=items_id, item_type=table_name, similarity__gte=threshold)
-        target_records = LdaSimilarity.objects.filter(target=items_id, item_type=table_name, similarity__gte=threshold)
-        
-        records = []
-        records = records + [{'id': item.target, 'similarity_score': item.similarity} for item in list(source_records)]
-        records = records + [{'id': item.source, 'similarity_score': item.similarity} for item in list(target_records)]
-        
-        new_records = []
+    def hydrate_items(table_name, records, fields=None):
+        if (len(records) == 0):
+            return []
+        Model = apps.get_model(app_label='dimadb', model_name=table_name)
+        list_objs = Model.objects.filter(id__in=[int(record['id']) for record in records])
+        if (fields is None):
+            list_objs = {obj.id: model_to_dict(obj) for obj in list_objs}
+        else:
+            list_objs = {obj['id']: obj for obj in list_objs.values('id', *fields)}
+
+        items = []
         for record in records:
-            Model = apps.get_model(app_label='dimadb', model_name=table_name)
-            list_objs = Model.objects.filter(id=record['id'])
-            list_objs = [model_to_dict(obj) for obj in list(list_objs)]
-            if (len(list_objs)):
-                obj = list_objs[0]
-                obj['similarity_score'] = record['similarity_score']
-                new_records.append(obj)
-                
-        new_records = sorted(new_records, key = lambda i: i['similarity_score'],reverse=True)
-        return new_records
-    
+            item_id = int(record['id'])
+            if (item_id in list_objs):
+                item = dict(list_objs[item_id])
+                item.update(record)
+                item['id'] = item_id
+                items.append(item)
+        return items
+
     @staticmethod
-    def train_items_by_items(table_name):
-        manager = LdaModelManager()
-        manager.train_model(table_name=table_name)
-        
-        return
\ No newline at end of file
+    def train_items_by_items(table_name, mode='full', progress_callback=None, training_options=None, sweep_options=None, backend=None):
+        # Backend of the item type (settings), unless the request chooses one
+        backend = get_similarity_backend(backend or settings.SIMILARITY_BACKENDS.get(table_name, 'lda'), progress_callback)
+        backend.train(table_name, mode=mode, training_options=training_options, sweep_options=sweep_options)
+
+        return
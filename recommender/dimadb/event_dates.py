@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.db.models import CharField, OuterRef, QuerySet, Subquery
+from django.db.models.functions import Cast
+from django.utils import timezone
+from .models import Events, EventDate
+from .popularity import iter_chunks
+import threading
+import time
+
+
+# Store in Events.next_date the next date to come of some events (all of them when event_ids is None);
+# event_ids can be a list or a queryset of ids. The ids are read first: MySQL rejects an UPDATE whose
+# WHERE reads the updated table (error 1093).
+def refresh_next_dates(event_ids=None):
+    # EventDate.event_id holds the id of the event as a string
+    next_dates = EventDate.objects.filter(event_id=Cast(OuterRef('id'), output_field=CharField()), date__gte=timezone.now())
+    next_date = Subquery(next_dates.order_by('date').values('date')[:1])
+    if (event_ids is None):
+        return Events.objects.update(next_date=next_date)
+
+    if (isinstance(event_ids, QuerySet)):
+        event_ids = event_ids.values_list('id', flat=True)
+    n_events = 0
+    for chunk in iter_chunks(event_ids):
+        n_events += Events.objects.filter(id__in=chunk).update(next_date=next_date)
+    return n_events
+
+
+# Roll forward the events whose next date has passed to their following date (or to none)
+def roll_next_dates():
+    return refresh_next_dates(Events.objects.filter(next_date__lt=timezone.now()).values('id'))
+
+
+last_rolled_at = None
+roll_lock = threading.Lock()
+
+
+# Roll the passed next dates before serving, at most every NEXT_DATES_ROLL_SECONDS per process, so that an event
+# whose date passed during the day is shown again with its following date. Returns the number of rolled events.
+def roll_stale_next_dates():
+    global last_rolled_at
+    if (last_rolled_at is not None and time.monotonic() - last_rolled_at < settings.NEXT_DATES_ROLL_SECONDS):
+        return 0
+    with roll_lock:
+        if (last_rolled_at is not None and time.monotonic() - last_rolled_at < settings.NEXT_DATES_ROLL_SECONDS):
+            return 0
+        last_rolled_at = time.monotonic()
+    return roll_next_dates()
@@ -2,163 +2,797 @@ import os
 
 # os.environ.setdefault("DJANGO_SETTINGS_MODULE", "recommender.settings")
 
-import django
 import datetime
-from gensim.matutils import cossim
-from gensim import corpora, models, similarities
-from gensim.models import CoherenceModel, ldamodel
+from gensim import corpora, models
 from gensim.parsing.porter import PorterStemmer
 from nltk.tokenize import RegexpTokenizer
 from django.apps import apps
-import nltk 
 from stop_words import get_stop_words
 import re
 
 # django.setup()
-from dimadb.models import Events, Products, LdaSimilarityVersion, LdaSimilarity
+from dimadb.models import LdaSimilarityVersion, LdaSimilarity, LdaNeighbour, LdaTrainingStage, PreprocessedText, LdaTopicSweepResult
+from dimadb.similarity_engine import doc_topic_matrix, normalize_rows, iter_similar_pairs, iter_similar_pairs_between, iter_top_k, iter_top_k_rows, \
+    iter_sharded_similarities, save_neighbour_index
+from dimadb.topic_sweep import run_topic_sweep, select_best_candidate
+from dimadb.recommend_cache import bump_data_version
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+import numpy as np
+import contextlib
+import hashlib
+import resource
+import shutil
+import tempfile
+import time
+
+
+# Directory of the trained artifacts (model, dictionary, corpus, neighbour index)
+model_dir = settings.LDA_MODEL_DIR
+
+artifact_names = {
+    'model': 'model_{}.lda',
+    'dictionary': 'dict_{}.lda',
+    'corpus': 'corpus_{}.mm',
+    'index': 'index_{}.npy',
+    'index_ids': 'index_{}.ids.npy',
+    'tfidf': 'tfidf_{}.model',
+}
+
+
+# Each training writes its artifacts to a new directory, model_dir/<item type>/<version>/. The CURRENT file of
+# the item type names the published directory and is replaced atomically once the training is complete,
+# so that the serving processes never read the files of a training in progress.
+CURRENT_POINTER = 'CURRENT'
+
+
+# Get the published artifact directory of an item type (None before the first versioned training)
+def get_current_artifact_dir(table_name):
+    try:
+        with open(os.path.join(model_dir, table_name, CURRENT_POINTER)) as pointer:
+            name = pointer.read().strip()
+    except FileNotFoundError:
+        return None
+    if not name:
+        return None
+    return os.path.join(model_dir, table_name, name)
+
+
+# Get the path of an artifact (model, dictionary, corpus, index, index_ids, tfidf) of an item type:
+# in the given directory, else in the published one, else the flat file of the previous layout
+def get_artifact_path(table_name, artifact, artifact_dir=None):
+    if artifact_dir is None:
+        artifact_dir = get_current_artifact_dir(table_name) or model_dir
+    return os.path.join(artifact_dir, artifact_names[artifact].format(table_name))
+
+
+# Total size of the files of an artifact directory (the files linked from the previous version included)
+def get_artifact_dir_size(artifact_dir):
+    return sum([os.path.getsize(os.path.join(artifact_dir, name)) for name in os.listdir(artifact_dir)
+                if os.path.isfile(os.path.join(artifact_dir, name))])
+
+
+# Create the (unpublished) directory of a new version, named so that the versions sort by creation time
+def create_artifact_dir(table_name):
+    parent = os.path.join(model_dir, table_name)
+    os.makedirs(parent, exist_ok=True)
+    return tempfile.mkdtemp(prefix=datetime.datetime.now().strftime('%Y%m%d%H%M%S%f') + '_', dir=parent)
+
+
+# Reuse the unchanged artifacts of the published version (hard links, gensim companion files included)
+def link_artifacts(table_name, artifacts, artifact_dir):
+    for artifact in artifacts:
+        source_dir, name = os.path.split(get_artifact_path(table_name, artifact))
+        for file_name in os.listdir(source_dir):
+            if file_name == name or file_name.startswith(name + '.'):
+                source = os.path.join(source_dir, file_name)
+                target = os.path.join(artifact_dir, file_name)
+                try:
+                    os.link(source, target)
+                except OSError:
+                    shutil.copy2(source, target)
+
+
+# Point CURRENT to a complete artifact directory: the pointer is written aside, then renamed over the old one
+def publish_artifact_dir(table_name, artifact_dir):
+    pointer_path = os.path.join(model_dir, table_name, CURRENT_POINTER)
+    temp_path = pointer_path + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_path, 'w') as pointer:
+        pointer.write(os.path.basename(artifact_dir))
+        pointer.flush()
+        os.fsync(pointer.fileno())
+    os.replace(temp_path, pointer_path)
+    remove_old_artifact_dirs(table_name)
+
+
+# Remove the versions older than the published one, except the most recent ones (kept for the processes still
+# reading them). The directories newer than the published one belong to trainings in progress.
+def remove_old_artifact_dirs(table_name, n_kept=None):
+    if n_kept is None:
+        n_kept = settings.LDA_ARTIFACT_VERSIONS_KEPT
+    current_dir = get_current_artifact_dir(table_name)
+    if current_dir is None:
+        return
+    parent, current_name = os.path.split(current_dir)
+    older_names = sorted([name for name in os.listdir(parent) if name < current_name and os.path.isdir(os.path.join(parent, name))])
+    for name in older_names[:max(len(older_names) - max(n_kept - 1, 0), 0)]:
+        shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+
+
+# The version whose similarities are read by the recommendations (None before the first staged training)
+def get_active_version(table_name):
+    return LdaSimilarityVersion.objects.filter(item_type=table_name, status='active').order_by('-created_at').first()
+
+
+# Copy the similarity rows of a version to another one with a single INSERT ... SELECT, returns the number of rows
+def copy_similarity_rows(table_name, from_version, to_version):
+    table = connection.ops.quote_name(LdaSimilarity._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute('INSERT INTO ' + table + ' (source, target, item_type, similarity, version) '
+                       'SELECT source, target, item_type, similarity, %s FROM ' + table + ' WHERE item_type = %s AND version = %s',
+                       [str(to_version.id), table_name, str(from_version.id)])
+        return cursor.rowcount
+
+
+# Same as copy_similarity_rows for the neighbour lists of a version stored as top k
+def copy_neighbour_rows(table_name, from_version, to_version):
+    table = connection.ops.quote_name(LdaNeighbour._meta.db_table)
+    rank = connection.ops.quote_name('rank')
+    with connection.cursor() as cursor:
+        cursor.execute('INSERT INTO ' + table + ' (version, item_type, source, target, ' + rank + ', similarity) '
+                       'SELECT %s, item_type, source, target, ' + rank + ', similarity FROM ' + table + ' WHERE item_type = %s AND version = %s',
+                       [to_version.id, table_name, from_version.id])
+        return cursor.rowcount
+
+
+# Remove, in batches, the similarity rows belonging neither to the active version nor to a version being written
+def remove_retired_similarities(table_name, batch_size=5000):
+    kept_versions = list(LdaSimilarityVersion.objects.filter(item_type=table_name, status__in=['staging', 'active']).values_list('id', flat=True))
+    for Model, kept in [(LdaSimilarity, [str(version_id) for version_id in kept_versions]), (LdaNeighbour, kept_versions)]:
+        while True:
+            row_ids = list(Model.objects.filter(item_type=table_name).exclude(version__in=kept).values_list('id', flat=True)[:batch_size])
+            if len(row_ids) == 0:
+                break
+            Model.objects.filter(id__in=row_ids).delete()
+
+
+# Peak resident size of this process, or of its largest worker process (multicore LDA, topic sweep), in MB,
+# since the process started: ru_maxrss never goes down, so this is not the peak of a single stage
+def get_cumulative_peak_rss_mb():
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+# Wall time, counts and cumulative peak RSS of each stage of a training (a stage starts when its progress is first reported)
+class TrainingTelemetry(object):
+
+    def __init__(self):
+        self.stages = []
+        self.current = None
+
+    def start(self, stage):
+        if self.current is not None and self.current['stage'] == stage:
+            return
+        self.close()
+        self.current = {'stage': stage, 'started_at': time.perf_counter()}
+
+    # Set counts of the current stage: n_rows, vocabulary_size, pairs_evaluated, rows_written
+    def record(self, **metrics):
+        if self.current is not None:
+            self.current.update(metrics)
+
+    def close(self):
+        if self.current is None:
+            return
+        stage = self.current
+        stage['seconds'] = time.perf_counter() - stage.pop('started_at')
+        stage['cumulative_peak_rss_mb'] = get_cumulative_peak_rss_mb()
+        self.stages.append(stage)
+        self.current = None
+
+    def save(self, version):
+        self.close()
+        LdaTrainingStage.objects.bulk_create([LdaTrainingStage(version=version, position=position, **stage)
+                                              for position, stage in enumerate(self.stages)])
+        self.stages = []
+
+
+# Similarity rows (LdaSimilarity or LdaNeighbour) inserted in chunks with bulk_create, as the pairs are computed
+class SimilarityWriter(object):
+
+    def __init__(self, batch_size=5000):
+        self.batch_size = batch_size
+        self.records = []
+        self.n_written = 0
+
+    def add(self, record):
+        self.records.append(record)
+        if len(self.records) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.records) > 0:
+            type(self.records[0]).objects.bulk_create(self.records)
+            self.n_written += len(self.records)
+            self.records = []
 
 
-def load_data(table_name):
-    Model = apps.get_model(app_label='dimadb', model_name=table_name)
-    docs = list(Model.objects.all().order_by('-created_at'))
-    data = [str(item.description) for item in docs]
+# Compiled once per process and shared by every preprocessed document
+url_email_pattern = re.compile("((\S+)?(http(s)?)(\S+))|((\S+)?(www)(\S+))|((\S+)?(\@)(\S+)?)")
+non_letter_pattern = re.compile("[^a-zA-Z ]")
+fr_stop_words = None
+
+# Change it whenever preprocessing() changes, so that the cached tokens are computed again
+PREPROCESSING_VERSION = '1'
+
+
+def get_french_stop_words():
+    global fr_stop_words
+    if fr_stop_words is None:
+        fr_stop_words = frozenset(get_stop_words('french'))
+    return fr_stop_words
 
-    if len(data) == 0:
-        print('There is no data of cultural product')
 
-    return docs, data
+def get_text_hash(text):
+    return hashlib.sha1((PREPROCESSING_VERSION + ':' + text).encode('utf-8')).hexdigest()
+
+
+# Iterate over the (id, description) of an item type in chunks fetched with keyset pagination,
+# so that only one chunk of rows is held in memory (the MySQL client buffers whole result sets)
+class DescriptionStream(object):
+
+    def __init__(self, table_name, chunk_size=2000):
+        self.table_name = table_name
+        self.chunk_size = chunk_size
+
+    def iter_chunks(self):
+        Model = apps.get_model(app_label='dimadb', model_name=self.table_name)
+        last_id = None
+        while True:
+            rows = Model.objects.order_by('-id').values_list('id', 'description')
+            if last_id is not None:
+                rows = rows.filter(id__lt=last_id)
+            rows = list(rows[:self.chunk_size])
+            if len(rows) == 0:
+                return
+            yield [row[0] for row in rows], [str(row[1]) for row in rows]
+            last_id = rows[-1][0]
+
+
+# Tokens of each description, preprocessed chunk by chunk through the preprocessing cache.
+# After a complete iteration, ids holds the item ids in the same order as the tokens.
+class TokenStream(object):
+
+    def __init__(self, manager, descriptions):
+        self.manager = manager
+        self.descriptions = descriptions
+        self.ids = []
+
+    def __iter__(self):
+        ids = []
+        for chunk_ids, chunk_data in self.descriptions.iter_chunks():
+            ids += chunk_ids
+            for tokens in self.manager.preprocess_documents(self.descriptions.table_name, chunk_ids, chunk_data):
+                yield tokens
+        self.ids = ids
+
+
+# Bag-of-words of each document, computed on demand
+class BowStream(object):
+
+    def __init__(self, dictionary, texts):
+        self.dictionary = dictionary
+        self.texts = texts
+
+    def __iter__(self):
+        for tokens in self.texts:
+            yield self.dictionary.doc2bow(tokens)
+
 
 class LdaModelManager(object):
 
-    def __init__(self, min_sim=0.1):
+    def __init__(self, min_sim=0.1, progress_callback=None):
         self.dirname, self.filename = os.path.split(os.path.abspath(__file__))
         self.lda_path = self.dirname
 
         self.min_sim = min_sim
         self.NUM_OF_TOPICS = 11 # The default value of num of topics (best)
+        self.TRAINING_MODE = 'single' # 'single' (LdaModel) or 'multicore' (LdaMulticore)
+        self.WORKERS = None # Worker processes of the multicore mode (None: number of cores - 1)
+        self.CHUNKSIZE = 2000 # Documents per training chunk
+        self.PASSES = 1 # Passes through the corpus
+        self.SIMILARITY_THRESHOLD = 0.5 # Pairs below this similarity are not stored
+        self.SIMILARITY_BLOCK_SIZE = 1024 # Rows per block when computing the similarity matrix
+        self.SIMILARITY_WRITE_BATCH_SIZE = 5000 # Similarity rows per INSERT
+        self.SIMILARITY_DELETE_BATCH_SIZE = 5000 # Similarity rows of retired versions per DELETE
+        self.SIMILARITY_STORAGE = 'pairs' # 'pairs' (every pair above the threshold) or 'top_k' (the TOP_K most similar items of each item)
+        self.TOP_K = 20
+        self.NO_BELOW = None # Bounded training: minimum number of documents of a token kept in the dictionary
+        self.NO_ABOVE = None # Bounded training: maximum share of the documents of a token kept in the dictionary
+        self.KEEP_N = None # Bounded training: maximum size of the dictionary
+        self.DTYPE = np.float64 # Of the LDA state and of the doc-topic index
+        self.pruned_share = None # Share of the tokens removed from the dictionary of the latest training
+        self.data_cutoff = None # Time the latest training started reading the items (see LdaSimilarityVersion.data_cutoff)
+        self.SIMILARITY_WORKERS = 1 # Processes computing the similarities (above 1: shards of rows in a process pool)
+        self.doc_topics = None # Normalized doc-topic matrix of the latest trained documents
+        self.VOCABULARY_DRIFT_THRESHOLD = settings.LDA_VOCABULARY_DRIFT_THRESHOLD # Above it, incremental training retrains from scratch
+        self.progress_callback = progress_callback # Called with (stage, progress) while training
+        self.artifact_dir = None # Unpublished directory the running training writes its artifacts to
+        self.pending_version = None # Version activated once the artifact directory is published
+        self.telemetry = TrainingTelemetry() # Stages of the running training, saved with its version
+
+    def report_progress(self, stage, progress=0):
+        self.telemetry.start(stage)
+        if self.progress_callback is not None:
+            self.progress_callback(stage, progress)
+
+    # Write the artifacts of a training to a new version directory, published only if the training completes
+    @contextlib.contextmanager
+    def new_artifact_version(self, table_name, linked_artifacts=()):
+        artifact_dir = self.artifact_dir = create_artifact_dir(table_name)
+        self.pending_version = None
+        try:
+            link_artifacts(table_name, linked_artifacts, artifact_dir)
+            yield artifact_dir
+        except BaseException:
+            shutil.rmtree(artifact_dir, ignore_errors=True)
+            raise
+        else:
+            publish_artifact_dir(table_name, artifact_dir)
+        finally:
+            self.artifact_dir = None
+        # The version written by the training is only read by the recommendations once its artifacts are published
+        if self.pending_version is not None:
+            version, self.pending_version = self.pending_version, None
+            self.complete_activation(version, table_name, get_artifact_dir_size(artifact_dir))
+
+    def set_similarity_storage(self, storage, k=20):
+        if storage not in ['pairs', 'top_k']:
+            raise ValueError('Unknown similarity storage: ' + str(storage))
+        self.SIMILARITY_STORAGE = storage
+        self.TOP_K = k
 
     def set_num_topics(self, num_of_topics):
         self.NUM_OF_TOPICS = num_of_topics
 
-    def get_latest_lda_model(self, table_name, retrain=False, populate_sims=False):
-        if LdaSimilarityVersion.objects.filter(item_type=table_name).exists():
-            latest_lda = LdaSimilarityVersion.objects.filter(item_type=table_name).latest('created_at')
-        else:
-            latest_lda = None
-            
-        if latest_lda != None and not retrain:
-            self.model = models.ldamodel.LdaModel.load(os.path.join(self.lda_path, 'model_recommend', 'model_' + table_name + '.lda'))
-            self.corpus = corpora.MmCorpus(os.path.join(self.lda_path, 'model_recommend', 'corpus_' + table_name + '.mm'))
-
-            if populate_sims:
-                docs, data = load_data(table_name)
-                self.save_similarity(docs, table_name)
-        else:
-            self.train_model(table_name=table_name) 
-
-    def train_model(self, data=None, docs=None, table_name=None):
-        if data is None:
-            docs, data = load_data(table_name=table_name)
+    def set_training_mode(self, training_mode, workers=None, chunksize=2000, passes=1):
+        if training_mode not in ['single', 'multicore']:
+            raise ValueError('Unknown training mode: ' + str(training_mode))
+        self.TRAINING_MODE = training_mode
+        self.WORKERS = workers
+        self.CHUNKSIZE = chunksize
+        self.PASSES = passes
+
+    # Bounded training: prune the rare and the boilerplate tokens of the dictionary and store float32 arrays
+    def set_memory_bounds(self, no_below=None, no_above=None, keep_n=None, float32=False):
+        self.NO_BELOW = no_below
+        self.NO_ABOVE = no_above
+        self.KEEP_N = keep_n
+        self.DTYPE = np.float32 if float32 else np.float64
+
+    # Compute the similarities in a pool of `workers` processes (None: one per core), each one a shard of the rows
+    def set_similarity_workers(self, workers):
+        if workers is not None and workers < 1:
+            raise ValueError('Invalid number of similarity workers: ' + str(workers))
+        self.SIMILARITY_WORKERS = workers
+
+    # Train the LDA model with the single-core or the multicore implementation of gensim
+    def create_lda_model(self, corpus, dictionary, n_topics):
+        if self.TRAINING_MODE == 'multicore':
+            return models.ldamulticore.LdaMulticore(corpus=corpus, id2word=dictionary, num_topics=n_topics, random_state=100,
+                                                    workers=self.WORKERS, chunksize=self.CHUNKSIZE, passes=self.PASSES, dtype=self.DTYPE)
+        return models.ldamodel.LdaModel(corpus=corpus, id2word=dictionary, num_topics=n_topics, random_state=100,
+                                        chunksize=self.CHUNKSIZE, passes=self.PASSES, dtype=self.DTYPE)
+
+    def train_model(self, table_name, descriptions=None):
+        if descriptions is None:
+            descriptions = DescriptionStream(table_name)
     
-        self.build_model(data, docs, self.NUM_OF_TOPICS, table_name)
-
-    def build_model(self, data, docs, n_topics, table_name):
-        texts = list()
+        self.data_cutoff = timezone.now()
+        with self.new_artifact_version(table_name):
+            self.build_model(descriptions, self.NUM_OF_TOPICS, table_name)
+
+    # Incremental training: only the items created, changed or removed since the latest version are processed
+    def update_model(self, table_name, online_update=False):
+        # Changes are applied to the active version (the similarities written before the staged versions are retrained)
+        latest_lda = get_active_version(table_name)
+        if latest_lda is None:
+            return self.train_model(table_name=table_name)
+
+        artifacts = [get_artifact_path(table_name, artifact) for artifact in ['model', 'dictionary', 'index', 'index_ids']]
+        if not all(os.path.exists(path) for path in artifacts):
+            return self.train_model(table_name=table_name)
+
+        self.report_progress('loading')
+        # The online update modifies the model, it cannot be a read-only mapping
+        self.model = models.ldamodel.LdaModel.load(get_artifact_path(table_name, 'model'), mmap=None if online_update else 'r')
+        dictionary = corpora.Dictionary.load(get_artifact_path(table_name, 'dictionary'))
+        index_ids = np.load(get_artifact_path(table_name, 'index_ids'))
+        index_matrix = np.load(get_artifact_path(table_name, 'index'), mmap_mode='r')
+        self.telemetry.record(n_rows=len(index_ids), vocabulary_size=len(dictionary))
+
+        # Find new, changed and removed items. The items changed while they are read are changed again after the
+        # cutoff of the new version: the next update processes them.
+        Model = apps.get_model(app_label='dimadb', model_name=table_name)
+        self.data_cutoff = timezone.now()
+        existing_ids = set(Model.objects.values_list('id', flat=True))
+        indexed_ids = set(index_ids.tolist())
+        changed_docs = list(Model.objects.filter(modified_at__gt=latest_lda.data_cutoff or latest_lda.created_at).only('id', 'description'))
+        changed_ids = set([doc.id for doc in changed_docs])
+        new_ids = existing_ids - indexed_ids - changed_ids
+        changed_docs += list(Model.objects.filter(id__in=list(new_ids)).only('id', 'description'))
+        changed_ids |= new_ids
+        removed_ids = indexed_ids - existing_ids
+
+        if len(changed_docs) == 0 and len(removed_ids) == 0:
+            return
+
+        self.report_progress('preprocessing')
+        texts = self.preprocess_documents(table_name, [doc.id for doc in changed_docs], [str(doc.description) for doc in changed_docs])
+        self.telemetry.record(n_rows=len(changed_docs))
+
+        # Retrain from scratch when too many tokens are unknown to the current dictionary (beyond the share of tokens
+        # a bounded training removed from it)
+        n_tokens = sum([len(text) for text in texts])
+        n_unknown_tokens = sum([1 for text in texts for token in text if token not in dictionary.token2id])
+        if n_tokens > 0 and n_unknown_tokens / n_tokens - (latest_lda.pruned_share or 0) > self.VOCABULARY_DRIFT_THRESHOLD:
+            return self.train_model(table_name=table_name)
+
+        corpus = [dictionary.doc2bow(text) for text in texts]
+        # The new version reuses the unchanged artifacts of the published one
+        linked_artifacts = ['dictionary', 'corpus']
+        if not (online_update and len(corpus) > 0):
+            linked_artifacts.append('model')
+        with self.new_artifact_version(table_name, linked_artifacts):
+            if online_update and len(corpus) > 0:
+                self.report_progress('lda')
+                self.telemetry.record(n_rows=len(corpus), vocabulary_size=len(dictionary))
+                self.model.update(corpus)
+                self.model.save(get_artifact_path(table_name, 'model', self.artifact_dir))
+
+            # Replace the rows of changed items in the neighbour index and append the new ones
+            self.report_progress('index')
+            changed_topics = normalize_rows(doc_topic_matrix(self.model, corpus, dtype=index_matrix.dtype))
+            keep = [position for position, item_id in enumerate(index_ids.tolist()) if item_id not in removed_ids and item_id not in changed_ids]
+            ids = np.concatenate([index_ids[keep], np.array([doc.id for doc in changed_docs], dtype=np.int64)])
+            self.doc_topics = np.vstack([index_matrix[keep], changed_topics])
+            self.telemetry.record(n_rows=len(changed_topics))
+            save_neighbour_index(get_artifact_path(table_name, 'index', self.artifact_dir), get_artifact_path(table_name, 'index_ids', self.artifact_dir),
+                                 ids, self.doc_topics)
+
+            delta_version = LdaSimilarityVersion.objects.create(
+                created_at=datetime.datetime.now(),
+                n_topics=self.model.num_topics,
+                n_products=len(ids),
+                item_type=table_name,
+                version_type='delta',
+                training_mode=self.TRAINING_MODE if online_update else None,
+                n_updated=len(changed_ids) + len(removed_ids),
+                similarity_storage=self.SIMILARITY_STORAGE,
+                top_k=self.TOP_K if self.SIMILARITY_STORAGE == 'top_k' else None,
+                pruned_share=latest_lda.pruned_share,
+                data_cutoff=self.data_cutoff
+            )
+            self.save_delta_similarity(changed_docs, changed_topics, ids, len(keep), removed_ids, table_name, delta_version, latest_lda)
+
+    # Recompute only the rows involving changed items: the new version starts from a copy of the rows of the
+    # active one, without the rows of the changed and removed items
+    def save_delta_similarity(self, changed_docs, changed_topics, ids, n_unchanged, removed_ids, table_name, version, active_version):
+        # The rows of the active version are only reused when they are stored the same way
+        if (active_version.similarity_storage != self.SIMILARITY_STORAGE or
+                (self.SIMILARITY_STORAGE == 'top_k' and active_version.top_k != self.TOP_K)):
+            return self.save_similarity(ids.tolist(), table_name, version)
+        if self.SIMILARITY_STORAGE == 'top_k':
+            return self.save_delta_neighbours(changed_topics, ids, n_unchanged, removed_ids, table_name, version, active_version)
+
+        self.report_progress('copying')
+        n_copied = copy_similarity_rows(table_name, active_version, version)
+        self.telemetry.record(rows_written=n_copied)
+        stale_ids = [str(doc.id) for doc in changed_docs] + [str(item_id) for item_id in removed_ids]
+        for start in range(0, len(stale_ids), 500):
+            chunk = stale_ids[start:start + 500]
+            LdaSimilarity.objects.filter(Q(source__in=chunk) | Q(target__in=chunk), item_type=table_name, version=str(version.id)).delete()
+
+        self.report_progress('similarity')
+        self.telemetry.record(n_rows=len(changed_docs), pairs_evaluated=len(changed_docs) * len(ids))
+        writer = SimilarityWriter(self.SIMILARITY_WRITE_BATCH_SIZE)
+        ids = ids.tolist()
+        for sources, targets, sims in iter_similar_pairs_between(changed_topics, self.doc_topics, self.SIMILARITY_THRESHOLD, self.SIMILARITY_BLOCK_SIZE):
+            self.report_progress('similarity', float(sources[0]) / len(changed_docs))
+            # Skip self pairs, and keep a single row for pairs of two changed items
+            mask = (targets < n_unchanged) | (targets - n_unchanged > sources)
+            for source_index, target_index, sim in zip(sources[mask].tolist(), targets[mask].tolist(), sims[mask].tolist()):
+                writer.add(LdaSimilarity(source=changed_docs[source_index].id, target=ids[target_index], item_type=table_name,
+                                         similarity=sim, version=str(version.id)))
+
+        self.report_progress('writing')
+        writer.flush()
+        self.telemetry.record(rows_written=writer.n_written)
+        self.activate_version(version, table_name)
+
+    # Top k storage: only the neighbour lists which can change are computed again, the ones of the changed items, the
+    # ones holding a changed or removed item and the ones whose k-th similarity a changed item reaches. The unchanged
+    # items keep their topic vectors, so the other lists are copied from the active version.
+    def save_delta_neighbours(self, changed_topics, ids, n_unchanged, removed_ids, table_name, version, active_version):
+        ids = ids.tolist()
+        positions = {item_id: position for position, item_id in enumerate(ids)}
+        stale_ids = ids[n_unchanged:] + list(removed_ids)
+
+        self.report_progress('candidates')
+        recomputed_ids = set(ids[n_unchanged:])
+        for start in range(0, len(stale_ids), 500):
+            recomputed_ids.update(LdaNeighbour.objects.filter(version=active_version.id, target__in=stale_ids[start:start + 500])
+                                  .values_list('source', flat=True))
+        # Similarity a changed item has to reach to enter a list: the k-th one of a full list, the threshold otherwise
+        entry_sims = np.full(n_unchanged, self.SIMILARITY_THRESHOLD)
+        full_lists = LdaNeighbour.objects.filter(version=active_version.id, rank=self.TOP_K - 1).values_list('source', 'similarity')
+        for source, similarity in full_lists.iterator():
+            if positions.get(source, n_unchanged) < n_unchanged:
+                entry_sims[positions[source]] = similarity
+        for sources, targets, sims in iter_similar_pairs_between(changed_topics, self.doc_topics[:n_unchanged], self.SIMILARITY_THRESHOLD,
+                                                                 self.SIMILARITY_BLOCK_SIZE):
+            recomputed_ids.update([ids[target] for target in targets[sims >= entry_sims[targets]].tolist()])
+
+        self.report_progress('copying')
+        n_copied = copy_neighbour_rows(table_name, active_version, version)
+        dropped_ids = list(recomputed_ids | set(removed_ids))
+        for start in range(0, len(dropped_ids), 500):
+            n_copied -= LdaNeighbour.objects.filter(version=version.id, source__in=dropped_ids[start:start + 500]).delete()[0]
+        self.telemetry.record(rows_written=n_copied)
+
+        self.report_progress('similarity')
+        recomputed_positions = sorted([positions[item_id] for item_id in recomputed_ids if item_id in positions])
+        self.telemetry.record(n_rows=len(recomputed_positions), pairs_evaluated=len(recomputed_positions) * len(ids))
+        writer = SimilarityWriter(self.SIMILARITY_WRITE_BATCH_SIZE)
+        for sources, targets, sims, ranks in iter_top_k_rows(self.doc_topics, recomputed_positions, self.TOP_K, self.SIMILARITY_THRESHOLD,
+                                                             self.SIMILARITY_BLOCK_SIZE):
+            for source_index, target_index, sim, rank in zip(sources.tolist(), targets.tolist(), sims.tolist(), ranks.tolist()):
+                writer.add(LdaNeighbour(version=version.id, item_type=table_name, source=ids[source_index], target=ids[target_index],
+                                        rank=rank, similarity=sim))
+
+        self.report_progress('writing')
+        writer.flush()
+        self.telemetry.record(rows_written=writer.n_written)
+        self.activate_version(version, table_name)
+
+    # Make a staging version the one read by the recommendations, then remove the rows of the previous ones.
+    # Inside new_artifact_version, this is done after its directory is published.
+    def activate_version(self, version, table_name):
+        if self.artifact_dir is not None:
+            self.pending_version = version
+            return
+        self.complete_activation(version, table_name)
+
+    def complete_activation(self, version, table_name, artifact_bytes=None):
+        with transaction.atomic():
+            # The earlier staging versions belong to trainings which did not complete
+            LdaSimilarityVersion.objects.filter(item_type=table_name).exclude(id=version.id).filter(
+                Q(status='active') | Q(status='staging', created_at__lt=version.created_at)).update(status='retired')
+            LdaSimilarityVersion.objects.filter(id=version.id).update(status='active', artifact_bytes=artifact_bytes)
+        version.status = 'active'
+        version.artifact_bytes = artifact_bytes
+        bump_data_version()
+        # Not reported to the progress callback: the training cannot be cancelled any more
+        self.telemetry.start('cleanup')
+        remove_retired_similarities(table_name, self.SIMILARITY_DELETE_BATCH_SIZE)
+        self.telemetry.save(version)
+
+    # Preprocess the descriptions of items, reusing the tokens cached for unchanged descriptions
+    def preprocess_documents(self, table_name, ids, data):
         tokenizer = RegexpTokenizer('\w+')
         stemmer = PorterStemmer()
+        texts = list()
+        created_records = list()
+        updated_records = list()
 
-        for d in data:
-            # Preprocessing the text
-            final_preprocess_tokens = self.preprocessing(tokenizer, stemmer, d)
-            texts.append(final_preprocess_tokens)
+        for start in range(0, len(ids), 1000):
+            chunk_ids = ids[start:start + 1000]
+            cached_records = PreprocessedText.objects.filter(item_type=table_name, item_id__in=chunk_ids)
+            cached_records = {record.item_id: record for record in cached_records}
+
+            for item_id, d in zip(chunk_ids, data[start:start + 1000]):
+                text_hash = get_text_hash(d)
+                record = cached_records.get(item_id)
+                if record is not None and record.text_hash == text_hash:
+                    texts.append(record.tokens.split())
+                    continue
+
+                tokens = self.preprocessing(tokenizer, stemmer, d)
+                texts.append(tokens)
+                if record is None:
+                    created_records.append(PreprocessedText(item_type=table_name, item_id=item_id, text_hash=text_hash, tokens=' '.join(tokens)))
+                else:
+                    record.text_hash = text_hash
+                    record.tokens = ' '.join(tokens)
+                    updated_records.append(record)
 
+        if len(created_records) > 0:
+            PreprocessedText.objects.bulk_create(created_records, batch_size=1000)
+        if len(updated_records) > 0:
+            PreprocessedText.objects.bulk_update(updated_records, fields=['text_hash', 'tokens'], batch_size=1000)
+
+        return texts
+
+    # Build the dictionary and the corpus of the descriptions, shared by the training and the topic sweep
+    def prepare_corpus(self, descriptions, table_name):
+        # Texts are preprocessed chunk by chunk (through the cache) each time they are iterated
+        self.report_progress('preprocessing')
+        texts = TokenStream(self, descriptions)
+
+        # First pass: build the dictionary
+        self.report_progress('dictionary')
         dictionary = corpora.Dictionary(texts)
-        corpus = [dictionary.doc2bow(text) for text in texts]       
-        lda_model = models.ldamodel.LdaModel(corpus=corpus, id2word=dictionary, num_topics=n_topics, random_state=100)
-        num_docs = len(docs)
+        if self.NO_BELOW is not None or self.NO_ABOVE is not None or self.KEEP_N is not None:
+            n_tokens = sum(dictionary.cfs.values())
+            dictionary.filter_extremes(no_below=self.NO_BELOW or 1, no_above=self.NO_ABOVE or 1.0, keep_n=self.KEEP_N)
+            self.pruned_share = 1 - sum(dictionary.cfs.values()) / n_tokens if n_tokens else 0
+        self.telemetry.record(n_rows=len(texts.ids), vocabulary_size=len(dictionary))
+
+        # Second pass: stream the bag-of-words corpus to disk, the training then reads it back from there
+        self.report_progress('corpus')
+        corpus_path = get_artifact_path(table_name, 'corpus', self.artifact_dir)
+        corpora.MmCorpus.serialize(corpus_path, BowStream(dictionary, texts))
+        corpus = corpora.MmCorpus(corpus_path)
+        self.telemetry.record(n_rows=len(corpus), vocabulary_size=len(dictionary))
+
+        if len(texts.ids) == 0:
+            print('There is no data of cultural product')
+
+        return texts, dictionary, corpus
+
+    def build_model(self, descriptions, n_topics, table_name):
+        texts, dictionary, corpus = self.prepare_corpus(descriptions, table_name)
+        ids = texts.ids
+
+        self.report_progress('lda')
+        self.telemetry.record(n_rows=len(ids), vocabulary_size=len(dictionary))
+        lda_model = self.create_lda_model(corpus, dictionary, n_topics)
 
         self.model = lda_model
         self.corpus = corpus
 
         # Save the model and update the database
-        self.save_lda_model(lda_model, corpus, dictionary, num_docs, table_name)
-        self.save_similarity(docs, table_name)
-
-    def save_lda_model(self, lda_model, corpus, dictionary, n_docs, table_name):
+        self.report_progress('saving')
+        version = self.save_lda_model(lda_model, dictionary, len(ids), table_name)
+        self.save_neighbour_index(ids, table_name)
+        self.save_similarity(ids, table_name, version)
+
+    # Train one model per candidate number of topics in parallel and keep the most coherent one.
+    # The texts, dictionary and corpus are built once and read from disk by the worker processes.
+    def sweep_num_topics(self, table_name, candidates, coherence='u_mass', processes=None, descriptions=None):
+        if descriptions is None:
+            descriptions = DescriptionStream(table_name)
+        self.data_cutoff = timezone.now()
+        with self.new_artifact_version(table_name):
+            texts, dictionary, corpus = self.prepare_corpus(descriptions, table_name)
+            ids = texts.ids
+
+            sweep_dir = tempfile.mkdtemp(prefix='sweep_', dir=self.artifact_dir)
+            try:
+                dictionary_path = os.path.join(sweep_dir, 'dictionary')
+                dictionary.save(dictionary_path)
+                # c_v and the other sliding window measures need the texts (read from the preprocessing cache)
+                texts_path = None
+                if coherence != 'u_mass':
+                    texts_path = os.path.join(sweep_dir, 'texts.txt')
+                    with open(texts_path, 'w') as texts_file:
+                        for tokens in texts:
+                            texts_file.write(' '.join(tokens) + '\n')
+
+                self.report_progress('sweep')
+                self.telemetry.record(n_rows=len(ids), vocabulary_size=len(dictionary))
+                # The workers are forked: they must not share the database connections of this process
+                connections.close_all()
+                corpus_path = get_artifact_path(table_name, 'corpus', self.artifact_dir)
+                results = run_topic_sweep(sorted(set(candidates)), corpus_path, dictionary_path, texts_path, sweep_dir, coherence=coherence,
+                                          processes=processes, chunksize=self.CHUNKSIZE, passes=self.PASSES, dtype=self.DTYPE)
+                best = select_best_candidate(results)
+                if best is None:
+                    raise ValueError('No number of topics of the sweep has a defined ' + coherence + ' coherence')
+
+                # Promote the selected model as if it had been trained by build_model
+                self.NUM_OF_TOPICS = best['n_topics']
+                self.TRAINING_MODE = 'sweep'
+                self.model = models.ldamodel.LdaModel.load(best['model_path'])
+                self.corpus = corpus
+
+                self.report_progress('saving')
+                version = self.save_lda_model(self.model, dictionary, len(ids), table_name)
+                LdaTopicSweepResult.objects.bulk_create([LdaTopicSweepResult(
+                    version=version,
+                    n_topics=result['n_topics'],
+                    coherence=result['coherence'],
+                    coherence_measure=coherence,
+                    training_seconds=result['training_seconds'],
+                    is_selected=(result is best)
+                ) for result in results])
+            finally:
+                shutil.rmtree(sweep_dir, ignore_errors=True)
+
+            self.save_neighbour_index(ids, table_name)
+            self.save_similarity(ids, table_name, version)
+        return results
+
+    def save_lda_model(self, lda_model, dictionary, n_docs, table_name):
         current_time = datetime.datetime.now()
-        current_time_str = current_time.strftime('%Y%m%d_%H%M%S_')
 
         # Create the path 
-        # index_path = os.path.relpath(os.path.join(self.lda_path, 'index.lda'))
-        model_path = os.path.relpath(os.path.join(self.lda_path, 'model_recommend', 'model_' + table_name + '.lda'))
-        dictionary_path = os.path.relpath(os.path.join(self.lda_path, 'model_recommend', 'dict_' + table_name + '.lda'.format(current_time_str)))
-        corpus_path = os.path.relpath(os.path.join(self.lda_path, 'model_recommend', 'corpus_' + table_name + '.mm'.format(current_time_str)))
+        model_path = get_artifact_path(table_name, 'model', self.artifact_dir)
+        dictionary_path = get_artifact_path(table_name, 'dictionary', self.artifact_dir)
         lda_model.save(model_path)
         dictionary.save(dictionary_path)
-        corpora.MmCorpus.serialize(corpus_path, corpus)
         
         # Save all the paths with some data of the version of the model in the database 
-        LdaSimilarityVersion.objects.create(
+        return LdaSimilarityVersion.objects.create(
             created_at=current_time,
             n_topics=self.NUM_OF_TOPICS,
+            training_mode=self.TRAINING_MODE,
             n_products=n_docs,
-            item_type=table_name
+            item_type=table_name,
+            similarity_storage=self.SIMILARITY_STORAGE,
+            top_k=self.TOP_K if self.SIMILARITY_STORAGE == 'top_k' else None,
+            pruned_share=self.pruned_share,
+            data_cutoff=self.data_cutoff
         )
 
-    def save_similarity(self, docs, table_name):
-        latest_version = LdaSimilarityVersion.objects.filter(item_type=table_name).latest('-created_at')
-
-        # Map each docs with the corpus
-        events = [[docs[i], self.corpus[i]] for i in range(0, len(docs))]
-  
-        # Create lists to optimize creation and updates for records in the databse
-        updated_records = list()
-        created_records = list()
-
-        # Looping through each pair of product and calculate the similarity
-        for source_index in range(0, len(events)-1):
-            for target_index in range(source_index + 1, len(events)):
-                print(source_index, target_index)
-                source_record = events[source_index]
-                target_record = events[target_index]
-
-                # Cosine similarity
-                sim = cossim(
-                    self.model.get_document_topics(source_record[1], minimum_probability=0), 
-                    self.model.get_document_topics(target_record[1], minimum_probability=0)
-                    )
-
-                if (float(sim) >= 0.5):
-                    source = source_record[0]
-                    target = target_record[0]
-                    
-                    try:
-                        
-                        # First try updating the existing records.
-                        u_record = LdaSimilarity.objects.get(source=source.id, target=target.id, item_type=table_name)
-                        u_record.similarity = float(sim)
-                        u_record.version = latest_version
-                        updated_records.append(u_record)
-                    except LdaSimilarity.DoesNotExist:
-                        
-                        # If there is no record, create a new records. 
-                        c_record = LdaSimilarity(source=source.id, target=target.id, item_type=table_name, similarity=float(sim), version=latest_version)
-                        created_records.append(c_record)
-            
-        # Proceed the database transaction/query here.
-        if len(created_records) > 0:
-            LdaSimilarity.objects.bulk_create(created_records)
-
-        if len(updated_records) > 0:
-            LdaSimilarity.objects.bulk_update(updated_records, fields=['similarity', 'version'])
-
-        # Clear all the zero-similarity
-        LdaSimilarity.objects.filter(similarity=0).delete()
+    # Infer the topic vector of each document once and write the neighbour index used for serving
+    def save_neighbour_index(self, ids, table_name):
+        self.report_progress('index')
+        self.doc_topics = normalize_rows(doc_topic_matrix(self.model, self.corpus, n_docs=len(ids), dtype=self.DTYPE))
+        self.telemetry.record(n_rows=len(self.doc_topics))
+        ids = np.array(ids[:len(self.doc_topics)], dtype=np.int64)
+        save_neighbour_index(get_artifact_path(table_name, 'index', self.artifact_dir), get_artifact_path(table_name, 'index_ids', self.artifact_dir),
+                             ids, self.doc_topics)
+
+    # Write the similarities of a new version in chunks, then make it the active one
+    def save_similarity(self, ids, table_name, version):
+        # Compare all the topic vectors with blocked matrix products
+        doc_topics = self.doc_topics
+        if (doc_topics is None):
+            doc_topics = normalize_rows(doc_topic_matrix(self.model, self.corpus, n_docs=len(ids), dtype=self.DTYPE))
+
+        self.report_progress('similarity')
+        # Top k: each item is compared with all the others, pairs: each pair is compared once
+        n_docs = len(doc_topics)
+        self.telemetry.record(n_rows=n_docs, pairs_evaluated=n_docs * (n_docs - 1) // (1 if self.SIMILARITY_STORAGE == 'top_k' else 2))
+        writer = SimilarityWriter(self.SIMILARITY_WRITE_BATCH_SIZE)
+        if self.SIMILARITY_STORAGE == 'top_k':
+            blocks = iter_top_k(doc_topics, self.TOP_K, self.SIMILARITY_THRESHOLD, self.SIMILARITY_BLOCK_SIZE)
+        else:
+            blocks = iter_similar_pairs(doc_topics, self.SIMILARITY_THRESHOLD, self.SIMILARITY_BLOCK_SIZE)
+        # The workers memory-map the neighbour index written by save_neighbour_index instead of receiving the matrix
+        matrix_path = get_artifact_path(table_name, 'index', self.artifact_dir)
+        if (self.SIMILARITY_WORKERS != 1 and self.doc_topics is not None and self.artifact_dir is not None and os.path.exists(matrix_path)):
+            # The workers are forked: they must not share the database connections of this process
+            connections.close_all()
+            blocks = iter_sharded_similarities(matrix_path, n_docs, self.SIMILARITY_STORAGE, self.TOP_K, self.SIMILARITY_THRESHOLD,
+                                               self.SIMILARITY_BLOCK_SIZE, self.SIMILARITY_WORKERS)
+
+        if self.SIMILARITY_STORAGE == 'top_k':
+            # The TOP_K most similar items of each item (above the threshold)
+            for sources, targets, sims, ranks in blocks:
+                self.report_progress('similarity', float(sources[0]) / len(doc_topics))
+                for source_index, target_index, sim, rank in zip(sources.tolist(), targets.tolist(), sims.tolist(), ranks.tolist()):
+                    writer.add(LdaNeighbour(version=version.id, item_type=table_name, source=ids[source_index], target=ids[target_index],
+                                            rank=rank, similarity=sim))
+        else:
+            # Looping through each pair of product above the threshold
+            for sources, targets, sims in blocks:
+                self.report_progress('similarity', float(sources[0]) / len(doc_topics))
+                for source_index, target_index, sim in zip(sources.tolist(), targets.tolist(), sims.tolist()):
+                    writer.add(LdaSimilarity(source=ids[source_index], target=ids[target_index], item_type=table_name,
+                                             similarity=sim, version=str(version.id)))
+
+        self.report_progress('writing')
+        writer.flush()
+        self.telemetry.record(rows_written=writer.n_written)
+        self.activate_version(version, table_name)
 
     @staticmethod
     def remove_stopwords(tokenized_data):
 
-        fr_stop = get_stop_words('french')
+        fr_stop = get_french_stop_words()
 
         stopped_tokens = [token for token in tokenized_data if token not in fr_stop]
         return stopped_tokens
@@ -168,8 +802,8 @@ class LdaModelManager(object):
         # Converting the document to lowercase
         raw = doc.lower()
         # Remove website and email
-        raw = re.sub("((\S+)?(http(s)?)(\S+))|((\S+)?(www)(\S+))|((\S+)?(\@)(\S+)?)", " ", raw)
-        raw = re.sub("[^a-zA-Z ]", "", raw)
+        raw = url_email_pattern.sub(" ", raw)
+        raw = non_letter_pattern.sub("", raw)
 
         # Steming 
         stemmed_doc = stemmer.stem_sentence(raw)     
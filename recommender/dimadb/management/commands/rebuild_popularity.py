@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from dimadb.popularity import rebuild_popularity
+from dimadb.recommend_cache import bump_data_version
+
+
+class Command(BaseCommand):
+    help = 'Aggregate again the daily page activity and the popularity of all the items (imports keep them up to date)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scores-only', action='store_true', help='Keep the page activity, only compute the scores again')
+
+    def handle(self, *args, **options):
+        rebuild_popularity(activity=not options['scores_only'])
+        bump_data_version()
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from dimadb.event_dates import refresh_next_dates, roll_next_dates
+from dimadb.recommend_cache import bump_data_version
+
+
+class Command(BaseCommand):
+    help = 'Move the next date of the events whose date has passed to their following date (run daily)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Compute the next date of every event again')
+
+    def handle(self, *args, **options):
+        n_events = refresh_next_dates() if options['all'] else roll_next_dates()
+        if (n_events):
+            bump_data_version()
+        self.stdout.write('Next date updated for %d event(s)' % n_events)
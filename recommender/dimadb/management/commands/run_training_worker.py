@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from dimadb.training_jobs import run_worker
+
+
+class Command(BaseCommand):
+    help = 'Run the queued similarity training jobs (one job at a time)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=float, default=5, help='Seconds between two checks of the queue')
+        parser.add_argument('--once', action='store_true', help='Exit when the queue is empty')
+
+    def handle(self, *args, **options):
+        run_worker(poll_interval=options['poll_interval'], once=options['once'])
@@ -12,6 +12,25 @@ class LdaSimilarityVersion(models.Model):
     n_topics = models.IntegerField(null=True)
     item_type = models.CharField(max_length=150, null=True, blank=True)
     n_products = models.IntegerField(null=True)
+    version_type = models.CharField(max_length=10, choices=(
+        ('full', 'full'), ('delta', 'delta')), default='full')
+    n_updated = models.IntegerField(null=True)
+    training_mode = models.CharField(max_length=20, null=True, blank=True)
+    # The similarities of a version are written while it is 'staging', then it replaces the 'active' one
+    # (which is 'retired' and whose rows are removed)
+    status = models.CharField(max_length=10, choices=(
+        ('staging', 'staging'), ('active', 'active'), ('retired', 'retired')), default='staging', db_index=True)
+    # Where the similarities of the version are stored: 'pairs' (LdaSimilarity) or 'top_k' (LdaNeighbour)
+    similarity_storage = models.CharField(max_length=10, choices=(
+        ('pairs', 'pairs'), ('top_k', 'top_k')), default='pairs')
+    top_k = models.IntegerField(null=True) # Neighbours kept per item ('top_k' storage)
+    # Similarity backend which trained the version (see content_based_recommender.similarity_backends)
+    backend = models.CharField(max_length=20, default='lda')
+    artifact_bytes = models.BigIntegerField(null=True) # Size of the artifact directory of the version
+    pruned_share = models.FloatField(null=True) # Share of the training tokens removed from the dictionary (bounded training)
+    # Items modified after this time are not in the version: taken before reading them, an item changed during
+    # the training is processed by the next incremental update (None for versions written before it existed)
+    data_cutoff = models.DateTimeField(null=True)
 
     def __str__(self):
         return format(self.created_at)
@@ -22,7 +41,84 @@ class LdaSimilarity(models.Model):
     target = models.CharField(max_length=150, null=True, blank=True)
     item_type = models.CharField(max_length=150, null=True, blank=True)
     similarity = models.DecimalField(max_digits=10, decimal_places=7)
-    version = models.CharField(max_length=150, null=True, blank=True)
+    version = models.CharField(max_length=150, null=True, blank=True) # Id of the LdaSimilarityVersion
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['item_type', 'version', 'source']),
+            models.Index(fields=['item_type', 'version', 'target']),
+        ]
+
+
+# The k most similar items of each item (similarity storage 'top_k'), read with one lookup on (version, source)
+class LdaNeighbour(models.Model):
+    version = models.IntegerField() # Id of the LdaSimilarityVersion
+    item_type = models.CharField(max_length=150)
+    source = models.IntegerField()
+    target = models.IntegerField()
+    rank = models.SmallIntegerField() # 0 for the most similar item
+    similarity = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['version', 'source', 'rank']),
+            models.Index(fields=['item_type', 'version']),
+        ]
+
+
+# Wall time and counts of each stage of the training of a version, in the order of the stages
+class LdaTrainingStage(models.Model):
+    version = models.ForeignKey(LdaSimilarityVersion, on_delete=models.CASCADE, related_name='stages')
+    position = models.IntegerField()
+    stage = models.CharField(max_length=50)
+    seconds = models.FloatField()
+    n_rows = models.IntegerField(null=True) # Items processed by the stage
+    vocabulary_size = models.IntegerField(null=True)
+    pairs_evaluated = models.BigIntegerField(null=True)
+    rows_written = models.IntegerField(null=True)
+    cumulative_peak_rss_mb = models.FloatField(null=True) # Peak resident size of the training process (or of its workers) since it started, up to the end of the stage
+
+
+# Coherence of each number of topics tried by a topic sweep, the selected one is the model of the version
+class LdaTopicSweepResult(models.Model):
+    version = models.ForeignKey(LdaSimilarityVersion, on_delete=models.CASCADE, related_name='sweep_results')
+    n_topics = models.IntegerField()
+    coherence = models.FloatField(null=True)
+    coherence_measure = models.CharField(max_length=20)
+    training_seconds = models.FloatField(null=True)
+    is_selected = models.BooleanField(default=False)
+
+
+# Tokens of a preprocessed description, reused by the trainings while the description hash is unchanged
+class PreprocessedText(models.Model):
+    item_type = models.CharField(max_length=150)
+    item_id = models.IntegerField()
+    text_hash = models.CharField(max_length=64)
+    tokens = models.TextField(blank=True)
+
+    class Meta:
+        unique_together = ('item_type', 'item_id')
+
+
+# Training jobs run by the training worker (python manage.py run_training_worker)
+class TrainingJob(models.Model):
+    item_type = models.CharField(max_length=150)
+    mode = models.CharField(max_length=20, default='full')
+    params = models.TextField(null=True, blank=True) # JSON training options (trainingMode, workers, ...)
+    status = models.CharField(max_length=20, choices=(
+        ('queued', 'queued'), ('running', 'running'), ('succeeded', 'succeeded'),
+        ('failed', 'failed'), ('cancelled', 'cancelled')), default='queued', db_index=True)
+    stage = models.CharField(max_length=50, null=True, blank=True)
+    progress = models.FloatField(default=0)
+    message = models.TextField(null=True, blank=True)
+    # Equal to item_type while the job is queued or running: the unique constraint de-duplicates requests
+    active_key = models.CharField(max_length=150, null=True, blank=True, unique=True)
+    cancel_requested = models.BooleanField(default=False)
+    worker = models.CharField(max_length=150, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True, null=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
 
 
 # Import_info:
@@ -32,6 +128,13 @@ class ImportInfo(models.Model):
     source_name = models.CharField(max_length=200, null=True, blank=True)
     import_date = models.DateTimeField(auto_now_add=True)
 
+# Counter incremented each time the data it names changes (e.g. 'recommend': what the recommendations are computed
+# from), so that every process can tell whether its cached results are still valid
+class DataVersion(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+    version = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
 # New_event:
 class Events(models.Model):
     id = models.AutoField(primary_key=True)
@@ -59,10 +162,12 @@ class Events(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, null=True)
     modified_at = models.DateTimeField(auto_now=True, null=True)
     import_id = models.CharField(max_length=30, null=True, blank=True)
+    # First EventDate to come, maintained by dimadb.event_dates (imports, edits, roll_event_dates command)
+    next_date = models.DateTimeField(null=True, blank=True, db_index=True)
     
 class EventDate(models.Model):
     id = models.AutoField(primary_key=True)
-    event_id = models.CharField(max_length=150, null=True, blank=True)
+    event_id = models.CharField(max_length=150, null=True, blank=True, db_index=True)
     date = models.DateTimeField(null=True)
     import_id = models.CharField(max_length=30, null=True, blank=True)
     
@@ -185,6 +290,36 @@ class Interaction_ga(models.Model):
     import_id = models.CharField(max_length=30, null=True, blank=True)
     
   
+# Web activities of each page per day and event name, from the file and Google Analytics interactions
+# (maintained by dimadb.popularity when they are imported)
+class PageActivity(models.Model):
+    page_location = models.CharField(max_length=500)
+    event_name = models.CharField(max_length=150, null=True, blank=True)
+    date = models.DateField(null=True, blank=True)
+    event_count = models.BigIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['page_location', 'event_name']),
+            models.Index(fields=['date']),
+        ]
+
+
+# Popularity of an item: web activities of its page weighted by the WebActivityType values (items without any
+# activity have no row)
+class ItemPopularity(models.Model):
+    item_type = models.CharField(max_length=150)
+    item_id = models.IntegerField()
+    score = models.FloatField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('item_type', 'item_id')
+        indexes = [
+            models.Index(fields=['item_type', '-score']),
+        ]
+
+
 #WebActivityType   
 class WebActivityType(models.Model):
     name = models.CharField(max_length=60, null=True, blank=True)
@@ -0,0 +1,137 @@
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+from .models import Interaction_f, Interaction_ga, PageActivity, ItemPopularity, WebActivityType
+import datetime
+import numpy as np
+
+# Item types whose popularity is materialised (their url is the page location of the web activities)
+popularity_item_types = ['events', 'products']
+
+CHUNK_SIZE = 500
+
+
+def iter_chunks(values, size=CHUNK_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+# Weight of each web activity type (1 for the types without a weight)
+def get_activity_weights():
+    weights = {}
+    for name, value in WebActivityType.objects.values_list('name', 'value'):
+        weights[name] = float(value) if value is not None else 1
+    return weights
+
+
+# Aggregate again the daily activity of some pages from the file and Google Analytics interactions
+def refresh_page_activity(page_locations):
+    for chunk in iter_chunks(set(page_locations) - {None}):
+        counts = {}
+        file_counts = Interaction_f.objects.filter(page_location__in=chunk).values('page_location', 'event_name', 'visit_date') \
+            .annotate(total=Count('id'))
+        for row in file_counts:
+            key = (row['page_location'], row['event_name'], row['visit_date'])
+            counts[key] = counts.get(key, 0) + row['total']
+        ga_counts = Interaction_ga.objects.filter(page_location__in=chunk).values('page_location', 'event_name', 'date') \
+            .annotate(total=Sum('event_count'))
+        for row in ga_counts:
+            key = (row['page_location'], row['event_name'], row['date'])
+            counts[key] = counts.get(key, 0) + (row['total'] or 0)
+
+        with transaction.atomic():
+            PageActivity.objects.filter(page_location__in=chunk).delete()
+            PageActivity.objects.bulk_create([PageActivity(page_location=page_location, event_name=event_name, date=date, event_count=count)
+                                              for (page_location, event_name, date), count in counts.items()])
+
+
+# Compute again the weighted popularity score of some items (all the items of the type when item_ids is None).
+# The scores are computed first, then replace the rows in one transaction: the readers never see a partial table.
+def refresh_item_popularity(item_type, item_ids=None, weights=None):
+    Model = apps.get_model(app_label='dimadb', model_name=item_type)
+    weights = weights if weights is not None else get_activity_weights()
+    items = Model.objects.all() if item_ids is None else Model.objects.filter(id__in=list(item_ids))
+
+    popularities = []
+    for chunk in iter_chunks(items.exclude(url=None).values_list('id', 'url')):
+        scores = {}
+        activities = PageActivity.objects.filter(page_location__in=[url for item_id, url in chunk]).values('page_location', 'event_name') \
+            .annotate(total=Sum('event_count'))
+        for activity in activities:
+            scores[activity['page_location']] = scores.get(activity['page_location'], 0) + \
+                activity['total'] * weights.get(activity['event_name'], 1)
+        popularities += [ItemPopularity(item_type=item_type, item_id=item_id, score=scores[url])
+                         for item_id, url in chunk if scores.get(url, 0) > 0]
+
+    with transaction.atomic():
+        if (item_ids is None):
+            ItemPopularity.objects.filter(item_type=item_type).delete()
+        else:
+            # Including the items which do not exist any more
+            for chunk in iter_chunks(item_ids):
+                ItemPopularity.objects.filter(item_type=item_type, item_id__in=chunk).delete()
+        ItemPopularity.objects.bulk_create(popularities, batch_size=CHUNK_SIZE)
+
+
+# Popularity of the items of some pages, after their activity changed
+def refresh_page_popularity(page_locations):
+    weights = get_activity_weights()
+    for item_type in popularity_item_types:
+        Model = apps.get_model(app_label='dimadb', model_name=item_type)
+        for chunk in iter_chunks(set(page_locations) - {None}):
+            item_ids = list(Model.objects.filter(url__in=chunk).values_list('id', flat=True))
+            if (len(item_ids)):
+                refresh_item_popularity(item_type, item_ids, weights)
+
+
+# Keep the popularity up to date after the rows of an import were added (or before they are removed):
+# returns the pages whose activity changed
+def get_import_page_locations(model_name, import_id):
+    if (model_name == 'interaction_f'):
+        return set(Interaction_f.objects.filter(import_id=import_id).values_list('page_location', flat=True))
+    if (model_name == 'interaction_ga'):
+        return set(Interaction_ga.objects.filter(import_id=import_id).values_list('page_location', flat=True))
+    return set()
+
+
+def refresh_import_popularity(model_name, import_id, page_locations=None):
+    if (model_name in popularity_item_types):
+        Model = apps.get_model(app_label='dimadb', model_name=model_name)
+        refresh_item_popularity(model_name, list(Model.objects.filter(import_id=import_id).values_list('id', flat=True)))
+        return
+    page_locations = page_locations if page_locations is not None else get_import_page_locations(model_name, import_id)
+    if (len(page_locations)):
+        refresh_page_activity(page_locations)
+        refresh_page_popularity(page_locations)
+
+
+# Trending score of the pages: {page location: score}. The daily activities of the last window_days days are
+# weighted by the activity types and halved every half_life_days of age. Only the rows of the window are read,
+# so the cost does not grow with the length of the history.
+def get_trending_scores(window_days, half_life_days, today=None):
+    today = today or timezone.localdate()
+    activities = list(PageActivity.objects.filter(date__gt=today - datetime.timedelta(days=window_days), date__lte=today)
+                      .values_list('page_location', 'event_name', 'date', 'event_count'))
+    if (len(activities) == 0):
+        return {}
+
+    page_locations, event_names, dates, counts = zip(*activities)
+    weights = get_activity_weights()
+    ages = (np.datetime64(today, 'D') - np.array(dates, dtype='datetime64[D]')).astype(np.float64)
+    scores = np.array(counts, dtype=np.float64) * np.array([weights.get(name, 1) for name in event_names]) * np.exp2(-ages / half_life_days)
+    pages, positions = np.unique(np.array(page_locations, dtype=object), return_inverse=True)
+    return dict(zip(pages.tolist(), np.bincount(positions, weights=scores).tolist()))
+
+
+# Rebuild the daily page activity and the popularity of all the items (e.g. after the activity weights changed)
+def rebuild_popularity(activity=True):
+    if (activity):
+        page_locations = set(Interaction_f.objects.values_list('page_location', flat=True).distinct())
+        page_locations |= set(Interaction_ga.objects.values_list('page_location', flat=True).distinct())
+        PageActivity.objects.all().delete()
+        refresh_page_activity(page_locations)
+    weights = get_activity_weights()
+    for item_type in popularity_item_types:
+        refresh_item_popularity(item_type, weights=weights)
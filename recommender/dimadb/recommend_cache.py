@@ -0,0 +1,120 @@
+from collections import OrderedDict
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from .models import DataVersion
+import datetime
+import threading
+import time
+
+# Version of everything the recommendations are computed from (items, web activities, activity weights, similarities)
+RECOMMEND_DATA = 'recommend'
+# Version of the urls and the domains of the items (the routing table): changed by the item edits and imports only
+ITEM_URLS_DATA = 'item_urls'
+
+
+# Called by the paths which change the recommendations: imports, item edits, trainings, activity weights
+def bump_data_version(name=RECOMMEND_DATA):
+    # update() does not set the auto_now date, which is the Last-Modified date of the recommendations
+    if (DataVersion.objects.filter(name=name).update(version=F('version') + 1, updated_at=timezone.now()) == 0):
+        data_version, created = DataVersion.objects.get_or_create(name=name, defaults={'version': 1})
+        if (not created):
+            DataVersion.objects.filter(name=name).update(version=F('version') + 1, updated_at=timezone.now())
+
+
+def get_data_version(name=RECOMMEND_DATA):
+    versions = list(DataVersion.objects.filter(name=name).values_list('version', flat=True)[:1])
+    return versions[0] if len(versions) else 0
+
+
+# HTTP validators of the recommendations: (ETag, Last-Modified timestamp). They change with the data version, and
+# each day since the upcoming events change with the date.
+def get_data_validators(name=RECOMMEND_DATA):
+    data_version = DataVersion.objects.filter(name=name).first()
+    today = timezone.localdate()
+    start_of_today = timezone.make_aware(datetime.datetime.combine(today, datetime.time()))
+    last_modified = max(data_version.updated_at, start_of_today) if data_version else start_of_today
+    etag = '"%s-%d-%s"' % (name, data_version.version if data_version else 0, today.isoformat())
+    return etag, int(last_modified.timestamp())
+
+
+# 304 response when the request validators (If-None-Match, If-Modified-Since) match, else None
+def get_not_modified_response(request, etag, last_modified):
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if (response is not None):
+        set_http_cache_headers(response, etag, last_modified)
+    return response
+
+
+def set_http_cache_headers(response, etag, last_modified):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    if (settings.RECOMMEND_HTTP_CACHE_CONTROL):
+        response['Cache-Control'] = settings.RECOMMEND_HTTP_CACHE_CONTROL
+    # The shared caches must not answer the requests of another API key (or without one)
+    patch_vary_headers(response, ['Authorization'])
+    return response
+
+
+# Recommendation results of this process, least recently used first. An entry is only returned for the data
+# version it was computed with, and for ttl seconds (upcoming items also change with the date).
+class RecommendCache(object):
+
+    def __init__(self, max_size=1000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict() # {key: (data version, expiry time, value)}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0 # Entries dropped because the data version changed or the ttl expired
+
+    # Return (True, value) when the key is cached for this data version, else (False, None).
+    # The value is shared by the requests: it must not be modified.
+    def get(self, key, data_version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry is not None and (entry[0] != data_version or entry[1] < time.monotonic())):
+                del self.entries[key]
+                self.invalidations += 1
+                entry = None
+            if (entry is None):
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[2]
+
+    def set(self, key, data_version, value):
+        if (self.max_size <= 0):
+            return
+        with self.lock:
+            self.entries[key] = (data_version, time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while (len(self.entries) > self.max_size):
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            n_requests = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'maxSize': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': self.hits / n_requests if n_requests else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+recommend_cache = RecommendCache(settings.RECOMMEND_CACHE_SIZE, settings.RECOMMEND_CACHE_TTL)
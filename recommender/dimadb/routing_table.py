@@ -0,0 +1,132 @@
+from django.apps import apps
+from django.conf import settings
+from slugify import slugify
+from urllib.parse import urlsplit
+from .recommend_cache import ITEM_URLS_DATA, get_data_version
+import threading
+import time
+
+# Column holding the domain of each item type
+domain_columns = {'events': 'event_type', 'products': 'product_type'}
+
+# Value of the urls missing from the missed urls (None is the value of a url which is not an item)
+NOT_LOOKED_UP = object()
+
+
+# Same page whatever the scheme, the case of the host, a trailing slash, the query string or the fragment
+def normalize_url(url):
+    parts = urlsplit(url.strip())
+    return (parts.netloc.lower() + parts.path).rstrip('/')
+
+
+# Item type, recommend level and domain slug of a page of the partner website, from the structure of its url
+def parse_page_url(url):
+    url_parts = normalize_url(url).split('/')
+    url_len = len(url_parts)
+    item_type = ''
+    recommend_level = ''
+    slug_domain = ''
+
+    for index, part in enumerate(url_parts):
+        if part == 'magazine':
+            item_type = 'products'
+            if (url_len - index == 3):
+                recommend_level = 'Item'
+            elif (url_len - index == 2):
+                if url_parts[url_len-1] != 'tous-les-articles':
+                    recommend_level = 'Domain'
+                    slug_domain = url_parts[url_len-1]
+                else:
+                    recommend_level = 'Homepage'
+            else:
+                recommend_level = 'Homepage'
+            break
+        elif part == 'evenements':
+            item_type = 'events'
+            if (url_len - index == 2):
+                recommend_level = 'Item'
+            else:
+                recommend_level = 'Homepage'
+            break
+
+    return item_type, recommend_level, slug_domain
+
+
+# Urls of the items and slugs of the domains, kept in memory by each process. The version of the item urls is
+# checked at most every check_interval seconds; the tables are built again (and swapped at once) when it changed.
+# The other data changes (web activities, trainings, date rolls) leave the tables as they are.
+class RoutingTable(object):
+
+    def __init__(self, check_interval=5, max_missed_urls=10000):
+        self.check_interval = check_interval
+        self.max_missed_urls = max_missed_urls
+        self.lock = threading.Lock()
+        self.data_version = None
+        self.checked_at = None
+        self.items = {} # {item type: {normalised url: item id}}
+        self.domains = {} # {item type: {domain slug: domain}}
+        self.missed_urls = {} # {(item type, url): item id or None} of the urls looked up in the database since the build
+
+    def is_checked(self):
+        return self.checked_at is not None and time.monotonic() - self.checked_at < self.check_interval
+
+    def refresh(self):
+        if (self.is_checked()):
+            return
+        with self.lock:
+            if (self.is_checked()):
+                return
+            # Read before the tables: a change made during the build is seen by the next check
+            data_version = get_data_version(ITEM_URLS_DATA)
+            if (data_version != self.data_version):
+                self.build()
+                self.data_version = data_version
+            self.checked_at = time.monotonic()
+
+    def build(self):
+        items = {}
+        domains = {}
+        for item_type, domain_column in domain_columns.items():
+            Model = apps.get_model(app_label='dimadb', model_name=item_type)
+            items[item_type] = {}
+            for item_id, url in Model.objects.exclude(url=None).values_list('id', 'url').iterator():
+                items[item_type].setdefault(normalize_url(url), item_id)
+            domains[item_type] = {}
+            for domain in Model.objects.exclude(**{domain_column: None}).values_list(domain_column, flat=True).distinct():
+                domains[item_type].setdefault(slugify(domain), domain)
+        self.items = items
+        self.domains = domains
+        self.missed_urls = {}
+
+    # Id of the item of a page, None when unknown. A url missing from the table (an item added since the build,
+    # or a page which is not an item) is looked up in the database once until the next build.
+    def get_item_id(self, item_type, url):
+        self.refresh()
+        item_id = self.items.get(item_type, {}).get(normalize_url(url))
+        if (item_id is not None):
+            return item_id
+        # One read of the dict: another thread may clear it between a membership check and a read
+        missed_urls = self.missed_urls
+        key = (item_type, url)
+        item_id = missed_urls.get(key, NOT_LOOKED_UP)
+        if (item_id is not NOT_LOOKED_UP):
+            return item_id
+        Model = apps.get_model(app_label='dimadb', model_name=item_type)
+        item_id = Model.objects.filter(url=url).values_list('id', flat=True).first()
+        if (len(missed_urls) >= self.max_missed_urls):
+            missed_urls.clear()
+        missed_urls[key] = item_id
+        return item_id
+
+    # Domain of a slug, '' when unknown
+    def get_domain(self, item_type, slug_domain):
+        self.refresh()
+        return self.domains.get(item_type, {}).get(slug_domain, '')
+
+    def clear(self):
+        with self.lock:
+            self.checked_at = None
+            self.data_version = None
+
+
+routing_table = RoutingTable(settings.ROUTING_TABLE_CHECK_SECONDS)
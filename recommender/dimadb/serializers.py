@@ -1,6 +1,6 @@
 from rest_framework import serializers
 from rest_framework_jwt.settings import api_settings
-from .models import Events, Products, Interaction_f, ImportInfo
+from .models import Events, Products, Interaction_f, ImportInfo, TrainingJob
 
         
 class InteractionSerializer(serializers.ModelSerializer):
@@ -18,4 +18,8 @@ class ArticleSerializer(serializers.ModelSerializer):
 class ImportInfoSerializer(serializers.ModelSerializer):
     class Meta:
         model = ImportInfo
-        fields = ('id', 'source_name', 'import_date')
\ No newline at end of file
+        fields = ('id', 'source_name', 'import_date')
+class TrainingJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = TrainingJob
+        fields = ('id', 'item_type', 'mode', 'status', 'stage', 'progress', 'message', 'cancel_requested', 'created_at', 'started_at', 'finished_at')
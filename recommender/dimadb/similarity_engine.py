@@ -0,0 +1,226 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# This module only depends on numpy so it can be used (and benchmarked) without a Django setup,
+# and in the worker processes of the sharded similarity computation.
+
+
+# Infer the topic distribution of each document once and stack them in a dense (n_docs x n_topics) matrix
+def doc_topic_matrix(model, corpus, n_docs=None, dtype=np.float64):
+    rows = []
+    for index, bow in enumerate(corpus):
+        if (n_docs is not None and index >= n_docs):
+            break
+        row = np.zeros(model.num_topics, dtype=dtype)
+        for topic_id, probability in model.get_document_topics(bow, minimum_probability=0):
+            row[topic_id] = probability
+        rows.append(row)
+
+    if (len(rows) == 0):
+        return np.zeros((0, model.num_topics), dtype=dtype)
+    return np.vstack(rows)
+
+
+# Scale every row to unit length so that a dot product is the cosine similarity.
+# Empty rows stay at zero, which gives a similarity of 0 like gensim's cossim.
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+# Yield (sources, targets, similarities) arrays for every pair source < target with similarity >= threshold.
+# The matrix must be normalized; the products are computed tile by tile so that the memory
+# footprint is bounded by block_size * block_size, whatever the number of documents.
+# first_row/last_row restrict the sources to a shard of the rows.
+def iter_similar_pairs(matrix, threshold, block_size=1024, first_row=0, last_row=None):
+    n_docs = matrix.shape[0]
+    last_row = n_docs if last_row is None else min(last_row, n_docs)
+
+    for row_start in range(first_row, last_row, block_size):
+        row_end = min(row_start + block_size, last_row)
+        rows = matrix[row_start:row_end]
+
+        for col_start in range(row_start, n_docs, block_size):
+            col_end = min(col_start + block_size, n_docs)
+            block = rows @ matrix[col_start:col_end].T
+            mask = block >= threshold
+
+            # On the diagonal tile, only keep the upper triangle (no self pairs, no duplicates)
+            if (col_start == row_start):
+                mask &= np.triu(np.ones(mask.shape, dtype=bool), k=1)
+
+            sources, targets = np.nonzero(mask)
+            if (len(sources)):
+                yield sources + row_start, targets + col_start, block[sources, targets]
+
+
+
+# Yield (query positions, matrix positions, similarities) for every query row compared with every matrix row
+# with similarity >= threshold. Both inputs must be normalized; used to compare only new or changed documents.
+def iter_similar_pairs_between(queries, matrix, threshold, block_size=1024):
+    for query_start in range(0, queries.shape[0], block_size):
+        query_rows = queries[query_start:query_start + block_size]
+
+        for col_start in range(0, matrix.shape[0], block_size):
+            block = query_rows @ matrix[col_start:col_start + block_size].T
+            sources, targets = np.nonzero(block >= threshold)
+            if (len(sources)):
+                yield sources + query_start, targets + col_start, block[sources, targets]
+
+
+# Yield (sources, targets, similarities, ranks) arrays with the k most similar rows of every row (itself excluded)
+# with similarity >= threshold, rank 0 being the most similar. The matrix must be normalized; each block of rows
+# keeps a running top k while the columns are compared tile by tile. first_row/last_row restrict the sources.
+def iter_top_k(matrix, k, threshold=0, block_size=1024, first_row=0, last_row=None):
+    last_row = matrix.shape[0] if last_row is None else min(last_row, matrix.shape[0])
+    return iter_top_k_rows(matrix, np.arange(first_row, last_row), k, threshold, block_size)
+
+
+# Same as iter_top_k for the sources at some positions of the matrix (in increasing order), e.g. the neighbour
+# lists an incremental training has to compute again
+def iter_top_k_rows(matrix, positions, k, threshold=0, block_size=1024):
+    n_docs = matrix.shape[0]
+    k = min(k, n_docs - 1)
+    if (k <= 0):
+        return
+    positions = np.asarray(positions, dtype=np.int64)
+
+    for start in range(0, len(positions), block_size):
+        row_positions = positions[start:start + block_size]
+        rows = matrix[row_positions]
+        n_rows = rows.shape[0]
+        best_sims = np.zeros((n_rows, 0))
+        best_targets = np.zeros((n_rows, 0), dtype=np.int64)
+
+        for col_start in range(0, n_docs, block_size):
+            block = rows @ matrix[col_start:col_start + block_size].T
+            # No self pairs
+            diagonal = row_positions - col_start
+            inside = (diagonal >= 0) & (diagonal < block.shape[1])
+            block[np.nonzero(inside)[0], diagonal[inside]] = -np.inf
+
+            sims = np.hstack([best_sims, block])
+            targets = np.hstack([best_targets, np.broadcast_to(np.arange(col_start, col_start + block.shape[1]), block.shape)])
+            if (sims.shape[1] > k):
+                top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+                sims = np.take_along_axis(sims, top, axis=1)
+                targets = np.take_along_axis(targets, top, axis=1)
+            best_sims, best_targets = sims, targets
+
+        order = np.argsort(-best_sims, axis=1, kind='stable')
+        best_sims = np.take_along_axis(best_sims, order, axis=1)
+        best_targets = np.take_along_axis(best_targets, order, axis=1)
+        sources = np.broadcast_to(row_positions[:, None], best_sims.shape)
+        ranks = np.broadcast_to(np.arange(best_sims.shape[1]), best_sims.shape)
+        mask = best_sims >= threshold
+        if (mask.any()):
+            yield sources[mask], best_targets[mask], best_sims[mask], ranks[mask]
+
+
+# Worker of the sharded computation: the similarities of the rows [first_row, last_row) of the normalized matrix
+# saved at matrix_path, which is memory-mapped (its pages are shared with the other workers, never pickled).
+# Returns the arrays of iter_top_k (storage 'top_k') or of iter_similar_pairs, concatenated, or None.
+def compute_similarity_shard(matrix_path, storage, first_row, last_row, k, threshold, block_size):
+    matrix = np.load(matrix_path, mmap_mode='r')
+    if storage == 'top_k':
+        blocks = list(iter_top_k(matrix, k, threshold, block_size, first_row, last_row))
+    else:
+        blocks = list(iter_similar_pairs(matrix, threshold, block_size, first_row, last_row))
+    if len(blocks) == 0:
+        return None
+    return tuple(np.concatenate(arrays) for arrays in zip(*blocks))
+
+
+# Same output as iter_top_k/iter_similar_pairs over the whole matrix saved at matrix_path, the blocks of rows
+# being computed by a pool of processes. The shards are yielded in row order; at most two shards per worker are
+# in flight so that the results waiting to be consumed stay bounded.
+def iter_sharded_similarities(matrix_path, n_docs, storage, k=20, threshold=0, block_size=1024, processes=None):
+    processes = processes or os.cpu_count() or 1
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for first_row in range(0, n_docs, block_size):
+            pending.append(executor.submit(compute_similarity_shard, matrix_path, storage, first_row, first_row + block_size,
+                                           k, threshold, block_size))
+            while len(pending) > 2 * processes or (pending and pending[0].done()):
+                shard = pending.popleft().result()
+                if shard is not None:
+                    yield shard
+        while pending:
+            shard = pending.popleft().result()
+            if shard is not None:
+                yield shard
+
+
+# Same as iter_top_k for a sparse (scipy CSR) matrix with normalized rows, e.g. TF-IDF vectors: the product of
+# each block of rows with the whole matrix stays sparse and only its non-zero similarities are ranked
+def iter_sparse_top_k(matrix, k, threshold=0, block_size=256):
+    n_docs = matrix.shape[0]
+    transposed = matrix.T.tocsr()
+
+    for row_start in range(0, n_docs, block_size):
+        block = (matrix[row_start:row_start + block_size] @ transposed).tocsr()
+        sources, targets, sims, ranks = [], [], [], []
+
+        for row in range(block.shape[0]):
+            row_targets = block.indices[block.indptr[row]:block.indptr[row + 1]]
+            row_sims = block.data[block.indptr[row]:block.indptr[row + 1]]
+            # No self pairs
+            keep = (row_targets != row_start + row) & (row_sims >= threshold)
+            row_targets, row_sims = row_targets[keep], row_sims[keep]
+
+            if (len(row_sims) > k):
+                top = np.argpartition(-row_sims, k - 1)[:k]
+                row_targets, row_sims = row_targets[top], row_sims[top]
+            order = np.argsort(-row_sims, kind='stable')
+            sources.append(np.full(len(order), row_start + row, dtype=np.int64))
+            targets.append(row_targets[order].astype(np.int64))
+            sims.append(row_sims[order])
+            ranks.append(np.arange(len(order)))
+
+        sources = np.concatenate(sources)
+        if (len(sources)):
+            yield sources, np.concatenate(targets), np.concatenate(sims), np.concatenate(ranks)
+
+
+# Write the normalized doc-topic matrix and the item ids (same order) beside the model artifacts
+def save_neighbour_index(matrix_path, ids_path, ids, matrix):
+    np.save(ids_path, np.asarray(ids, dtype=np.int64))
+    np.save(matrix_path, np.asarray(matrix))
+
+
+# In-memory nearest-neighbour index over the normalized doc-topic matrix of an item type
+class NeighbourIndex(object):
+
+    def __init__(self, ids, matrix):
+        self.ids = ids
+        self.matrix = matrix
+        self.positions = {int(item_id): position for position, item_id in enumerate(ids.tolist())}
+
+    # The matrix is memory-mapped read-only: the processes serving the same version share its pages
+    @classmethod
+    def load(cls, matrix_path, ids_path):
+        return cls(np.load(ids_path), np.load(matrix_path, mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.ids)
+
+    # Return [(item_id, similarity)] sorted by decreasing similarity, the item itself excluded
+    def query(self, item_id, limit=None, threshold=0):
+        position = self.positions.get(int(item_id))
+        if (position is None):
+            return []
+
+        scores = self.matrix @ self.matrix[position]
+        scores[position] = -np.inf
+        candidates = np.nonzero(scores >= threshold)[0]
+
+        # Partial sort: only the best `limit` candidates are ordered
+        if (limit is not None and len(candidates) > limit):
+            candidates = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+
+        return [(int(self.ids[i]), float(scores[i])) for i in candidates]
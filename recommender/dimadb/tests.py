@@ -1,3 +1,658 @@
-from django.test import TestCase
+from asgiref.sync import async_to_sync, sync_to_async
+from django.test import AsyncClient, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from scipy import sparse
+from unittest import mock
+from benchmarks.synthetic import generate_descriptions
+from django.utils import timezone
+from .models import DataVersion, Events, EventDate, Products, LdaSimilarity, LdaSimilarityVersion, LdaNeighbour, LdaTrainingStage, TrainingJob, \
+    Interaction_f, Interaction_ga, ItemPopularity, PageActivity, WebActivityType
+from .similarity_engine import normalize_rows, iter_similar_pairs, iter_top_k, iter_top_k_rows, iter_sparse_top_k, \
+    iter_sharded_similarities, save_neighbour_index, NeighbourIndex
+from .lda_model_builder import LdaModelManager, get_active_version, get_artifact_path
+from .content_based_recommender import ContentBasedRecommender, TfidfBackend
+from .tfidf_model_builder import TfidfModelManager
+from .training_jobs import enqueue_training_job, cancel_training_job, claim_next_job, finish_job, run_job
+from .popularity import refresh_item_popularity, refresh_import_popularity, get_trending_scores
+from .recommend_cache import RecommendCache, bump_data_version, recommend_cache
+from .routing_table import RoutingTable, normalize_url, parse_page_url, routing_table
+from .event_dates import refresh_next_dates, roll_next_dates
+from . import event_dates, views
+import datetime
+import json
+import numpy as np
+import os
+import tempfile
+from urllib.parse import urlencode
 
-# Create your tests here.
+
+def random_matrix(n_docs=57, n_topics=6, seed=0):
+    return normalize_rows(np.random.RandomState(seed).rand(n_docs, n_topics))
+
+
+# {(source, target): similarity} of the arrays yielded by a similarity iterator
+def collect_pairs(blocks):
+    pairs = {}
+    for block in blocks:
+        for source, target, similarity in zip(block[0].tolist(), block[1].tolist(), block[2].tolist()):
+            pairs[(source, target)] = similarity
+    return pairs
+
+
+# Brute force: every row compared with every other one, {source: [targets, most similar first]}
+def brute_force_top_k(similarities, k, threshold):
+    top_k = {}
+    for source in range(similarities.shape[0]):
+        targets = [target for target in np.argsort(-similarities[source], kind='stable').tolist()
+                   if target != source and similarities[source, target] >= threshold][:k]
+        if (len(targets)):
+            top_k[source] = targets
+    return top_k
+
+
+# Write the model artifacts of the test to a temporary directory
+def use_temporary_model_dir(test):
+    model_dir = tempfile.TemporaryDirectory()
+    test.addCleanup(model_dir.cleanup)
+    patcher = mock.patch('dimadb.lda_model_builder.model_dir', model_dir.name)
+    patcher.start()
+    test.addCleanup(patcher.stop)
+
+
+def create_events(descriptions, first_index=0):
+    return [Events.objects.create(event_id='event-%d' % index, event_name='Event %d' % index, event_type='Musique',
+                                  url='https://dici.ca/evenements/event-%d' % index, description=description)
+            for index, description in enumerate(descriptions, first_index)]
+
+
+# {(item id, item id): similarity} of the active version recomputed from its neighbour index, with the threshold
+# of the training
+def recompute_similar_pairs(table_name):
+    index = NeighbourIndex.load(get_artifact_path(table_name, 'index'), get_artifact_path(table_name, 'index_ids'))
+    ids = index.ids.tolist()
+    pairs = collect_pairs(iter_similar_pairs(np.asarray(index.matrix), LdaModelManager().SIMILARITY_THRESHOLD))
+    return {frozenset([ids[source], ids[target]]): similarity for (source, target), similarity in pairs.items()}
+
+
+# {source: [targets, most similar first]} of the arrays yielded by a top k iterator, checking their ranks
+def collect_top_k(test, blocks):
+    top_k = {}
+    for sources, targets, sims, ranks in blocks:
+        for source, target, rank in zip(sources.tolist(), targets.tolist(), ranks.tolist()):
+            top_k.setdefault(source, []).append(target)
+            test.assertEqual(len(top_k[source]) - 1, rank)
+    return top_k
+
+
+class SimilarityEngineTests(SimpleTestCase):
+
+    def setUp(self):
+        self.matrix = random_matrix()
+        self.similarities = self.matrix @ self.matrix.T
+
+    def test_similar_pairs_match_brute_force(self):
+        expected = {(source, target): self.similarities[source, target]
+                    for source in range(len(self.matrix)) for target in range(source + 1, len(self.matrix))
+                    if self.similarities[source, target] >= 0.8}
+        for block_size in [7, 16, 1024]:
+            pairs = collect_pairs(iter_similar_pairs(self.matrix, 0.8, block_size=block_size))
+            self.assertEqual(set(expected), set(pairs))
+            for pair, similarity in expected.items():
+                self.assertAlmostEqual(similarity, pairs[pair])
+
+        # Shards of rows give the pairs of the whole matrix
+        shards = {}
+        for first_row in range(0, len(self.matrix), 10):
+            shards.update(collect_pairs(iter_similar_pairs(self.matrix, 0.8, block_size=7, first_row=first_row, last_row=first_row + 10)))
+        self.assertEqual(set(expected), set(shards))
+
+    def test_top_k_matches_brute_force(self):
+        for k, threshold, block_size in [(5, 0, 7), (5, 0.9, 16), (100, 0.5, 1024)]:
+            self.assertEqual(brute_force_top_k(self.similarities, k, threshold),
+                             collect_top_k(self, iter_top_k(self.matrix, k, threshold, block_size=block_size)))
+        # Some of the rows only
+        positions = [0, 3, 4, 20, 41, 56]
+        expected = brute_force_top_k(self.similarities, 5, 0.5)
+        self.assertEqual({position: expected[position] for position in positions if position in expected},
+                         collect_top_k(self, iter_top_k_rows(self.matrix, positions, 5, 0.5, block_size=4)))
+
+    def test_sparse_top_k_matches_brute_force(self):
+        matrix = sparse.random(41, 30, density=0.15, format='csr', random_state=1)
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1))).ravel()
+        norms[norms == 0] = 1
+        matrix = (sparse.diags(1 / norms) @ matrix).tocsr()
+        similarities = (matrix @ matrix.T).toarray()
+        for k, threshold, block_size in [(3, 0.1, 8), (10, 0.3, 256)]:
+            # Only the non-zero similarities are ranked
+            self.assertEqual(brute_force_top_k(similarities, k, max(threshold, 1e-12)),
+                             collect_top_k(self, iter_sparse_top_k(matrix, k, threshold, block_size=block_size)))
+
+    def test_sharded_similarities_match_single_process(self):
+        with tempfile.TemporaryDirectory() as directory:
+            matrix_path = os.path.join(directory, 'matrix.npy')
+            np.save(matrix_path, self.matrix)
+            sharded = iter_sharded_similarities(matrix_path, len(self.matrix), 'top_k', k=4, threshold=0.5, block_size=10, processes=2)
+            self.assertEqual(brute_force_top_k(self.similarities, 4, 0.5), collect_top_k(self, sharded))
+            sharded = iter_sharded_similarities(matrix_path, len(self.matrix), 'pairs', threshold=0.8, block_size=10, processes=2)
+            self.assertEqual(set(collect_pairs(iter_similar_pairs(self.matrix, 0.8))), set(collect_pairs(sharded)))
+
+    def test_neighbour_index_matches_brute_force(self):
+        ids = np.arange(100, 100 + len(self.matrix), dtype=np.int64)
+        with tempfile.TemporaryDirectory() as directory:
+            matrix_path = os.path.join(directory, 'index.npy')
+            ids_path = os.path.join(directory, 'index_ids.npy')
+            save_neighbour_index(matrix_path, ids_path, ids, self.matrix)
+            index = NeighbourIndex.load(matrix_path, ids_path)
+            self.assertEqual(len(self.matrix), len(index))
+            for position in [0, 13, len(self.matrix) - 1]:
+                for limit, threshold in [(None, 0), (5, 0), (3, 0.9), (None, 0.95)]:
+                    expected = brute_force_top_k(self.similarities, len(self.matrix), threshold).get(position, [])
+                    if (limit is not None):
+                        expected = expected[:limit]
+                    neighbours = index.query(int(ids[position]), limit, threshold)
+                    self.assertEqual([int(ids[target]) for target in expected], [item_id for item_id, similarity in neighbours])
+                    for item_id, similarity in neighbours:
+                        self.assertAlmostEqual(self.similarities[position, item_id - 100], similarity)
+            self.assertEqual([], index.query(1))
+
+
+class RecommendCacheTests(SimpleTestCase):
+
+    def test_entry_of_the_data_version(self):
+        cache = RecommendCache(max_size=10, ttl=60)
+        self.assertEqual((False, None), cache.get('key', 1))
+        cache.set('key', 1, ['item'])
+        self.assertEqual((True, ['item']), cache.get('key', 1))
+        # Computed from older data
+        self.assertEqual((False, None), cache.get('key', 2))
+        self.assertEqual((False, None), cache.get('key', 1))
+        stats = cache.stats()
+        self.assertEqual((1, 3, 1), (stats['hits'], stats['misses'], stats['invalidations']))
+
+    def test_entry_expires(self):
+        cache = RecommendCache(max_size=10, ttl=60)
+        with mock.patch('dimadb.recommend_cache.time.monotonic', return_value=1000):
+            cache.set('key', 1, ['item'])
+        with mock.patch('dimadb.recommend_cache.time.monotonic', return_value=1059):
+            self.assertEqual((True, ['item']), cache.get('key', 1))
+        with mock.patch('dimadb.recommend_cache.time.monotonic', return_value=1061):
+            self.assertEqual((False, None), cache.get('key', 1))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = RecommendCache(max_size=2, ttl=60)
+        cache.set('a', 1, 'a')
+        cache.set('b', 1, 'b')
+        cache.get('a', 1)
+        cache.set('c', 1, 'c')
+        self.assertEqual((False, None), cache.get('b', 1))
+        self.assertEqual((True, 'a'), cache.get('a', 1))
+        self.assertEqual((True, 'c'), cache.get('c', 1))
+        self.assertEqual(1, cache.stats()['evictions'])
+
+    def test_disabled_cache_keeps_nothing(self):
+        cache = RecommendCache(max_size=0, ttl=60)
+        cache.set('key', 1, 'value')
+        self.assertEqual((False, None), cache.get('key', 1))
+
+
+# Incremental training: the rows of the new version are the ones of a full computation over its neighbour index
+@override_settings(LDA_SIMILARITY_STORAGE={'events': {'storage': 'pairs'}})
+class IncrementalTrainingTests(TestCase):
+
+    def setUp(self):
+        use_temporary_model_dir(self)
+        self.descriptions = generate_descriptions(80, seed=7)
+        self.events = create_events(self.descriptions[:60])
+        ContentBasedRecommender.train_items_by_items('events', backend='lda')
+        self.full_version = get_active_version('events')
+
+    # Change, add and remove items from the vocabulary of the model
+    def change_items(self):
+        for event, description in zip(self.events[:3], self.descriptions[70:73]):
+            event.description = description
+            event.save()
+        create_events(self.descriptions[60:65], first_index=60)
+        Events.objects.filter(id__in=[self.events[5].id, self.events[6].id]).delete()
+
+    def check_version(self, version):
+        self.assertEqual(version, get_active_version('events'))
+        self.assertEqual('retired', LdaSimilarityVersion.objects.get(id=self.full_version.id).status)
+        self.assertGreater(version.data_cutoff, self.full_version.data_cutoff)
+        index_ids = np.load(get_artifact_path('events', 'index_ids')).tolist()
+        self.assertEqual(sorted(Events.objects.values_list('id', flat=True)), sorted(index_ids))
+        self.check_rows(version)
+
+    def check_rows(self, version):
+        expected = recompute_similar_pairs('events')
+        rows = LdaSimilarity.objects.filter(item_type='events', version=str(version.id)).values_list('source', 'target', 'similarity')
+        pairs = {frozenset([int(source), int(target)]): float(similarity) for source, target, similarity in rows}
+        self.assertTrue(len(expected))
+        self.assertEqual(set(expected), set(pairs))
+        for pair, similarity in expected.items():
+            self.assertAlmostEqual(similarity, pairs[pair], places=5)
+
+    def test_incremental_rows_match_a_full_computation(self):
+        self.change_items()
+        ContentBasedRecommender.train_items_by_items('events', mode='incremental', backend='lda')
+        version = get_active_version('events')
+        self.assertEqual(('delta', None), (version.version_type, version.training_mode))
+        # 3 changed, 5 added, 2 removed
+        self.assertEqual(10, version.n_updated)
+        self.check_version(version)
+
+    def test_online_rows_match_a_full_computation(self):
+        self.change_items()
+        ContentBasedRecommender.train_items_by_items('events', mode='online', backend='lda')
+        version = get_active_version('events')
+        self.assertEqual(('delta', 'single'), (version.version_type, version.training_mode))
+        self.check_version(version)
+
+    def test_unknown_vocabulary_trains_again(self):
+        self.events[0].description = 'zzyzx quorble fnarp ' * 20
+        self.events[0].save()
+        ContentBasedRecommender.train_items_by_items('events', mode='incremental', backend='lda')
+        version = get_active_version('events')
+        self.assertEqual('full', version.version_type)
+        self.check_version(version)
+
+    def test_nothing_changed(self):
+        ContentBasedRecommender.train_items_by_items('events', mode='incremental', backend='lda')
+        self.assertEqual(self.full_version, get_active_version('events'))
+
+
+class TrainingJobTests(TestCase):
+
+    def test_one_active_job_per_item_type(self):
+        job, created = enqueue_training_job('events')
+        self.assertTrue(created)
+        self.assertEqual((job, False), enqueue_training_job('events', mode='incremental'))
+        self.assertTrue(enqueue_training_job('products')[1])
+        # A finished job does not hold the item type any more
+        claim_next_job('worker')
+        job.refresh_from_db()
+        finish_job(job, 'succeeded')
+        self.assertTrue(enqueue_training_job('events')[1])
+
+    def test_claim_the_oldest_queued_job(self):
+        first = enqueue_training_job('events')[0]
+        second = enqueue_training_job('products')[0]
+        job = claim_next_job('worker-1')
+        self.assertEqual((first.id, 'running', 'worker-1'), (job.id, job.status, job.worker))
+        self.assertIsNotNone(job.started_at)
+        self.assertEqual(second.id, claim_next_job('worker-2').id)
+        self.assertIsNone(claim_next_job('worker-3'))
+
+    def test_stale_running_job_is_replaced(self):
+        job = enqueue_training_job('events')[0]
+        job = claim_next_job('worker')
+        # Running jobs whose worker updates them are kept
+        self.assertEqual((job, False), enqueue_training_job('events'))
+        TrainingJob.objects.filter(id=job.id).update(updated_at=timezone.now() - datetime.timedelta(days=1))
+        new_job, created = enqueue_training_job('events')
+        self.assertTrue(created)
+        self.assertNotEqual(job.id, new_job.id)
+        job.refresh_from_db()
+        self.assertEqual(('failed', None), (job.status, job.active_key))
+        # The worker of the replaced job cannot finish it any more
+        self.assertEqual(0, finish_job(job, 'succeeded'))
+        self.assertEqual('failed', TrainingJob.objects.get(id=job.id).status)
+
+    def test_cancel_a_queued_job(self):
+        job = cancel_training_job(enqueue_training_job('events')[0].id)
+        self.assertEqual(('cancelled', None), (job.status, job.active_key))
+        self.assertIsNone(claim_next_job('worker'))
+
+    def test_cancel_a_running_job(self):
+        enqueue_training_job('events')
+        job = claim_next_job('worker')
+        self.assertTrue(cancel_training_job(job.id).cancel_requested)
+
+        def train(table_name, progress_callback=None, **options):
+            progress_callback('lda', 0.5)
+        with mock.patch.object(ContentBasedRecommender, 'train_items_by_items', side_effect=train):
+            run_job(job)
+        job.refresh_from_db()
+        self.assertEqual(('cancelled', 'lda', None), (job.status, job.stage, job.active_key))
+
+    def test_run_job(self):
+        enqueue_training_job('events')
+        job = claim_next_job('worker')
+        with mock.patch.object(ContentBasedRecommender, 'train_items_by_items') as train:
+            run_job(job)
+        self.assertEqual('events', train.call_args[1]['table_name'])
+        job.refresh_from_db()
+        self.assertEqual(('succeeded', 1, None), (job.status, job.progress, job.active_key))
+
+        enqueue_training_job('events')
+        job = claim_next_job('worker')
+        with mock.patch.object(ContentBasedRecommender, 'train_items_by_items', side_effect=ValueError('No data')):
+            with self.assertLogs('dimadb.training_jobs', 'ERROR'):
+                run_job(job)
+        job.refresh_from_db()
+        self.assertEqual(('failed', 'No data'), (job.status, job.message))
+
+
+# Top k storage: only the lists which can change are computed again, the others are copied
+@override_settings(LDA_SIMILARITY_STORAGE={'events': {'storage': 'top_k', 'k': 5}})
+class IncrementalTopKTrainingTests(IncrementalTrainingTests):
+
+    def check_rows(self, version):
+        self.assertEqual(5, version.top_k)
+        index = NeighbourIndex.load(get_artifact_path('events', 'index'), get_artifact_path('events', 'index_ids'))
+        ids = index.ids.tolist()
+        expected = {ids[source]: [ids[target] for target in targets]
+                    for source, targets in collect_top_k(self, iter_top_k(np.asarray(index.matrix), 5, LdaModelManager().SIMILARITY_THRESHOLD)).items()}
+        lists = {}
+        for source, target, rank in LdaNeighbour.objects.filter(version=version.id).order_by('source', 'rank').values_list('source', 'target', 'rank'):
+            lists.setdefault(source, []).append(target)
+            self.assertEqual(len(lists[source]) - 1, rank)
+        self.assertTrue(len(expected))
+        self.assertEqual(expected, lists)
+
+    def test_incremental_rows_match_a_full_computation(self):
+        super().test_incremental_rows_match_a_full_computation()
+        similarity_stage = LdaTrainingStage.objects.get(version=get_active_version('events'), stage='similarity')
+        self.assertLess(similarity_stage.n_rows, Events.objects.count())
+
+
+class TfidfBackendTests(TestCase):
+
+    def setUp(self):
+        use_temporary_model_dir(self)
+
+    @override_settings(SIMILARITY_BACKENDS={'events': 'tfidf'}, LDA_SIMILARITY_STORAGE={'events': {'storage': 'top_k', 'k': 3}})
+    def test_rank_similar_items(self):
+        events = create_events(['concert orchestre symphonie piano violon', 'orchestre symphonie piano concert chorale',
+                                'peinture sculpture exposition galerie', 'exposition galerie peinture vernissage',
+                                'concert jazz guitare'])
+        ContentBasedRecommender.train_items_by_items('events')
+        version = get_active_version('events')
+        self.assertEqual(('tfidf', 'top_k', 3), (version.backend, version.similarity_storage, version.top_k))
+
+        # Most similar first, only above the 0.3 threshold of the backend
+        ranked = ContentBasedRecommender.rank_batch_items_by_items('events', [events[0].id, events[2].id, events[4].id])
+        for records in ranked:
+            self.assertTrue(all(record['similarity_score'] >= TfidfBackend.recommend_threshold for record in records))
+            self.assertEqual(sorted([record['similarity_score'] for record in records], reverse=True),
+                             [record['similarity_score'] for record in records])
+        self.assertEqual(events[1].id, ranked[0][0]['id'])
+        self.assertEqual([events[3].id], [record['id'] for record in ranked[1]])
+
+    def test_pairs_storage_is_refused(self):
+        with self.assertRaises(ValueError):
+            TfidfModelManager().set_similarity_storage('pairs')
+
+
+class PageUrlTests(SimpleTestCase):
+
+    def test_normalize_url(self):
+        self.assertEqual('dici.ca/evenements/concert', normalize_url(' HTTPS://Dici.CA/evenements/concert/?utm_source=x#top '))
+        self.assertEqual(normalize_url('http://dici.ca/magazine/'), normalize_url('https://dici.ca/magazine'))
+
+    def test_parse_page_url(self):
+        self.assertEqual(('events', 'Item', ''), parse_page_url('https://dici.ca/evenements/concert/'))
+        self.assertEqual(('events', 'Homepage', ''), parse_page_url('https://dici.ca/evenements'))
+        self.assertEqual(('products', 'Homepage', ''), parse_page_url('https://dici.ca/magazine'))
+        self.assertEqual(('products', 'Homepage', ''), parse_page_url('https://dici.ca/magazine/tous-les-articles?page=2'))
+        self.assertEqual(('products', 'Domain', 'arts-visuels'), parse_page_url('https://dici.ca/magazine/arts-visuels/'))
+        self.assertEqual(('products', 'Item', ''), parse_page_url('https://dici.ca/magazine/arts-visuels/une-exposition'))
+        self.assertEqual(('', '', ''), parse_page_url('https://dici.ca/a-propos'))
+
+
+# The routing table of a process: built from the items, again only after the item urls changed
+class RoutingTableTests(TestCase):
+
+    def setUp(self):
+        self.events = create_events(['', ''])
+        self.routing_table = RoutingTable(check_interval=0)
+
+    def test_rebuilt_when_item_urls_change(self):
+        self.assertEqual(self.events[0].id, self.routing_table.get_item_id('events', self.events[0].url))
+        with mock.patch.object(self.routing_table, 'build', wraps=self.routing_table.build) as build:
+            # Web activities, trainings, date rolls
+            bump_data_version()
+            self.assertEqual(self.events[1].id, self.routing_table.get_item_id('events', self.events[1].url + '/'))
+            self.assertEqual(0, build.call_count)
+
+            Events.objects.filter(id=self.events[0].id).update(url='https://dici.ca/evenements/renamed', import_id='import')
+            views.refresh_imported_data('events', 'import')
+            self.assertEqual(self.events[0].id, self.routing_table.get_item_id('events', 'https://dici.ca/evenements/renamed'))
+            self.assertEqual(1, build.call_count)
+
+    # A url which is not in the table is looked up in the database once, the pages which are not items as well
+    def test_missed_urls_are_looked_up_once(self):
+        self.routing_table.get_item_id('events', self.events[0].url)
+        event = Events.objects.create(event_id='event-new', url='https://dici.ca/evenements/event-new')
+        for url, item_id in [(event.url, event.id), ('https://dici.ca/evenements/unknown', None)]:
+            with self.assertNumQueries(2):
+                self.assertEqual(item_id, self.routing_table.get_item_id('events', url))
+            with self.assertNumQueries(1):
+                self.assertEqual(item_id, self.routing_table.get_item_id('events', url))
+
+    # Another thread clears the missed urls right after this one found its url there
+    def test_missed_urls_cleared_by_another_thread(self):
+        class ClearedAfterCheck(dict):
+            def __contains__(self, key):
+                found = dict.__contains__(self, key)
+                self.clear()
+                return found
+
+        self.routing_table.get_item_id('events', self.events[0].url)
+        self.routing_table.missed_urls = ClearedAfterCheck({('events', 'https://dici.ca/a-propos'): None})
+        self.assertIsNone(self.routing_table.get_item_id('events', 'https://dici.ca/a-propos'))
+
+
+# The widget endpoint over similarities stored as pairs (LdaSimilarity rows, whose ids are strings), without
+# a neighbour index
+class RecommendationViewTests(TestCase):
+
+    def setUp(self):
+        model_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(model_dir.cleanup)
+        patcher = mock.patch('dimadb.lda_model_builder.model_dir', model_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        recommend_cache.clear()
+        routing_table.clear()
+        event_dates.last_rolled_at = None
+
+        now = timezone.now()
+        self.events = [Events.objects.create(event_id='event-%d' % index, event_name='Event %d' % index, event_type='Musique',
+                                             url='https://dici.ca/evenements/event-%d' % index) for index in range(4)]
+        for index, event in enumerate(self.events):
+            EventDate.objects.create(event_id=str(event.id), date=now + datetime.timedelta(days=index + 1))
+        refresh_next_dates()
+        version = LdaSimilarityVersion.objects.create(item_type='events', status='active', similarity_storage='pairs', backend='lda')
+        for source, target, similarity in [(0, 1, 0.95), (2, 0, 0.9), (0, 3, 0.1)]:
+            LdaSimilarity.objects.create(source=str(self.events[source].id), target=str(self.events[target].id), item_type='events',
+                                         similarity=similarity, version=str(version.id))
+        bump_data_version()
+
+    def get_recommendation(self, url, **headers):
+        return self.client.get('/dimadb/get-recommendation/', {'url': url}, HTTP_AUTHORIZATION='Bearer ' + views.API_KEY, **headers)
+
+    def test_similar_events_from_pairs(self):
+        response = self.get_recommendation(self.events[0].url)
+        self.assertEqual(200, response.status_code)
+        sections = json.loads(response.content)
+        self.assertEqual(['Similar'], [section['recommendType'] for section in sections])
+        # The most similar first, from either side of the pairs; not the upcoming events of the fallback
+        items = sections[0]['items']
+        self.assertEqual(['event-1', 'event-2'], [item['event_id'] for item in items])
+        self.assertEqual([0.95, 0.9], [item['similarity_score'] for item in items])
+
+    def test_batch_similar_events_from_pairs(self):
+        response = self.client.post('/dimadb/get-batch-recommendation/', json.dumps({'requests': [
+            {'url': self.events[0].url}, {'url': self.events[1].url, 'recommendType': 'Similar combined with Most popular'}]}),
+            content_type='application/json', HTTP_AUTHORIZATION='Bearer ' + views.API_KEY)
+        self.assertEqual(200, response.status_code)
+        pages = json.loads(response.content)
+        self.assertEqual(['event-1', 'event-2'], [item['event_id'] for item in pages[0]['recommendation'][0]['items']])
+        self.assertEqual(['event-0'], [item['event_id'] for item in pages[1]['recommendation'][0]['items']])
+
+    # The similar items of all the pages are read together: more pages do not make more queries
+    def test_batch_queries_do_not_grow_with_the_pages(self):
+        def count_queries(events):
+            recommend_cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post('/dimadb/get-batch-recommendation/', json.dumps({'requests': [{'url': event.url} for event in events]}),
+                                            content_type='application/json', HTTP_AUTHORIZATION='Bearer ' + views.API_KEY)
+            self.assertEqual(len(events), len(json.loads(response.content)))
+            return len(queries)
+
+        # The routing table is built by the first request
+        count_queries(self.events)
+        # (event-3 has no similar event: the upcoming events are read for it)
+        self.assertEqual(count_queries(self.events[:1]), count_queries(self.events[:3]))
+
+    # The async view answers the same sections, with all the queries of the request made by one call (one
+    # connection, closed once). The call runs in the thread of the test, which sees its transaction.
+    def test_async_view_answers_like_the_sync_view(self):
+        url = '/dimadb/async/get-recommendation/?' + urlencode({'url': self.events[0].url})
+        with mock.patch('dimadb.async_views.sync_to_async', lambda function, thread_sensitive: sync_to_async(function, thread_sensitive=True)), \
+                mock.patch('dimadb.async_views.close_old_connections') as close_old_connections:
+            response = async_to_sync(AsyncClient().get)(url, authorization='Bearer ' + views.API_KEY)
+        self.assertEqual(1, close_old_connections.call_count)
+        self.assertEqual(json.loads(self.get_recommendation(self.events[0].url).content), json.loads(response.content))
+
+    # One query for all the candidates, in the order of the ranked records; the records of removed items are dropped
+    def test_hydrate_items_with_one_query(self):
+        records = [{'id': str(self.events[2].id), 'similarity_score': 0.9}, {'id': 0, 'similarity_score': 0.5},
+                   {'id': self.events[1].id, 'similarity_score': 0.1}]
+        with self.assertNumQueries(1):
+            items = ContentBasedRecommender.hydrate_items('Events', records, ['event_id'])
+        self.assertEqual([(self.events[2].id, 'event-2', 0.9), (self.events[1].id, 'event-1', 0.1)],
+                         [(item['id'], item['event_id'], item['similarity_score']) for item in items])
+
+    # The same page is answered from the cache until the data changes
+    def test_cached_recommendation_is_invalidated_by_a_data_change(self):
+        self.get_recommendation(self.events[0].url)
+        hits = recommend_cache.stats()['hits']
+        self.get_recommendation(self.events[0].url)
+        self.assertEqual(hits + 1, recommend_cache.stats()['hits'])
+
+        LdaSimilarity.objects.filter(target=str(self.events[1].id)).delete()
+        items = json.loads(self.get_recommendation(self.events[0].url).content)[0]['items']
+        self.assertEqual(['event-1', 'event-2'], [item['event_id'] for item in items])
+        bump_data_version()
+        items = json.loads(self.get_recommendation(self.events[0].url).content)[0]['items']
+        self.assertEqual(['event-2'], [item['event_id'] for item in items])
+
+    def test_last_modified_advances_with_the_data_version(self):
+        last_modified = self.get_recommendation(self.events[0].url)['Last-Modified']
+        self.assertEqual(304, self.get_recommendation(self.events[0].url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code)
+
+        with mock.patch('django.utils.timezone.now', return_value=timezone.now() + datetime.timedelta(minutes=1)):
+            bump_data_version()
+        self.assertGreater(DataVersion.objects.get().updated_at, timezone.now())
+        response = self.get_recommendation(self.events[0].url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(last_modified, response['Last-Modified'])
+
+
+    # MySQL rejects an UPDATE whose WHERE reads the updated table (error 1093): the ids are read first
+    def test_next_dates_are_rolled_without_reading_the_updated_table(self):
+        passed_date = timezone.now() - datetime.timedelta(hours=1)
+        EventDate.objects.create(event_id=str(self.events[0].id), date=passed_date)
+        Events.objects.filter(id=self.events[0].id).update(next_date=passed_date)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(1, roll_next_dates())
+            refresh_next_dates(Events.objects.filter(event_type='Musique').values('id'))
+        updates = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertTrue(len(updates))
+        for sql in updates:
+            self.assertNotIn('IN (SELECT', sql.upper())
+        expected_dates = {event.id: EventDate.objects.filter(event_id=str(event.id), date__gte=timezone.now()).order_by('date').first().date
+                          for event in self.events}
+        self.assertEqual(expected_dates, dict(Events.objects.values_list('id', 'next_date')))
+
+    # An event whose next date passed since the last roll is shown with its following date
+    def test_passed_next_date_is_rolled_before_serving(self):
+        Events.objects.filter(id=self.events[1].id).update(next_date=timezone.now() - datetime.timedelta(hours=1))
+        items = json.loads(self.get_recommendation(self.events[0].url).content)[0]['items']
+        self.assertEqual(['event-1', 'event-2'], [item['event_id'] for item in items])
+
+# Popularity scores maintained when the interactions and the items are imported
+class PopularityTests(TestCase):
+
+    def setUp(self):
+        WebActivityType.objects.create(name='page_view', value=1)
+        WebActivityType.objects.create(name='add_to_cart', value=2.5)
+        self.products = [Products.objects.create(product_id='product-%d' % index, url='https://dici.ca/magazine/arts-visuels/product-%d' % index)
+                         for index in range(4)]
+        today = timezone.localdate()
+        Interaction_f.objects.bulk_create([Interaction_f(page_location=self.products[0].url, event_name='page_view', visit_date=today, import_id='file')
+                                           for index in range(3)] +
+                                          [Interaction_f(page_location=self.products[1].url, event_name='page_view', visit_date=today, import_id='file')])
+        Interaction_ga.objects.create(page_location=self.products[1].url, event_name='add_to_cart', date=today, event_count=2, import_id='ga')
+        # Without a weight, an activity counts 1
+        Interaction_ga.objects.create(page_location=self.products[2].url, event_name='scroll', date=today, event_count=4, import_id='ga')
+        refresh_import_popularity('interaction_f', 'file')
+        refresh_import_popularity('interaction_ga', 'ga')
+
+    def get_scores(self, item_type):
+        return dict(ItemPopularity.objects.filter(item_type=item_type).values_list('item_id', 'score'))
+
+    def test_weighted_score_of_the_imports(self):
+        self.assertEqual({self.products[0].id: 3, self.products[1].id: 6, self.products[2].id: 4}, self.get_scores('products'))
+
+        # Only the pages of a new import are aggregated again
+        Interaction_ga.objects.create(page_location=self.products[0].url, event_name='add_to_cart', date=timezone.localdate(), event_count=1, import_id='ga-2')
+        # The activity of a page whose item is imported later
+        Interaction_f.objects.create(page_location='https://dici.ca/magazine/arts-visuels/product-4', event_name='page_view', import_id='file-2')
+        with mock.patch('dimadb.popularity.refresh_item_popularity', wraps=refresh_item_popularity) as refresh:
+            refresh_import_popularity('interaction_ga', 'ga-2')
+        self.assertEqual([[self.products[0].id]], [call.args[1] for call in refresh.call_args_list])
+        refresh_import_popularity('interaction_f', 'file-2')
+        product = Products.objects.create(product_id='product-4', url='https://dici.ca/magazine/arts-visuels/product-4', import_id='products')
+        refresh_import_popularity('products', 'products')
+        self.assertEqual({self.products[0].id: 5.5, self.products[1].id: 6, self.products[2].id: 4, product.id: 1}, self.get_scores('products'))
+
+    # The most popular first, then the items without activity with a score of 0
+    def test_most_popular_is_completed_with_score_0(self):
+        items = views.get_most_popular('products', 5)
+        self.assertEqual([('product-1', 6), ('product-2', 4), ('product-0', 3), ('product-3', 0)],
+                         [(item['product_id'], item['popular_score']) for item in items])
+
+        # Only the events to come, completed with the upcoming ones
+        now = timezone.now()
+        events = create_events(['', '', ''])
+        for index, event in enumerate(events):
+            Events.objects.filter(id=event.id).update(next_date=now + datetime.timedelta(days=index + 1))
+        Events.objects.filter(id=events[2].id).update(next_date=now - datetime.timedelta(days=1))
+        PageActivity.objects.create(page_location=events[1].url, event_name='page_view', date=timezone.localdate(), event_count=2)
+        PageActivity.objects.create(page_location=events[2].url, event_name='page_view', date=timezone.localdate(), event_count=9)
+        refresh_item_popularity('events')
+        items = views.get_most_popular('events', 3)
+        self.assertEqual([('event-1', 2), ('event-0', 0)], [(item['event_id'], item['popular_score']) for item in items])
+
+    # Halved every half life of age; the activities out of the window are not counted
+    def test_trending_scores_decay(self):
+        today = datetime.date(2024, 3, 10)
+        PageActivity.objects.all().delete()
+        PageActivity.objects.bulk_create([
+            PageActivity(page_location='a', event_name='page_view', date=today, event_count=8),
+            PageActivity(page_location='a', event_name='add_to_cart', date=today - datetime.timedelta(days=2), event_count=4),
+            PageActivity(page_location='b', event_name='page_view', date=today - datetime.timedelta(days=4), event_count=16),
+            PageActivity(page_location='c', event_name='page_view', date=today - datetime.timedelta(days=7), event_count=100),
+            PageActivity(page_location='d', event_name='page_view', date=today + datetime.timedelta(days=1), event_count=100)])
+        scores = get_trending_scores(7, 2, today)
+        self.assertEqual({'a', 'b'}, set(scores))
+        self.assertAlmostEqual(8 + 4 * 2.5 / 2, scores['a'])
+        self.assertAlmostEqual(16 / 4, scores['b'])
+        self.assertEqual({}, get_trending_scores(7, 2, today - datetime.timedelta(days=30)))
+
+    # More recent activities rank an item above one with more, older activities
+    @override_settings(TRENDING_WINDOW_DAYS=7, TRENDING_HALF_LIFE_DAYS=2)
+    def test_trending_items_are_ranked_by_decayed_score(self):
+        today = timezone.localdate()
+        PageActivity.objects.all().delete()
+        PageActivity.objects.bulk_create([
+            PageActivity(page_location=self.products[0].url, event_name='page_view', date=today - datetime.timedelta(days=4), event_count=10),
+            PageActivity(page_location=self.products[1].url, event_name='page_view', date=today, event_count=3),
+            PageActivity(page_location=self.products[2].url, event_name='page_view', date=today - datetime.timedelta(days=10), event_count=100)])
+        items = views.get_trending('products', 3)
+        self.assertEqual(['product-1', 'product-0'], [item['product_id'] for item in items])
+        self.assertAlmostEqual(2.5, items[1]['trending_score'])
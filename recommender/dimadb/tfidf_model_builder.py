@@ -0,0 +1,67 @@
+from gensim.matutils import corpus2csc
+from gensim.models import TfidfModel
+
+from dimadb.models import LdaSimilarityVersion, LdaNeighbour
+from dimadb.lda_model_builder import LdaModelManager, SimilarityWriter, get_artifact_path
+from dimadb.similarity_engine import iter_sparse_top_k
+import numpy as np
+
+
+# Sparse TF-IDF cosine similarities. The preprocessing, the corpus, the artifact versions and the similarity
+# writes are the ones of the LDA manager; only the model and the comparison of the documents differ.
+class TfidfModelManager(LdaModelManager):
+
+    def __init__(self, min_sim=0.1, progress_callback=None):
+        super().__init__(min_sim=min_sim, progress_callback=progress_callback)
+        self.TRAINING_MODE = None
+        self.SIMILARITY_THRESHOLD = 0.1 # TF-IDF cosines are lower than the LDA ones
+        self.SIMILARITY_BLOCK_SIZE = 256 # Rows per sparse product
+        self.SIMILARITY_STORAGE = 'top_k' # All the pairs of a sparse matrix are never stored
+
+    def set_similarity_storage(self, storage, k=20):
+        if storage != 'top_k':
+            raise ValueError('The TF-IDF backend only stores the top k neighbours, not: ' + str(storage))
+        self.TOP_K = k
+
+    # Training is cheap: the changes are applied by training again
+    def update_model(self, table_name, online_update=False):
+        return self.train_model(table_name=table_name)
+
+    def build_model(self, descriptions, n_topics, table_name):
+        texts, dictionary, corpus = self.prepare_corpus(descriptions, table_name)
+        ids = texts.ids
+
+        self.report_progress('tfidf')
+        self.telemetry.record(n_rows=len(ids), vocabulary_size=len(dictionary))
+        tfidf_model = TfidfModel(corpus, id2word=dictionary)
+        # Documents x terms, the rows are normalized by the TF-IDF model
+        matrix = corpus2csc(tfidf_model[corpus], num_terms=len(dictionary), num_docs=len(ids), dtype=np.float32).T.tocsr()
+
+        self.report_progress('saving')
+        tfidf_model.save(get_artifact_path(table_name, 'tfidf', self.artifact_dir))
+        dictionary.save(get_artifact_path(table_name, 'dictionary', self.artifact_dir))
+        version = LdaSimilarityVersion.objects.create(
+            n_products=len(ids),
+            item_type=table_name,
+            similarity_storage=self.SIMILARITY_STORAGE,
+            top_k=self.TOP_K,
+            backend='tfidf',
+            data_cutoff=self.data_cutoff
+        )
+        self.save_sparse_similarity(matrix, ids, table_name, version)
+
+    # Write the top k neighbours of each document, then make the version the active one
+    def save_sparse_similarity(self, matrix, ids, table_name, version):
+        self.report_progress('similarity')
+        self.telemetry.record(n_rows=len(ids), pairs_evaluated=len(ids) * (len(ids) - 1))
+        writer = SimilarityWriter(self.SIMILARITY_WRITE_BATCH_SIZE)
+        for sources, targets, sims, ranks in iter_sparse_top_k(matrix, self.TOP_K, self.SIMILARITY_THRESHOLD, self.SIMILARITY_BLOCK_SIZE):
+            self.report_progress('similarity', float(sources[0]) / len(ids))
+            for source_index, target_index, sim, rank in zip(sources.tolist(), targets.tolist(), sims.tolist(), ranks.tolist()):
+                writer.add(LdaNeighbour(version=version.id, item_type=table_name, source=ids[source_index], target=ids[target_index],
+                                        rank=rank, similarity=sim))
+
+        self.report_progress('writing')
+        writer.flush()
+        self.telemetry.record(rows_written=writer.n_written)
+        self.activate_version(version, table_name)
@@ -0,0 +1,54 @@
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from gensim import corpora, models
+from gensim.models import CoherenceModel
+import numpy as np
+
+# The candidates are trained in worker processes: this module must not depend on Django.
+
+
+# Train one candidate number of topics from the shared corpus/dictionary files and score it
+def train_candidate(n_topics, corpus_path, dictionary_path, texts_path, output_dir, coherence, chunksize, passes, dtype=np.float64):
+    start = time.perf_counter()
+    corpus = corpora.MmCorpus(corpus_path)
+    dictionary = corpora.Dictionary.load(dictionary_path)
+    model = models.ldamodel.LdaModel(corpus=corpus, id2word=dictionary, num_topics=n_topics, random_state=100,
+                                     chunksize=chunksize, passes=passes, dtype=dtype)
+    training_seconds = time.perf_counter() - start
+
+    if coherence == 'u_mass':
+        coherence_model = CoherenceModel(model=model, corpus=corpus, dictionary=dictionary, coherence='u_mass')
+    else:
+        with open(texts_path) as texts_file:
+            texts = [line.split() for line in texts_file]
+        coherence_model = CoherenceModel(model=model, texts=texts, dictionary=dictionary, coherence=coherence, processes=1)
+    score = coherence_model.get_coherence()
+
+    model_path = os.path.join(output_dir, 'model_' + str(n_topics) + '.lda')
+    model.save(model_path)
+
+    return {
+        'n_topics': n_topics,
+        'coherence': None if math.isnan(score) else float(score),
+        'training_seconds': training_seconds,
+        'model_path': model_path,
+    }
+
+
+def run_topic_sweep(candidates, corpus_path, dictionary_path, texts_path, output_dir, coherence='u_mass',
+                    processes=None, chunksize=2000, passes=1, dtype=np.float64):
+    n = len(candidates)
+    with ProcessPoolExecutor(max_workers=processes or min(n, os.cpu_count() or 1)) as executor:
+        return list(executor.map(train_candidate, candidates, [corpus_path] * n, [dictionary_path] * n, [texts_path] * n,
+                                 [output_dir] * n, [coherence] * n, [chunksize] * n, [passes] * n, [dtype] * n))
+
+
+# The best candidate has the highest coherence (for u_mass and c_v alike)
+def select_best_candidate(results):
+    scored = [result for result in results if result['coherence'] is not None]
+    if len(scored) == 0:
+        return None
+    return max(scored, key=lambda result: result['coherence'])
@@ -0,0 +1,141 @@
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+from .models import TrainingJob
+from .content_based_recommender import ContentBasedRecommender
+import datetime
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TrainingCancelled(Exception):
+    pass
+
+
+# Queue a training job; if one is already queued or running for the same item type, return it instead
+def enqueue_training_job(item_type, mode='full', params=None):
+    for attempt in range(2):
+        try:
+            with transaction.atomic():
+                return TrainingJob.objects.create(item_type=item_type, mode=mode, params=json.dumps(params or {}), active_key=item_type), True
+        except IntegrityError:
+            job = TrainingJob.objects.filter(active_key=item_type).first()
+            if (job is None):
+                continue
+            # A running job whose worker stopped its heartbeat is considered dead and replaced
+            stale_before = timezone.now() - datetime.timedelta(seconds=settings.TRAINING_JOB_STALE_SECONDS)
+            if (job.status == 'running' and job.updated_at < stale_before):
+                finish_job(job, 'failed', 'The worker stopped updating the job')
+                continue
+            return job, False
+    raise IntegrityError('Could not enqueue the training job of ' + item_type)
+
+
+def cancel_training_job(job_id):
+    job = TrainingJob.objects.get(id=job_id)
+    # A queued job is cancelled right away, a running one stops at its next progress report
+    if (TrainingJob.objects.filter(id=job_id, status='queued').update(status='cancelled', active_key=None, finished_at=timezone.now())):
+        job.refresh_from_db()
+    elif (job.status == 'running'):
+        TrainingJob.objects.filter(id=job_id).update(cancel_requested=True)
+        job.refresh_from_db()
+    return job
+
+
+# Only the running job of its worker is finished: a job already replaced as dead keeps its status
+def finish_job(job, status, message=None):
+    return TrainingJob.objects.filter(id=job.id, status='running', worker=job.worker).update(
+        status=status, message=message, active_key=None, finished_at=timezone.now(), updated_at=timezone.now())
+
+
+# Keeps updated_at of a running job recent while the training runs stages which report no progress (LDA fit)
+class JobHeartbeat(threading.Thread):
+
+    def __init__(self, job, interval):
+        super().__init__(daemon=True)
+        self.job = job
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while (not self.stopped.wait(self.interval)):
+                TrainingJob.objects.filter(id=self.job.id, status='running', worker=self.job.worker).update(updated_at=timezone.now())
+        finally:
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+# Reports the progress of a job to the database and stops the training when a cancellation is requested
+class JobProgress(object):
+
+    def __init__(self, job, min_interval=1.0):
+        self.job = job
+        self.min_interval = min_interval
+        self.last_stage = None
+        self.last_report = 0
+
+    def __call__(self, stage, progress=0):
+        now = time.monotonic()
+        # Always write stage changes, throttle the progress updates inside a stage
+        if (stage == self.last_stage and now - self.last_report < self.min_interval):
+            return
+        self.last_stage = stage
+        self.last_report = now
+
+        TrainingJob.objects.filter(id=self.job.id).update(stage=stage, progress=progress, updated_at=timezone.now())
+        if (TrainingJob.objects.filter(id=self.job.id, cancel_requested=True).exists()):
+            raise TrainingCancelled()
+
+
+# Take the oldest queued job; the conditional update makes sure only one worker gets it
+def claim_next_job(worker_name):
+    for job in TrainingJob.objects.filter(status='queued').order_by('created_at')[:5]:
+        claimed = TrainingJob.objects.filter(id=job.id, status='queued').update(
+            status='running', worker=worker_name, started_at=timezone.now(), updated_at=timezone.now())
+        if (claimed):
+            job.refresh_from_db()
+            return job
+    return None
+
+
+def run_job(job):
+    heartbeat = JobHeartbeat(job, settings.TRAINING_JOB_HEARTBEAT_SECONDS)
+    heartbeat.start()
+    try:
+        params = json.loads(job.params or '{}')
+        ContentBasedRecommender.train_items_by_items(table_name=job.item_type, mode=job.mode, progress_callback=JobProgress(job),
+                                                     training_options=params.get('trainingOptions'), sweep_options=params.get('sweepOptions'),
+                                                     backend=params.get('backend'))
+        TrainingJob.objects.filter(id=job.id).update(progress=1)
+        finish_job(job, 'succeeded')
+    except TrainingCancelled:
+        job.refresh_from_db()
+        finish_job(job, 'cancelled', 'Cancelled during ' + str(job.stage or 'training'))
+    except Exception as error:
+        logger.exception('Training job %s failed', job.id)
+        finish_job(job, 'failed', str(error))
+    finally:
+        heartbeat.stop()
+
+
+def run_worker(poll_interval=5, once=False):
+    worker_name = socket.gethostname() + ':' + str(os.getpid())
+    while True:
+        job = claim_next_job(worker_name)
+        if (job is not None):
+            logger.info('Training job %s: %s, %s', job.id, job.item_type, job.mode)
+            run_job(job)
+        elif (once):
+            return
+        else:
+            time.sleep(poll_interval)
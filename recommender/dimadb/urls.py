@@ -1,6 +1,7 @@
 from multiprocessing import synchronize
 from django.urls import path
 from .views import *
+from .async_views import get_recommendation_async, get_list_recommend_async, get_batch_recommendation_async
 
 urlpatterns = [
     path('home/', home),
@@ -17,8 +18,17 @@ urlpatterns = [
     path('get-reports/', get_reports),
     path('delete-multiple-items/<item_type>/<pk>/', delete_imported_items),
     path('train-similar-recommend/', train_similar_recommend),
+    path('list-training-jobs/', list_training_jobs),
+    path('get-training-job/<pk>/', get_training_job),
+    path('cancel-training-job/<pk>/', cancel_training_job_view),
     path('update-activity-weight/', update_activity_weight),
+    path('get-recommend-cache-stats/', get_recommend_cache_stats),
     path('synchronize-google-analytic/', synchronize_google_analytic),
     path('get-synchronize-end-date/', get_synchronize_end_date),
     path('get-recommendation/', get_recommendation),
+    path('get-batch-recommendation/', get_batch_recommendation),
+    # Async versions of the widget endpoints, for an ASGI server
+    path('async/get-recommendation/', get_recommendation_async),
+    path('async/get-list-recommend/', get_list_recommend_async),
+    path('async/get-batch-recommendation/', get_batch_recommendation_async),
 ]
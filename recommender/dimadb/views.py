@@ -2,15 +2,26 @@ from rest_framework import permissions, status
 from rest_framework.decorators import api_view, authentication_classes, permission_classes
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from datetime import date, datetime, timedelta
+from datetime import date, timedelta
 from django.forms.models import model_to_dict
 from django.db.models import Q, Count, F, Sum
 from django.db.models.functions import TruncWeek, TruncMonth, TruncYear
 from django.apps import apps
+from django.conf import settings
 from django.core.files.storage import default_storage
+from django.core.exceptions import ObjectDoesNotExist
+from django.utils import timezone
 from .serializers import *
 from .models import *
 from .content_based_recommender import ContentBasedRecommender
+from .lda_model_builder import get_active_version
+from .training_jobs import enqueue_training_job, cancel_training_job
+from .popularity import get_trending_scores, iter_chunks, popularity_item_types, refresh_item_popularity, refresh_page_activity, refresh_page_popularity, \
+    refresh_import_popularity, get_import_page_locations, rebuild_popularity
+from .event_dates import refresh_next_dates, roll_stale_next_dates
+from .routing_table import routing_table, parse_page_url
+from .recommend_cache import ITEM_URLS_DATA, recommend_cache, bump_data_version, get_data_version, get_data_validators, \
+    get_not_modified_response, set_http_cache_headers
 from .utils import *
 from pathlib import Path
 from google.analytics.data_v1beta import BetaAnalyticsDataClient
@@ -20,7 +31,6 @@ from google.analytics.data_v1beta.types import Metric
 from google.analytics.data_v1beta.types import RunReportRequest
 from apiclient.discovery import build
 from oauth2client.service_account import ServiceAccountCredentials
-from slugify import slugify
 
 import pandas as pd
 import random
@@ -179,6 +189,8 @@ class ItemDetail(APIView):
         try:
             item_form = json.loads(request.body)
             update_item_info(item_form)
+            refresh_edited_item(item_form)
+            bump_data_version()
             return Response({'message': 'Update successfully'}, status=status.HTTP_200_OK)
         except Exception as exception:
             return Response({'message': exception})
@@ -188,6 +200,8 @@ class ItemDetail(APIView):
         try:
             item_form = json.loads(request.body)
             delete_item_info(item_form)
+            refresh_edited_item(item_form)
+            bump_data_version()
             return Response({'message': 'Delete successfully'}, status=status.HTTP_200_OK)
         except Exception as exception:
             return Response({'message': exception})
@@ -197,11 +211,41 @@ class ItemDetail(APIView):
         try:
             item_form = json.loads(request.body)
             update_item_info(item_form)
+            refresh_edited_item(item_form)
+            bump_data_version()
             return Response({'message': 'Create successfully'}, status=status.HTTP_200_OK)
         except Exception as exception:
             return Response({'message': exception})
 
 
+# Popularity (the url of an edited item may be the page of web activities), next date and routing table of an
+# edited item
+def refresh_edited_item(item_form):
+    if (item_form['name'] in popularity_item_types):
+        bump_data_version(ITEM_URLS_DATA)
+        obj_id = pydash.get(item_form, 'attributes.id.value')
+        url = pydash.get(item_form, 'attributes.url.value')
+        if (obj_id):
+            item_ids = [obj_id]
+        else:
+            # New item: its id is not in the form
+            Model = apps.get_model(app_label='dimadb', model_name=item_form['name'])
+            item_ids = list(Model.objects.filter(url=url).values_list('id', flat=True)) if url else []
+        refresh_item_popularity(item_form['name'], item_ids)
+        if (item_form['name'] == 'events'):
+            refresh_next_dates(item_ids)
+
+
+# Data derived from the rows of an import: popularity of the items and of the pages, next date of the events,
+# routing table of the items
+def refresh_imported_data(model_name, import_id):
+    refresh_import_popularity(model_name, import_id)
+    if (model_name in popularity_item_types):
+        bump_data_version(ITEM_URLS_DATA)
+    if (model_name == 'events'):
+        refresh_next_dates(Events.objects.filter(import_id=import_id).values('id'))
+
+
 # Get data(row) from a table(model)
 def get_model_object(model_name, pk):
     if (pk != 'form'):
@@ -334,6 +378,9 @@ def update_item_info(form_info, connected_field1_id=None):
             connected_field2_id = new_obj.id
             create_connected_object(form_info['connectedAttributes'], connected_field1_id, connected_field2_id)
     elif (status == 'created'):     # If info updated
+        # update() bypasses auto_now, refresh it so incremental training sees the change
+        if (hasattr(Model, 'modified_at')):
+            obj_info['modified_at'] = timezone.now()
         Model.objects.filter(id=obj_id).update(**obj_info)
         updated_obj = Model.objects.get(id=obj_id)
         update_multiple_items('m2m', form_info['attributes'], updated_obj.id)
@@ -445,6 +492,7 @@ def create_connected_object(form_info, connected_field1_id, connected_field2_id)
 
 #Mapping data in file with data model
 def mapping_data(data, template, source_name):
+    import_info = None
     try:
         total = 0   # Total object rows in imported data
         count = 0   # Total object rows saved in database
@@ -532,10 +580,14 @@ def mapping_data(data, template, source_name):
                                     new_o2m_obj.save()
 
                 count += 1
+            # Daily page activity and popularity of the imported interactions or items, next dates of the events
+            refresh_imported_data(template['model_name'], import_info.id)
             return {'message': 'Import successfully' + '.\n' + 'Import ' + str(count) + '/' + str(total) + 'object(s).'}
         else:
             return {'message': 'Wrong json format'}
     except Exception as error:
+        if (import_info is not None):
+            refresh_imported_data(template['model_name'], import_info.id)
         return {'message':  'There is an error(duplication, ...).\n' + 'Import ' + str(count) + '/' + str(total) + 'object(s).'}
 
 
@@ -611,6 +663,7 @@ def import_json_file(request, item_type):
 
         #Mapping and saving in database
         mapping_result = mapping_data(json_data, template, file.name)
+        bump_data_version()
         return Response(mapping_result, status=status.HTTP_200_OK)
     except Exception as error:
         return Response({'message': error})
@@ -655,6 +708,7 @@ def import_api(request, item_type):
         # Import
         mapping_template = get_json_info(mapping_template_file_path, item_type + '.' + template_type)
         mapping_result = mapping_data(response_data, mapping_template, url)
+        bump_data_version()
 
         return Response(mapping_result, status=status.HTTP_200_OK)
     except Exception as error:
@@ -688,10 +742,22 @@ def delete_imported_items(request, item_type, pk):
             "google-analytic-report": ["interaction_ga"]
         }
 
+        # Pages whose activity is removed
+        page_locations = set()
+        for table in tables[item_type]:
+            page_locations |= get_import_page_locations(table, pk)
         for table in tables[item_type]:
             Model = apps.get_model(app_label='dimadb', model_name=table)
+            if (table in popularity_item_types):
+                ItemPopularity.objects.filter(item_type=table, item_id__in=Model.objects.filter(import_id=pk).values('id')).delete()
             Model.objects.filter(import_id=pk).delete()
         ImportInfo.objects.filter(id=pk).delete()
+        if (len(page_locations)):
+            refresh_page_activity(page_locations)
+            refresh_page_popularity(page_locations)
+        if (len(set(tables[item_type]) & set(popularity_item_types))):
+            bump_data_version(ITEM_URLS_DATA)
+        bump_data_version()
         
         return Response({}, status=status.HTTP_200_OK)
     except Exception as error:
@@ -720,6 +786,19 @@ recommend_display_fields = {
             'products': ['product_id', 'product_name', 'product_type', 'url', 'img']
         }
 
+# Display fields which are columns of the item table
+def get_display_model_fields(Model, display_fields):
+    model_fields = [field.name for field in Model._meta.concrete_fields]
+    return [field for field in display_fields if field in model_fields]
+
+
+# Next date to come of each event, with one query: {event id: date}; the events without one are left out
+def get_next_dates(event_ids):
+    if (len(event_ids) == 0):
+        return {}
+    return dict(Events.objects.filter(id__in=event_ids, next_date__gte=timezone.now()).values_list('id', 'next_date'))
+
+
 # Get upcoming recommendation
 def get_upcoming(table_name, quantity=1, domain=None):
     Model = apps.get_model(app_label='dimadb', model_name=table_name)
@@ -734,72 +813,26 @@ def get_upcoming(table_name, quantity=1, domain=None):
             filter_params['product_type'] = domain
 
     list_objs = Model.objects.filter(Q(**filter_params))
-    list_objs = [model_to_dict(obj) for obj in list(list_objs)]
-    
+    # Events to come, soonest first: one query on the indexed next date, limited by the database
     if (table_name == 'events'):
-        list_filtered_obj = []
-        today = datetime.today()
-        EventDateModel = apps.get_model(app_label='dimadb', model_name='eventdate')
-        for obj in list_objs:
-            list_event_dates = EventDateModel.objects.filter(event_id=obj['id'], date__gte=today).order_by('date')
-            list_event_dates = [model_to_dict(obj) for obj in list(list_event_dates)]
-            if (len(list_event_dates)):
-                obj['next_date'] = list_event_dates[0]['date']
-                list_filtered_obj.append(obj)
-        if (len(list_filtered_obj)):   
-            list_objs = sorted(list_filtered_obj, key=lambda x: x['next_date'])
-        else:
-            list_objs = []
+        list_objs = list_objs.filter(next_date__gte=timezone.now()).order_by('next_date', 'id')
+    else:
+        list_objs = list_objs.order_by('id')
+    list_objs = list_objs.values(*get_display_model_fields(Model, display_fields))[:int(quantity)]
         
-    for i in range(0, int(quantity)):
-        if (i < len(list_objs)):
-            obj = list_objs[i]
-            recommend_item = {}
-            for field in list(display_fields):
-                recommend_item[field] = obj[field]
-            list_recommend_items.append(recommend_item)
+    for obj in list_objs:
+        recommend_item = {}
+        for field in list(display_fields):
+            recommend_item[field] = obj[field]
+        list_recommend_items.append(recommend_item)
 
     return list_recommend_items
 
-# Get most popular recommendation
-def order_by_score(table_name, list_objs):
-    if (len(list_objs)): 
-        list_interactions_f = Interaction_f.objects.filter(page_location__in=[obj['url'] for obj in list_objs])
-        list_interactions_f = [model_to_dict(obj) for obj in list_interactions_f]
-        if (len(list_interactions_f)):
-            list_interactions_f = pd.DataFrame(list_interactions_f).groupby(['page_location', 'event_name'], as_index=False)['id'].count().rename(columns={'id':'event_count'}).to_dict('r')
-        
-        list_interactions_ga = list(Interaction_ga.objects.filter(page_location__in=[obj['url'] for obj in list_objs]).values('page_location', 'event_name', 'event_count'))
-        list_interactions = list_interactions_f + list_interactions_ga
-        if (len(list_interactions)):
-            list_interactions = pd.DataFrame(list_interactions).groupby(['page_location', 'event_name'], as_index=False).sum().to_dict('r')
-    
-    list_objs_weight = {}
-    for interaction in list_interactions:
-        page_location = interaction['page_location']
-        event_name = interaction['event_name']
-        event_count = interaction['event_count']
-        activity_weight = 0
-        try:
-            activity_type_info = model_to_dict(WebActivityType.objects.get(name=event_name)) 
-            activity_weight = activity_type_info['value']       
-        except:
-            activity_weight = 1
-        if page_location not in list_objs_weight:
-            list_objs_weight[page_location] = 0
-        list_objs_weight[page_location] += event_count * activity_weight
-
-    
-    for obj in list_objs:
-        if obj['url'] in list_objs_weight: 
-            obj['popular_score'] = list_objs_weight[obj['url']]
-        else:
-            obj['popular_score'] = 0
-    if (len(list_objs)):   
-        list_objs = sorted(list_objs, key=lambda d: d['popular_score'], reverse=True)
-    else:
-        list_objs = []
-    return list_objs
+# Materialised popularity scores of some items: {item id: score}, the items without web activities are left out
+def get_popularity_scores(table_name, item_ids):
+    if (len(item_ids) == 0):
+        return {}
+    return dict(ItemPopularity.objects.filter(item_type=table_name, item_id__in=list(item_ids)).values_list('item_id', 'score'))
 
 # Get most popular recommendation
 def get_most_popular(table_name, quantity=1, domain=None):
@@ -807,7 +840,7 @@ def get_most_popular(table_name, quantity=1, domain=None):
     display_fields = recommend_display_fields[table_name]
     list_recommend_items = []
     filter_params = {}
-    list_interactions = []
+    quantity = int(quantity)
 
     if (domain is not None):
         if (table_name == 'events'):
@@ -815,127 +848,160 @@ def get_most_popular(table_name, quantity=1, domain=None):
         elif (table_name == 'products'):
             filter_params['product_type'] = domain
 
-    list_objs = Model.objects.filter(Q(**filter_params))
-    list_objs = [model_to_dict(obj) for obj in list(list_objs)]
-    # list_objs = order_by_score(table_name, list_objs)
-    
+    # Indexed ORDER BY score ... LIMIT on the materialised scores (of the events to come)
+    list_items = Model.objects.filter(Q(**filter_params))
     if (table_name == 'events'):
-        list_filtered_obj = []
-        today = datetime.today()
-        EventDateModel = apps.get_model(app_label='dimadb', model_name='eventdate')
-        for obj in list_objs:
-            list_event_dates = EventDateModel.objects.filter(event_id=obj['id'], date__gte=today).order_by('date')
-            list_event_dates = [model_to_dict(obj) for obj in list(list_event_dates)]
-            if (len(list_event_dates)):
-                obj['next_date'] = list_event_dates[0]['date']
-                list_filtered_obj.append(obj)
-        if (len(list_filtered_obj)):        
-            list_objs = sorted(list_filtered_obj, key=lambda x: x['next_date'])
-        else:
-            list_objs = []
-        
-    list_objs = order_by_score(table_name, list_objs)
-    # if (len(list_objs)): 
-    #     list_interactions_f = Interaction_f.objects.filter(page_location__in=[obj['url'] for obj in list_objs])
-    #     list_interactions_f = [model_to_dict(obj) for obj in list_interactions_f]
-    #     if (len(list_interactions_f)):
-    #         list_interactions_f = pd.DataFrame(list_interactions_f).groupby(['page_location', 'event_name'], as_index=False)['id'].count().rename(columns={'id':'event_count'}).to_dict('r')
-        
-    #     list_interactions_ga = list(Interaction_ga.objects.filter(page_location__in=[obj['url'] for obj in list_objs]).values('page_location', 'event_name', 'event_count'))
-    #     list_interactions = list_interactions_f + list_interactions_ga
-    #     if (len(list_interactions)):
-    #         list_interactions = pd.DataFrame(list_interactions).groupby(['page_location', 'event_name'], as_index=False).sum().to_dict('r')
-    
-    # list_objs_weight = {}
-    # for interaction in list_interactions:
-    #     page_location = interaction['page_location']
-    #     event_name = interaction['event_name']
-    #     event_count = interaction['event_count']
-    #     activity_weight = 0
-    #     try:
-    #         activity_type_info = model_to_dict(WebActivityType.objects.get(name=event_name)) 
-    #         activity_weight = activity_type_info['value']       
-    #     except:
-    #         activity_weight = 1
-    #     if page_location not in list_objs_weight:
-    #         list_objs_weight[page_location] = 0
-    #     list_objs_weight[page_location] += event_count * activity_weight
+        list_items = list_items.filter(next_date__gte=timezone.now())
+    list_popularity = ItemPopularity.objects.filter(item_type=table_name, item_id__in=list_items.values('id')).order_by('-score', 'item_id')
+    list_objs = [{'id': item_id, 'popular_score': score} for item_id, score in list_popularity.values_list('item_id', 'score')[:quantity]]
+    list_objs = ContentBasedRecommender.hydrate_items(table_name, list_objs, get_display_model_fields(Model, display_fields))
 
-    
-    # for obj in list_objs:
-    #     if obj['url'] in list_objs_weight: 
-    #         obj['popular_score'] = list_objs_weight[obj['url']]
-    #     else:
-    #         obj['popular_score'] = 0
-    # if (len(list_objs)):   
-    #     list_objs = sorted(list_objs, key=lambda d: d['popular_score'], reverse=True)
-    # else:
-    #     list_objs = []
-    
-    for i in range(0, int(quantity)):
-        if (i < len(list_objs)):
-            obj = list_objs[i]
-            recommend_item = {}
-            for field in list(display_fields):
-                recommend_item[field] = obj[field]
-            recommend_item['popular_score'] = obj['popular_score']
-            list_recommend_items.append(recommend_item)
+    for obj in list_objs:
+        recommend_item = {}
+        for field in list(display_fields):
+            recommend_item[field] = obj[field]
+        recommend_item['popular_score'] = obj['popular_score']
+        list_recommend_items.append(recommend_item)
+
+    # Items without web activities complete the list (upcoming events first)
+    if (len(list_recommend_items) < quantity):
+        urls = set([item['url'] for item in list_recommend_items])
+        if (table_name == 'events'):
+            list_objs = get_upcoming(table_name, quantity + len(list_recommend_items), domain)
+        else:
+            list_objs = list(Model.objects.filter(Q(**filter_params)).exclude(id__in=list_popularity.values('item_id'))
+                             .order_by('id').values(*display_fields)[:quantity - len(list_recommend_items)])
+        for obj in list_objs:
+            if (obj['url'] not in urls and len(list_recommend_items) < quantity):
+                obj['popular_score'] = 0
+                list_recommend_items.append(obj)
             
     if (len(list_recommend_items) == 0):
         list_recommend_items = get_upcoming(table_name, quantity)
     return list_recommend_items
 
 
+# Get trending recommendation: popularity of the recent web activities, the older ones counting less
+def get_trending(table_name, quantity=1, domain=None):
+    Model = apps.get_model(app_label='dimadb', model_name=table_name)
+    display_fields = recommend_display_fields[table_name]
+    list_recommend_items = []
+    filter_params = {}
+    quantity = int(quantity)
+
+    if (domain is not None):
+        if (table_name == 'events'):
+            filter_params['event_type'] = domain
+        elif (table_name == 'products'):
+            filter_params['product_type'] = domain
+    if (table_name == 'events'):
+        filter_params['next_date__gte'] = timezone.now()
+
+    # Items of the pages active during the window
+    scores = get_trending_scores(settings.TRENDING_WINDOW_DAYS, settings.TRENDING_HALF_LIFE_DAYS)
+    list_objs = []
+    for page_locations in iter_chunks(scores):
+        list_items = Model.objects.filter(Q(**filter_params), url__in=page_locations).values_list('id', 'url')
+        list_objs += [{'id': item_id, 'trending_score': scores[url]} for item_id, url in list_items]
+    list_objs = sorted(list_objs, key=lambda obj: (-obj['trending_score'], obj['id']))[:quantity]
+    list_objs = ContentBasedRecommender.hydrate_items(table_name, list_objs, get_display_model_fields(Model, display_fields))
+
+    for obj in list_objs:
+        recommend_item = {}
+        for field in list(display_fields):
+            recommend_item[field] = obj[field]
+        recommend_item['trending_score'] = obj['trending_score']
+        list_recommend_items.append(recommend_item)
+
+    # No recent activity: the all-time popularity
+    if (len(list_recommend_items) == 0):
+        list_recommend_items = get_most_popular(table_name, quantity, domain)
+    return list_recommend_items
+
+
+# Id of the item of a page from the routing table
+def get_item_id(table_name, item_url):
+    item_id = routing_table.get_item_id(table_name, item_url)
+    if (item_id is None):
+        Model = apps.get_model(app_label='dimadb', model_name=table_name)
+        raise Model.DoesNotExist('%s matching query does not exist.' % Model._meta.object_name)
+    return item_id
+
+
 # Get similarity recommendation
 def get_similar(table_name, quantity=1, item_url=None, recommend_type=None):
+    return get_similar_batch(table_name, [(quantity, get_item_id(table_name, item_url), recommend_type)])[0]
+
+
+# Get similarity recommendations of several items, one list per (quantity, item id, recommend type): the next dates,
+# the rows and the popularity scores of the candidates of all the items are read with one query each
+def get_similar_batch(table_name, similar_requests):
     Model = apps.get_model(app_label='dimadb', model_name=table_name)
     display_fields = recommend_display_fields[table_name]
-    list_recommend_items = []
-    item_id = Model.objects.get(url=item_url).id
-    list_similar_items = ContentBasedRecommender.recommend_items_by_items(table_name=table_name, items_id=item_id)
+    list_results = []
+    # Rank the similar items first, only the ones shown are loaded
+    list_ranked_items = ContentBasedRecommender.rank_batch_items_by_items(table_name, [item_id for quantity, item_id, recommend_type in similar_requests])
     
     if (table_name == 'events'):
-        list_filtered_obj = []
-        today = datetime.today()
-        EventDateModel = apps.get_model(app_label='dimadb', model_name='eventdate')
-        for obj in list_similar_items:
-            list_event_dates = EventDateModel.objects.filter(event_id=obj['id'], date__gte=today).order_by('date')
-            list_event_dates = [model_to_dict(obj) for obj in list(list_event_dates)]
-            if (len(list_event_dates)):
-                obj['next_date'] = list_event_dates[0]['date']
-                list_filtered_obj.append(obj)
-        if (len(list_filtered_obj)):        
-            list_similar_items = sorted(list_filtered_obj, key=lambda x: x['similarity_score'], reverse=True)
-        else:
-            list_similar_items = []
+        # Only the events to come, with their next date
+        next_dates = get_next_dates(list(set([obj['id'] for ranked_items in list_ranked_items for obj in ranked_items])))
+        list_ranked_items = [[dict(obj, next_date=next_dates[obj['id']]) for obj in ranked_items if obj['id'] in next_dates]
+                             for ranked_items in list_ranked_items]
     
-    if (recommend_type == 'Similar combined with Most popular'):
-        list_similar_items = order_by_score(table_name, list_similar_items)
-
-    for i in range(0, int(quantity)):
-        if (i < len(list_similar_items)):
-            similar_obj = list_similar_items[i]
-            obj = Model.objects.get(id=similar_obj['id'])
-            obj = model_to_dict(obj)
+    # The popularity of every candidate is needed to order them
+    shown_ids = set()
+    popular_ids = set()
+    for (quantity, item_id, recommend_type), ranked_items in zip(similar_requests, list_ranked_items):
+        if (recommend_type == 'Similar combined with Most popular'):
+            popular_ids.update([obj['id'] for obj in ranked_items])
+        else:
+            shown_ids.update([obj['id'] for obj in ranked_items[:int(quantity)]])
+    list_objs = ContentBasedRecommender.hydrate_items(table_name, [{'id': item_id} for item_id in shown_ids | popular_ids],
+                                                      get_display_model_fields(Model, display_fields))
+    list_objs = {obj['id']: obj for obj in list_objs}
+    scores = get_popularity_scores(table_name, popular_ids)
+
+    for (quantity, item_id, recommend_type), ranked_items in zip(similar_requests, list_ranked_items):
+        list_recommend_items = []
+        if (recommend_type == 'Similar combined with Most popular'):
+            list_similar_items = [dict(list_objs[obj['id']], popular_score=scores.get(obj['id'], 0), **obj)
+                                  for obj in ranked_items if obj['id'] in list_objs]
+            list_similar_items = sorted(list_similar_items, key=lambda d: d['popular_score'], reverse=True)[:int(quantity)]
+        else:
+            list_similar_items = [dict(list_objs[obj['id']], **obj) for obj in ranked_items[:int(quantity)] if obj['id'] in list_objs]
+
+        for similar_obj in list_similar_items:
             recommend_item = {}
             for field in list(display_fields):
-                if field in obj:
-                    recommend_item[field] = obj[field]
-            if (table_name == 'events'):
-                recommend_item['next_date'] = similar_obj['next_date']
+                if field in similar_obj:
+                    recommend_item[field] = similar_obj[field]
             if (recommend_type == 'Similar combined with Most popular'):
                 recommend_item['popular_score'] = similar_obj['popular_score']
             recommend_item['similarity_score'] = similar_obj['similarity_score']
             list_recommend_items.append(recommend_item)
-            
-    if (len(list_recommend_items) == 0):
-        list_recommend_items = get_upcoming(table_name, quantity)
+                
+        if (len(list_recommend_items) == 0):
+            list_recommend_items = get_upcoming(table_name, quantity)
+        list_results.append(list_recommend_items)
 
-    return list_recommend_items
+    return list_results
     
     
-# Get list of recommend items
+# Get list of recommend items, from the cache while the data they are computed from is unchanged
 def get_recommend_items(level, item_type, recommend_type, quantity, domain, item_url):
+    key = (level, item_type, recommend_type, str(quantity), domain, item_url)
+    # Events whose date passed since the last roll move to their following date
+    if (roll_stale_next_dates()):
+        bump_data_version()
+    data_version = get_data_version()
+    is_cached, list_recommend_items = recommend_cache.get(key, data_version)
+    if (not is_cached):
+        list_recommend_items = compute_recommend_items(level, item_type, recommend_type, quantity, domain, item_url)
+        recommend_cache.set(key, data_version, list_recommend_items)
+    return list_recommend_items
+
+
+def compute_recommend_items(level, item_type, recommend_type, quantity, domain, item_url):
     list_recommend_items = []
 
     if (level == 'Homepage'):
@@ -947,6 +1013,11 @@ def get_recommend_items(level, item_type, recommend_type, quantity, domain, item
                 list_recommend_items = get_most_popular(table_name=item_type, quantity=quantity)
             elif (item_type == 'products'):
                 list_recommend_items = get_most_popular(table_name=item_type, quantity=quantity)
+        if (recommend_type == 'Trending'):
+            if (item_type == 'events'):
+                list_recommend_items = get_trending(table_name=item_type, quantity=quantity)
+            elif (item_type == 'products'):
+                list_recommend_items = get_trending(table_name=item_type, quantity=quantity)
     elif (level == 'Domain'):
         if (recommend_type == 'Upcoming'):
             if (item_type == 'events'):
@@ -956,6 +1027,11 @@ def get_recommend_items(level, item_type, recommend_type, quantity, domain, item
                 list_recommend_items = get_most_popular(table_name=item_type, quantity=quantity, domain=domain)
             elif (item_type == 'products'):
                 list_recommend_items = get_most_popular(table_name=item_type, quantity=quantity, domain=domain)
+        if (recommend_type == 'Trending'):
+            if (item_type == 'events'):
+                list_recommend_items = get_trending(table_name=item_type, quantity=quantity, domain=domain)
+            elif (item_type == 'products'):
+                list_recommend_items = get_trending(table_name=item_type, quantity=quantity, domain=domain)
     else:
         if (item_type == 'events'):
             list_recommend_items = get_similar(table_name=item_type, quantity=quantity, item_url=item_url, recommend_type=recommend_type)
@@ -965,6 +1041,56 @@ def get_recommend_items(level, item_type, recommend_type, quantity, domain, item
     return list_recommend_items
 
 
+# Get the lists of recommend items of several requests (level, item type, recommend type, quantity, domain, item url),
+# None for an unknown item. The lists missing from the cache are computed together: each section (level, item type,
+# recommend type, domain) once for its largest quantity, and the similar items of each item type with one query per
+# kind of data.
+def get_batch_recommend_items(recommend_requests):
+    # Events whose date passed since the last roll move to their following date
+    if (roll_stale_next_dates()):
+        bump_data_version()
+    data_version = get_data_version()
+    list_results = [None] * len(recommend_requests)
+    missing_keys = {}
+    for index, (level, item_type, recommend_type, quantity, domain, item_url) in enumerate(recommend_requests):
+        key = (level, item_type, recommend_type, str(quantity), domain, item_url)
+        is_cached, list_recommend_items = recommend_cache.get(key, data_version)
+        if (is_cached):
+            list_results[index] = list_recommend_items
+        else:
+            missing_keys.setdefault(key, []).append(index)
+
+    sections = {}
+    similar_keys = {}
+    computed = {}
+    for key in missing_keys:
+        level, item_type, recommend_type, quantity, domain, item_url = key
+        if (level == 'Homepage' or level == 'Domain'):
+            sections.setdefault((level, item_type, recommend_type, domain), []).append(key)
+        elif (item_type == 'events' or item_type == 'products'):
+            try:
+                similar_keys.setdefault(item_type, []).append((key, get_item_id(item_type, item_url)))
+            except ObjectDoesNotExist:
+                pass
+        else:
+            computed[key] = []
+
+    for (level, item_type, recommend_type, domain), section_keys in sections.items():
+        list_recommend_items = compute_recommend_items(level, item_type, recommend_type, max([int(key[3]) for key in section_keys]), domain, None)
+        for key in section_keys:
+            computed[key] = list_recommend_items[:int(key[3])]
+    for item_type, item_keys in similar_keys.items():
+        list_similar = get_similar_batch(item_type, [(key[3], item_id, key[2]) for key, item_id in item_keys])
+        for (key, item_id), list_recommend_items in zip(item_keys, list_similar):
+            computed[key] = list_recommend_items
+
+    for key, list_recommend_items in computed.items():
+        recommend_cache.set(key, data_version, list_recommend_items)
+        for index in missing_keys[key]:
+            list_results[index] = list_recommend_items
+    return list_results
+
+
 @api_view(['GET'])
 @authentication_classes([])
 @permission_classes([])
@@ -973,6 +1099,11 @@ def get_list_recommend(request):
         # Authorization
         bearer_token = request.headers.get('Authorization')
         if (bearer_token == 'Bearer ' + API_KEY):
+            # The browser or the CDN already has the recommendations of this data version
+            etag, last_modified = get_data_validators()
+            not_modified = get_not_modified_response(request, etag, last_modified)
+            if (not_modified is not None):
+                return not_modified
             # Read request info
             level = request.GET.get('level', None)
             item_type = request.GET.get('itemType', None)
@@ -981,7 +1112,8 @@ def get_list_recommend(request):
             domain = request.GET.get('domain', None)
             item_url = request.GET.get('itemUrl', None)
             list_recommend_items = get_recommend_items(level, item_type, recommend_type, quantity, domain, item_url)
-            return Response({'itemType': item_type, 'recommendType': recommend_type, 'items': list_recommend_items}, status=status.HTTP_200_OK)
+            response = Response({'itemType': item_type, 'recommendType': recommend_type, 'items': list_recommend_items}, status=status.HTTP_200_OK)
+            return set_http_cache_headers(response, etag, last_modified)
         else:
             return Response({'message': 'Authorization failed'}, status=status.HTTP_401_UNAUTHORIZED)
     except Exception as error:
@@ -993,6 +1125,8 @@ def get_embedded_link(api, recommend_type, is_gui=False):
         recommendItems = 'upComingItems'
     elif (recommend_type == 'Most popular'):
         recommendItems = 'popularItems'
+    elif (recommend_type == 'Trending'):
+        recommendItems = 'trendingItems'
     elif (recommend_type == 'Similar'):
         recommendItems = 'similarItems'
     elif (recommend_type == 'Similar combined with Most popular'):
@@ -1059,11 +1193,66 @@ def train_similar_recommend(request):
         # Read request info
         body = json.loads(request.body)
         item_type = body['itemType']
-        # Training
-        ContentBasedRecommender.train_items_by_items(table_name=item_type)
+        mode = body.get('mode', 'full')
+        # Optional LDA options: trainingMode ('single' or 'multicore'), workers, chunksize, passes, similarityWorkers,
+        # bounded (prune the vocabulary and store float32 arrays, see LDA_MEMORY_BOUNDS)
+        training_options = {}
+        option_keys = {'trainingMode': 'training_mode', 'workers': 'workers', 'chunksize': 'chunksize', 'passes': 'passes',
+                       'similarityWorkers': 'similarity_workers', 'bounded': 'bounded'}
+        for key in option_keys:
+            if (body.get(key) is not None):
+                training_options[option_keys[key]] = body[key]
+        # Optional topic sweep options (mode 'sweep'): topicCandidates, coherence ('u_mass' or 'c_v'), processes
+        sweep_options = {}
+        option_keys = {'topicCandidates': 'candidates', 'coherence': 'coherence', 'processes': 'processes'}
+        for key in option_keys:
+            if (body.get(key) is not None):
+                sweep_options[option_keys[key]] = body[key]
+        # Optional similarity backend ('lda' or 'tfidf'), else the one of the item type in the settings
+        backend = body.get('backend', None)
+        # Training runs in the training worker, a job already queued for this item type is reused
+        job, created = enqueue_training_job(item_type, mode, {'trainingOptions': training_options, 'sweepOptions': sweep_options,
+                                                              'backend': backend})
         # Get similarity recommendation training info
         similar_train_info = get_similar_train_info()
-        return Response({'similarTrainInfo': similar_train_info}, status=status.HTTP_200_OK)
+        return Response({'similarTrainInfo': similar_train_info, 
+                         'job': TrainingJobSerializer(job).data,
+                         'isNewJob': created}, status=status.HTTP_200_OK)
+    except Exception as error:
+        return Response({'message': error})
+
+
+@api_view(['GET'])
+def list_training_jobs(request):
+    try:
+        item_type = request.GET.get('itemType', None)
+        jobs = TrainingJob.objects.all().order_by('-created_at')
+        if (item_type is not None):
+            jobs = jobs.filter(item_type=item_type)
+        serializer = TrainingJobSerializer(jobs[:20], many=True)
+        return Response({'jobs': serializer.data}, status=status.HTTP_200_OK)
+    except Exception as error:
+        return Response({'message': error})
+
+
+@api_view(['GET'])
+def get_training_job(request, pk):
+    try:
+        job = TrainingJob.objects.get(id=pk)
+        return Response({'job': TrainingJobSerializer(job).data}, status=status.HTTP_200_OK)
+    except TrainingJob.DoesNotExist:
+        return Response({'message': 'Training job not found'}, status=status.HTTP_404_NOT_FOUND)
+    except Exception as error:
+        return Response({'message': error})
+
+
+@api_view(['POST'])
+def cancel_training_job_view(request, pk):
+    try:
+        job = cancel_training_job(pk)
+        return Response({'job': TrainingJobSerializer(job).data}, status=status.HTTP_200_OK)
+    except TrainingJob.DoesNotExist:
+        return Response({'message': 'Training job not found'}, status=status.HTTP_404_NOT_FOUND)
     except Exception as error:
         return Response({'message': error})
 
@@ -1073,8 +1262,8 @@ def get_recommend_info(request):
     try:
         # Recommend info
         # recommend_levels = {
-        #     "Homepage": ["Upcoming", "Most popular"],
-        #     "Domain": ["Upcoming", "Most popular"],
+        #     "Homepage": ["Upcoming", "Most popular", "Trending"],
+        #     "Domain": ["Upcoming", "Most popular", "Trending"],
         #     "Item": ["Similar", "Similar combined with Most popular"]
         # }
         recommend_types = [
@@ -1090,17 +1279,20 @@ def get_recommend_info(request):
             }, {
                 "name": "Similar combined with Most popular",
                 "displayName": "Produits similaires combinés avec les plus populaires"
+            }, {
+                "name": "Trending",
+                "displayName": "Tendances"
             }
         ]
         
         recommend_levels = {
             "Homepage": {
                 "displayName": "Page d'accueil",
-                "algorithms": [recommend_types[0], recommend_types[1]]
+                "algorithms": [recommend_types[0], recommend_types[1], recommend_types[4]]
             }, 
             "Domain": {
                 "displayName": "Domaine",
-                "algorithms": [recommend_types[0], recommend_types[1]]
+                "algorithms": [recommend_types[0], recommend_types[1], recommend_types[4]]
             }, 
             "Item": {
                 "displayName": "Produit",
@@ -1159,14 +1351,29 @@ def get_similar_train_info():
             Model = apps.get_model(app_label='dimadb', model_name=item_type['value'])
             item_type['number_items'] = len(Model.objects.all())
 
-            # Get total number of trained items
-            if (LdaSimilarityVersion.objects.filter(item_type=item_type['value']).exists()):
-                obj = LdaSimilarityVersion.objects.filter(item_type=item_type['value']).latest('created_at')
+            # Get total number of trained items (of the active version, else of the latest one)
+            versions = LdaSimilarityVersion.objects.filter(item_type=item_type['value'])
+            if (versions.exists()):
+                obj = get_active_version(item_type['value']) or versions.latest('created_at')
                 item_type['latest_training_at'] = str(obj)
                 item_type['number_trained_items'] = model_to_dict(obj)['n_products']
+                item_type['number_topics'] = obj.n_topics
+                item_type['similarity_backend'] = obj.backend
+                item_type['artifact_bytes'] = obj.artifact_bytes
+                # Time, counts and memory of each stage of the training
+                item_type['training_stages'] = list(obj.stages.order_by('position').values(
+                    'stage', 'seconds', 'n_rows', 'vocabulary_size', 'pairs_evaluated', 'rows_written', 'cumulative_peak_rss_mb'))
+                # Coherence of the numbers of topics tried when the model comes from a topic sweep
+                item_type['topic_sweep'] = list(obj.sweep_results.order_by('n_topics').values(
+                    'n_topics', 'coherence', 'coherence_measure', 'training_seconds', 'is_selected'))
             else:
                 item_type['latest_training_at'] = ''
                 item_type['number_trained_items'] = 0
+                item_type['number_topics'] = None
+                item_type['similarity_backend'] = settings.SIMILARITY_BACKENDS.get(item_type['value'], 'lda')
+                item_type['artifact_bytes'] = None
+                item_type['training_stages'] = []
+                item_type['topic_sweep'] = []
 
             # Get total number of items
             Model = apps.get_model(app_label='dimadb', model_name=item_type['value'])
@@ -1229,12 +1436,24 @@ def update_activity_weight(request):
             except:
                 new_activity_type = WebActivityType(name=type, value=web_activity_types[type])
                 new_activity_type.save()
+        # The weights change the score of every item, the page activity stays the same
+        rebuild_popularity(activity=False)
+        bump_data_version()
 
         return Response({}, status=status.HTTP_200_OK)
     except Exception as error:
         return Response({'message': error})
 
 
+# Hit/miss counters of the recommendation cache of the process answering
+@api_view(['GET'])
+def get_recommend_cache_stats(request):
+    try:
+        return Response({'cache': recommend_cache.stats(), 'dataVersion': get_data_version()}, status=status.HTTP_200_OK)
+    except Exception as error:
+        return Response({'message': error})
+
+
 # Generate report object (info, name, title, data)
 def create_report(name, title, data, chart_type, is_change):
     return {
@@ -1704,6 +1923,10 @@ def synchronize_google_analytic(request):
                     import_id=import_info.id
                 )
                 new_report.save()
+        page_locations = set([record['pageLocation'] for record in json_data])
+        refresh_page_activity(page_locations)
+        refresh_page_popularity(page_locations)
+        bump_data_version()
        
         return Response({}, status=status.HTTP_200_OK)
     except Exception as error:
@@ -1730,6 +1953,32 @@ def get_embedded_recommendation(is_gui=False):
     
     return embedded_link
 
+# Item type, recommend level, domain, item url and default recommend types of a page of the partner website
+def get_page_recommend_info(url):
+    item_url = ''
+    item_domain = ''
+    recommend_types = []
+    
+    #Mapping itemType, recommendLevel, domain with url
+    item_type, recommend_level, slug_domain = parse_page_url(url)
+    
+    if (recommend_level == 'Item'):
+        item_url = url
+        recommend_types += ['Similar']
+    elif (recommend_level == 'Homepage'):
+        if (item_type == 'events'):
+            recommend_types += ['Upcoming']
+        recommend_types += ['Most popular']
+    elif (recommend_level == 'Domain'):
+        if (item_type == 'events'):
+            recommend_types += ['Upcoming']
+        recommend_types += ['Most popular']
+        # Domains of the routing table, kept in memory
+        item_domain = routing_table.get_domain(item_type, slug_domain)
+
+    return item_type, recommend_level, item_domain, item_url, recommend_types
+
+
 @api_view(['GET'])
 @authentication_classes([])
 @permission_classes([])
@@ -1738,66 +1987,15 @@ def get_recommendation(request):
         # Authorization
         bearer_token = request.headers.get('Authorization')
         if (bearer_token == 'Bearer ' + API_KEY):
+            # The browser or the CDN already has the recommendations of this data version
+            etag, last_modified = get_data_validators()
+            not_modified = get_not_modified_response(request, etag, last_modified)
+            if (not_modified is not None):
+                return not_modified
             # Read request info
             url = request.GET.get('url', None)
-            url_parts = url.split('/')
-            url_len = len(url_parts)
             recommendation = []
-            item_type = ''
-            item_url = ''
-            slug_domain = ''
-            item_domain = ''
-            recommend_level = ''
-            recommend_types = []
-            
-            #Mapping itemType, recommendLevel, domain with url
-            for index, part in enumerate(url_parts):
-                if part == 'magazine':
-                    item_type = 'products'
-                    if (url_len - index == 3):
-                        recommend_level = 'Item'
-                    elif (url_len - index == 2):
-                        if url_parts[url_len-1] != 'tous-les-articles':
-                            recommend_level = 'Domain'
-                            slug_domain = url_parts[url_len-1]
-                        else:
-                            recommend_level = 'Homepage'
-                    else:
-                        recommend_level = 'Homepage'
-                    break
-                elif part == 'evenements':
-                    item_type = 'events'
-                    if (url_len - index == 2):
-                        recommend_level = 'Item'
-                    else:
-                        recommend_level = 'Homepage'
-                    break
-            
-            if (recommend_level == 'Item'):
-                item_url = url
-                recommend_types += ['Similar']
-            elif (recommend_level == 'Homepage'):
-                if (item_type == 'events'):
-                    recommend_types += ['Upcoming']
-                recommend_types += ['Most popular']
-            elif (recommend_level == 'Domain'):
-                if (item_type == 'events'):
-                    recommend_types += ['Upcoming']
-                recommend_types += ['Most popular']
-                Model = apps.get_model(app_label='dimadb', model_name=item_type)
-                domain_column = ''
-                
-                if (item_type == 'events'):
-                    domain_column = 'event_type'
-                else:
-                    domain_column = 'product_type'
-                item_domains = Model.objects.all().values(domain_column).distinct()
-                item_domains = [domain[domain_column] for domain in list(item_domains)]
-                
-                for domain in item_domains:
-                    if slugify(domain) == slug_domain:
-                        item_domain = domain
-                        break
+            item_type, recommend_level, item_domain, item_url, recommend_types = get_page_recommend_info(url)
                     
             # if (url == 'file:///Users/nguyenchannam/Desktop/test.html'):
             #     recommend_level = 'Item'
@@ -1812,8 +2010,54 @@ def get_recommendation(request):
                     'recommendType': recommend_type, 
                     'items': recommends})
             
-            return Response(recommendation, status=status.HTTP_200_OK)
+            return set_http_cache_headers(Response(recommendation, status=status.HTTP_200_OK), etag, last_modified)
+        else:
+            return Response({'message': 'Authorization failed'}, status=status.HTTP_401_UNAUTHORIZED)
+    except Exception as error:
+        return Response({'message': error})
+
+# Recommendations of the pages of a batch request, one entry per page in their order
+def get_batch_recommendation_data(pages):
+    page_recommend_types = []
+    recommend_requests = []
+    for page in pages:
+        url = page['url']
+        quantity = int(page.get('quantity') or 4)
+        item_type, recommend_level, item_domain, item_url, recommend_types = get_page_recommend_info(url)
+        if (page.get('recommendType')):
+            recommend_types = [page['recommendType']]
+        page_recommend_types.append((url, item_type, recommend_types))
+        recommend_requests += [(recommend_level, item_type, recommend_type, quantity, item_domain, item_url) for recommend_type in recommend_types]
+
+    list_results = iter(get_batch_recommend_items(recommend_requests))
+    batch = []
+    for url, item_type, recommend_types in page_recommend_types:
+        recommendation = []
+        for recommend_type in recommend_types:
+            recommends = next(list_results)
+            recommend = {'itemType': item_type, 'recommendType': recommend_type, 'items': recommends or []}
+            if (recommends is None):
+                recommend['message'] = 'Item not found'
+            recommendation.append(recommend)
+        batch.append({'url': url, 'recommendation': recommendation})
+    return batch
+
+
+# Recommendations of several pages or sections with one request (e.g. a listing page with a block per item).
+# Body: {"requests": [{"url": page url, "recommendType": optional, else the ones of the page, "quantity": optional, 4}]}.
+# The answer has one entry per request, in their order: {"url", "recommendation": [{"itemType", "recommendType", "items"}]}
+@api_view(['POST'])
+@authentication_classes([])
+@permission_classes([])
+def get_batch_recommendation(request):
+    try:
+        # Authorization
+        bearer_token = request.headers.get('Authorization')
+        if (bearer_token == 'Bearer ' + API_KEY):
+            # Read request info
+            body = json.loads(request.body)
+            return Response(get_batch_recommendation_data(body['requests']), status=status.HTTP_200_OK)
         else:
             return Response({'message': 'Authorization failed'}, status=status.HTTP_401_UNAUTHORIZED)
     except Exception as error:
-        return Response({'message': error})
\ No newline at end of file
+        return Response({'message': error})
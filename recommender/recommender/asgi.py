@@ -2,6 +2,10 @@
 ASGI config for recommender project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+The same urls are served as by the WSGI application; the dimadb/async/ ones are
+async views, e.g. with ``gunicorn recommender.asgi:application -k uvicorn.workers.UvicornWorker``.
+They are not faster than the sync views (benchmarks/bench_widget_latency.py),
+which the widget keeps using.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
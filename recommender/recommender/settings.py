@@ -111,6 +111,8 @@ DATABASES = {
         'PASSWORD': env('DB_PASSWORD'),
         'HOST': env('DB_HOST'),
         'PORT': env('DB_PORT'),
+        # Seconds a connection is kept (0: closed after each request, by the sync and the async views alike)
+        'CONN_MAX_AGE': env.int('DB_CONN_MAX_AGE', default=0),
     },
     'OPTIONS': {
             'charset': 'utf8mb4',
@@ -167,3 +169,78 @@ STATIC_ROOT = os.path.join(BASE_DIR, "static/")
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+
+# Recommendation results cached by each process: maximum number of results (0: no cache) and lifetime in seconds.
+# The results are also dropped as soon as an import, a training or an activity weight update changes the data.
+RECOMMEND_CACHE_SIZE = env.int('RECOMMEND_CACHE_SIZE', default=1000)
+RECOMMEND_CACHE_TTL = env.int('RECOMMEND_CACHE_TTL', default=300)
+# Cache-Control of the widget endpoints (get-recommendation, get-list-recommend), which also send an ETag and a
+# Last-Modified date and answer conditional requests with 304 while the data is unchanged ('': no Cache-Control)
+RECOMMEND_HTTP_CACHE_CONTROL = env('RECOMMEND_HTTP_CACHE_CONTROL', default='public, max-age=60')
+# Seconds between two checks of the version of the item urls by the routing table of each process (item urls and
+# domain slugs of get-recommendation), which is built again when item imports or edits changed them
+ROUTING_TABLE_CHECK_SECONDS = env.int('ROUTING_TABLE_CHECK_SECONDS', default=5)
+
+# Seconds between two rolls, by each process serving recommendations, of the events whose next date has passed
+NEXT_DATES_ROLL_SECONDS = env.int('NEXT_DATES_ROLL_SECONDS', default=60)
+
+# 'Trending' recommendations: web activities of the last TRENDING_WINDOW_DAYS days, whose weight is halved
+# every TRENDING_HALF_LIFE_DAYS days of age
+TRENDING_WINDOW_DAYS = env.int('TRENDING_WINDOW_DAYS', default=28)
+TRENDING_HALF_LIFE_DAYS = env.float('TRENDING_HALF_LIFE_DAYS', default=7)
+
+# Recommender training
+# Directory of the trained artifacts (LDA model, dictionary, corpus, neighbour index)
+LDA_MODEL_DIR = env('LDA_MODEL_DIR', default=os.path.join(BASE_DIR, 'dimadb', 'model_recommend'))
+# Artifact versions kept per item type (the published one included), for the processes still reading older ones
+LDA_ARTIFACT_VERSIONS_KEPT = env.int('LDA_ARTIFACT_VERSIONS_KEPT', default=3)
+# Share of tokens of new/changed descriptions unknown to the LDA dictionary above which
+# an incremental training falls back to a full retrain
+LDA_VOCABULARY_DRIFT_THRESHOLD = env.float('LDA_VOCABULARY_DRIFT_THRESHOLD', default=0.2)
+# A running training job whose worker has not updated it for this long is considered dead; the worker
+# updates it every TRAINING_JOB_HEARTBEAT_SECONDS while the training runs
+TRAINING_JOB_STALE_SECONDS = env.int('TRAINING_JOB_STALE_SECONDS', default=1800)
+TRAINING_JOB_HEARTBEAT_SECONDS = env.int('TRAINING_JOB_HEARTBEAT_SECONDS', default=60)
+# Messages of the training worker (dimadb.training_jobs) are written to the console
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {'console': {'class': 'logging.StreamHandler'}},
+    'loggers': {'dimadb': {'handlers': ['console'], 'level': env('DIMADB_LOG_LEVEL', default='INFO')}},
+}
+# LDA training options per item type: training_mode is 'single' (LdaModel) or 'multicore' (LdaMulticore),
+# workers is only used by the multicore mode (None: number of cores - 1), similarity_workers is the number of
+# processes computing the similarities from the doc-topic matrix (1: in the training process, None: one per core),
+# bounded trains with the limits of LDA_MEMORY_BOUNDS
+LDA_TRAINING_OPTIONS = {
+    'events': {'training_mode': 'single', 'workers': None, 'chunksize': 2000, 'passes': 1, 'similarity_workers': 1,
+               'bounded': False},
+    'products': {'training_mode': 'single', 'workers': None, 'chunksize': 2000, 'passes': 1, 'similarity_workers': 1,
+                 'bounded': False},
+}
+# Limits of the bounded training mode per item type: the tokens found in fewer than no_below descriptions or in more
+# than a no_above share of them are removed from the dictionary, which then keeps the keep_n most frequent ones
+# (None: no limit); float32 halves the LDA state, the doc-topic index and the model files.
+LDA_MEMORY_BOUNDS = {
+    'events': {'no_below': 2, 'no_above': 0.5, 'keep_n': 20000, 'float32': True},
+    'products': {'no_below': 2, 'no_above': 0.5, 'keep_n': 50000, 'float32': True},
+}
+# Similarity backend per item type: 'lda' (LDA topics) or 'tfidf' (sparse TF-IDF cosine, much faster to train)
+SIMILARITY_BACKENDS = {
+    'events': 'lda',
+    'products': 'lda',
+}
+# Storage of the similarities per item type: 'top_k' keeps the k most similar items of each item (LdaNeighbour),
+# 'pairs' keeps every pair above the similarity threshold (LdaSimilarity). Both are updated incrementally: an
+# incremental training only computes again the lists (top_k) or the pairs of the items which can change.
+LDA_SIMILARITY_STORAGE = {
+    'events': {'storage': 'top_k', 'k': 20},
+    'products': {'storage': 'top_k', 'k': 20},
+}
+# Topic sweep ('sweep' training mode): numbers of topics tried in parallel, coherence measure used to
+# select the best one ('u_mass', or the slower 'c_v') and worker processes (None: one per candidate, up to the cores)
+LDA_TOPIC_SWEEP = {
+    'candidates': [5, 8, 11, 15, 20],
+    'coherence': 'u_mass',
+    'processes': None,
+}
@@ -34,6 +34,8 @@ function getListView(containerId, res) {
 
       if (recommendType == "Most popular") {
         title += " les plus populaires";
+      } else if (recommendType == "Trending") {
+        title += " tendance";
       } else if (recommendType == "Upcoming") {
         title += " à venir";
       } else {
@@ -210,6 +212,26 @@ function getMostPopularItems(
   return items;
 }
 
+function getTrendingItems(
+  itemType = "",
+  level = "",
+  domain = "",
+  quantity = 0
+) {
+  const recommendType = "Trending";
+  const api = generateRecommendAPI(
+    itemType,
+    level,
+    domain,
+    "",
+    recommendType,
+    quantity
+  );
+  const items = getRecommendItems(api, itemType, recommendType);
+
+  return items;
+}
+
 function getUpComingItems(
   itemType = "",
   level = "",
@@ -303,6 +325,8 @@ function getListViews(recommendations) {
   
         if (recommendType == "Most popular") {
           title += " les plus populaires";
+        } else if (recommendType == "Trending") {
+          title += " tendance";
         } else if (recommendType == "Upcoming") {
           title += " à venir";
         } else {